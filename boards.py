@@ -0,0 +1,93 @@
+import random
+
+# Balanced boards from what synerGen generators say about their goals: a spread of difficulties with every row,
+# column and diagonal adding up to about the same, and no two goals in a line sharing a synergy type (which would
+# make that line easier than it looks). Every seed's board is the best of a batch of random candidates, each taking
+# one goal from every slice of the goals sorted by difficulty, then improved by trying swaps. Scoring is a loop over
+# precomputed lines with each goal's types as bits of an int, so clashes cost an & and an | per square.
+CANDIDATES = 64
+SWAPS = 256
+
+
+def shuffled_goals(num_goals, board_size, seed):
+    # The server's boards without --balanced
+    goal_indices = list(range(num_goals))
+    random.Random(seed).shuffle(goal_indices)
+    return goal_indices[: board_size * board_size]
+
+
+def board_lines(size):
+    # Square positions of every row, column and diagonal
+    rows = [tuple(range(row * size, (row + 1) * size)) for row in range(size)]
+    columns = [tuple(range(column, size * size, size)) for column in range(size)]
+    diagonals = [tuple(range(0, size * size, size + 1)), tuple(range(size - 1, size * size - 1, size - 1))]
+    return rows + columns + diagonals
+
+
+class Board_Generator:
+    def __init__(self, difficulties, types, size, candidates=CANDIDATES, swaps=SWAPS):
+        self.size = size
+        self.num_squares = size * size
+        self.candidates = candidates
+        self.swaps = swaps
+        self.difficulties = difficulties
+        type_bits = {}
+        self.masks = [sum(1 << type_bits.setdefault(name, len(type_bits)) for name in set(names)) for names in types]
+        self.order = sorted(range(len(difficulties)), key=difficulties.__getitem__)
+        self.lines = board_lines(size)
+        self.lines_through = [[line for line in self.lines if idx in line] for idx in range(self.num_squares)]
+
+    def candidate(self, rng):
+        # goal indices by square
+        num_goals = len(self.order)
+        picks = [
+            self.order[rng.randrange(i * num_goals // self.num_squares, (i + 1) * num_goals // self.num_squares)]
+            for i in range(self.num_squares)
+        ]
+        rng.shuffle(picks)
+        return picks
+
+    def line_score(self, board, line, target):
+        seen = clashes = total = 0
+        for idx in line:
+            goal = board[idx]
+            mask = self.masks[goal]
+            if seen & mask:
+                clashes += 1
+            seen |= mask
+            total += self.difficulties[goal]
+        return clashes, (total - target) ** 2
+
+    def score(self, board):
+        # (synergy clashes, sum of squared differences between each line's difficulty and an even share), lower is
+        # fairer and clashes count first
+        target = sum(self.difficulties[goal] for goal in board) / self.size
+        clashes = spread = 0
+        for line in self.lines:
+            line_clashes, line_spread = self.line_score(board, line, target)
+            clashes += line_clashes
+            spread += line_spread
+        return clashes, spread
+
+    def score_batch(self, boards):
+        return [self.score(board) for board in boards]
+
+    def improve(self, board, rng):
+        # Swapping two squares only changes the lines through them, so only those get scored again
+        target = sum(self.difficulties[goal] for goal in board) / self.size
+        for _ in range(self.swaps):
+            a, b = rng.sample(range(self.num_squares), 2)
+            lines = {*self.lines_through[a], *self.lines_through[b]}
+            before = [self.line_score(board, line, target) for line in lines]
+            board[a], board[b] = board[b], board[a]
+            after = [self.line_score(board, line, target) for line in lines]
+            if tuple(map(sum, zip(*after))) > tuple(map(sum, zip(*before))):
+                board[a], board[b] = board[b], board[a]
+        return board
+
+    def generate(self, seed):
+        # Goal indices by square for seed, always the same ones for the same goals, size and seed
+        rng = random.Random(seed)
+        candidates = [self.candidate(rng) for _ in range(self.candidates)]
+        scores = self.score_batch(candidates)
+        return self.improve(candidates[scores.index(min(scores))], rng)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import re
+import struct
+
+# Goal lists come from BingoSync generator files, which are JavaScript rather than JSON: comments, trailing commas
+# and a "var bingoList = " in front are all fine there. Parsing one with thousands of goals takes a while, so the
+# sorted goal descriptions also get compiled into a cache file next to it, which is only trusted while the source
+# hashes the same:
+#   CACHE_MAGIC, sha256 of the source, catalog digest, !I goal count, (count + 1) !I offsets into the blob, blob
+# where the blob is every goal description in UTF-8, back to back. The catalog digest is the sha256 of the offsets
+# and blob, so two catalogs with the same goals in them have the same digest however their sources are written.
+# After the blob, to the end of the file, comes what synerGen generators say about each goal besides its description,
+# as JSON: {"difficulty": [number per goal], "types": [[synergy type names] per goal]}. Only the server's board
+# generator needs it, so it doesn't count towards the digest.
+CATALOG_FILE = "./bingo.json"
+CACHE_SUFFIX = ".cache"
+CACHE_MAGIC = b"BNGC\x02"
+HASH_SIZE = 32
+
+_JS_STRING = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+_JS_COMMENTS = re.compile(_JS_STRING + r"|//[^\n]*|/\*.*?\*/", re.S)
+_JS_TRAILING_COMMAS = re.compile(_JS_STRING + r"|,(?=\s*[}\]])")
+_HEADER = struct.Struct("!%is%is%isI" % (len(CACHE_MAGIC), HASH_SIZE, HASH_SIZE))
+
+
+def _keep_strings(match):
+    return match.group() if match.group()[0] in "\"'" else ""
+
+
+def strip_js(text):
+    # Drops comments and then trailing commas, leaving anything inside strings alone. Commas go in a second pass so a
+    # comment between one and the closing bracket doesn't hide it
+    return _JS_TRAILING_COMMAS.sub(_keep_strings, _JS_COMMENTS.sub(_keep_strings, text))
+
+
+def goal_info(goal):
+    # (difficulty, [synergy types]) of a goal from a synerGen generator, 0 and none for anything it doesn't say
+    difficulty = goal.get("Difficulty", goal.get("difficulty", 0))
+    types = goal.get("Types", goal.get("types", []))
+    if isinstance(types, dict):
+        types = list(types)
+    elif isinstance(types, str):
+        types = [types]
+    if not isinstance(difficulty, (int, float)) or not isinstance(types, list):
+        return 0, []
+    return difficulty, [str(goal_type) for goal_type in types]
+
+
+def parse_generator(text):
+    # Returns [(description, difficulty, [synergy types])] for every goal, sorted by description
+    text = strip_js(text)
+    start = 0
+    if (name := text.find("bingoList")) >= 0:
+        start = min((pos for pos in (text.find("{", name), text.find("[", name)) if pos >= 0), default=0)
+    goals, _ = json.JSONDecoder().raw_decode(text, start)
+    if isinstance(goals, list):
+        # some generators are a list of goals rather than an object of them
+        goals = dict(enumerate(goals))
+    goals = [goals[key] for key in goals if isinstance(goals[key], dict) and goals[key].get("Desc")]
+    return sorted((goal["Desc"], *goal_info(goal)) for goal in goals)
+
+
+class Catalog:
+    # The sorted goal descriptions, decoded from the compiled form only when asked for
+    def __init__(self, data):
+        magic, self.source_hash, self.digest, self.count = _HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC:
+            raise ValueError("not a compiled goal catalog")
+        self.data = data
+        self.offsets = _HEADER.size
+        self.blob = self.offsets + 4 * (self.count + 1)
+        self.info = None
+
+    @classmethod
+    def compile(cls, goal_list, source_hash=b"\0" * HASH_SIZE, info=None):
+        # info is a (difficulty, [synergy types]) per goal, if there's any
+        encoded = [goal.encode() for goal in goal_list]
+        offsets = [0]
+        for goal in encoded:
+            offsets.append(offsets[-1] + len(goal))
+        body = struct.pack("!%iI" % len(offsets), *offsets) + b"".join(encoded)
+        digest = hashlib.sha256(body).digest()
+        if info is not None:
+            difficulties, types = zip(*info) if info else ((), ())
+            body += json.dumps({"difficulty": difficulties, "types": types}, separators=(",", ":")).encode()
+        return cls(_HEADER.pack(CACHE_MAGIC, source_hash, digest, len(encoded)) + body)
+
+    def goal_info(self):
+        # ([difficulty per goal], [[synergy types] per goal]), decoded the first time it's asked for
+        if self.info is None:
+            start = self.blob + struct.unpack_from("!I", self.data, self.offsets + 4 * self.count)[0]
+            info = json.loads(self.data[start:]) if start < len(self.data) else {}
+            self.info = (info.get("difficulty", [0] * self.count), info.get("types", [[]] * self.count))
+        return self.info
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError("goal index out of range")
+        start, end = struct.unpack_from("!2I", self.data, self.offsets + 4 * idx)
+        return self.data[self.blob + start : self.blob + end].decode()
+
+    def __iter__(self):
+        return (self[idx] for idx in range(self.count))
+
+
+def load_catalog(path=CATALOG_FILE):
+    with open(path, "rb") as f:
+        source = f.read()
+    source_hash = hashlib.sha256(source).digest()
+    cache_path = path + CACHE_SUFFIX
+    try:
+        with open(cache_path, "rb") as f:
+            catalog = Catalog(f.read())
+        if catalog.source_hash == source_hash:
+            return catalog
+    except (OSError, ValueError, struct.error):
+        pass
+    goals = parse_generator(source.decode("utf-8-sig"))
+    catalog = Catalog.compile([goal[0] for goal in goals], source_hash, [goal[1:] for goal in goals])
+    try:
+        with open(cache_path + ".tmp", "wb") as f:
+            f.write(catalog.data)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        # a read-only directory just means compiling it again next time
+        pass
+    return catalog
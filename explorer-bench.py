@@ -0,0 +1,846 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+from protocol import (
+    CLIENT_HELLO,
+    FIELD_COLOR,
+    FIELD_ROOM,
+    FIELD_SIZE,
+    HELLO_MAGIC,
+    MARK,
+    MARKS,
+    PROTOCOL_VERSION,
+    Frame_Reader,
+    decode_fields,
+    decode_marks,
+    decode_varint,
+    encode_fields,
+    encode_varints,
+    frame,
+    pack_color,
+)
+from render import Board_Image
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "explorer-server.py")
+
+
+def write_catalog(directory, num_goals):
+    goals = {"goal-%05i" % i: {"Desc": "Goal number %i" % i} for i in range(num_goals)}
+    with open(os.path.join(directory, "bingo.json"), "w") as f:
+        json.dump(goals, f)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory, port, board_size, engine, extra_args=()):
+    return wait_listening(port, [str(board_size), "-s", "0", "-e", engine, *extra_args], directory)
+
+
+def start_relays(directory, port, num_relays, chain, engine):
+    # Relays of the server on port, every one following the server or, chained, each following the one before
+    relays = []
+    upstream = port
+    for _ in range(num_relays):
+        relay_port = free_port()
+        relay_args = ["--relay", "127.0.0.1:%i" % upstream, "-e", engine]
+        relays.append((relay_port, wait_listening(relay_port, relay_args, directory)))
+        if chain:
+            upstream = relay_port
+    return relays
+
+
+def wait_listening(port, args, directory):
+    proc = subprocess.Popen(
+        [sys.executable, SERVER, "127.0.0.1", str(port), *args],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start listening")
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {
+        "p50": pick(0.5),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": samples[-1],
+        "mean": statistics.fmean(samples),
+    }
+
+
+async def read_board(reader, board_size):
+    for _ in range(board_size * board_size):
+        num_markers = (await reader.readexactly(1))[0]
+        if num_markers:
+            await reader.readexactly(3 * num_markers)
+
+
+async def recv_frame(client):
+    while True:
+        for msg in client.frames:
+            return msg
+        if not (data := await client.reader.read(65536)):
+            raise ConnectionError("server hung up")
+        client.frames.feed(data)
+
+
+async def open_client(port, color=None, version=PROTOCOL_VERSION, room=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    client = SimpleNamespace(reader=reader, writer=writer, version=version, frames=Frame_Reader())
+    if version == 1:
+        writer.write(bytes([1]) if color is None else bytes([0, *color]))
+        client.board_size = (await reader.readexactly(1))[0]
+        await reader.readexactly(client.board_size * client.board_size)
+        await read_board(reader, client.board_size)
+        return client
+    fields = {} if color is None else {FIELD_COLOR: pack_color(color)}
+    if room is not None:
+        fields[FIELD_ROOM] = room
+    writer.write(bytes((HELLO_MAGIC, version)) + frame(CLIENT_HELLO, encode_fields(fields)))
+    _, hello = await recv_frame(client)
+    client.board_size = decode_varint(decode_fields(hello)[FIELD_SIZE])[0]
+    # the board snapshot is one frame, we don't need to look inside it
+    await recv_frame(client)
+    return client
+
+
+def send_marks(client, indices):
+    if client.version == 1:
+        client.writer.write(bytes(indices))
+    else:
+        client.writer.write(frame(MARK, encode_varints(indices)))
+
+
+async def recv_marks(client, num_marks):
+    if client.version == 1:
+        await client.reader.readexactly(4 * num_marks)
+        return
+    while num_marks > 0:
+        msg_type, payload = await recv_frame(client)
+        if msg_type == MARKS:
+            num_marks -= len(decode_marks(payload))
+
+
+async def bench_accept(port, num_clients, concurrency, version):
+    limit = asyncio.Semaphore(concurrency)
+    join_times = []
+
+    async def join():
+        async with limit:
+            start = time.perf_counter()
+            client = await open_client(port, version=version)
+            join_times.append(time.perf_counter() - start)
+            return client
+
+    start = time.perf_counter()
+    clients = await asyncio.gather(*[join() for _ in range(num_clients)])
+    elapsed = time.perf_counter() - start
+    return clients, elapsed, join_times
+
+
+async def bench_broadcast(port, spectators, num_marks, burst, version):
+    player = await open_client(port, (255, 0, 0), version)
+    num_squares = player.board_size * player.board_size
+    latencies = []
+    for mark in range(num_marks):
+        start = time.perf_counter()
+        send_marks(player, [(mark * burst + i) % num_squares for i in range(burst)])
+
+        async def receive(client):
+            await recv_marks(client, burst)
+            latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[receive(client) for client in spectators])
+    player.writer.close()
+    return latencies
+
+
+async def run_engine(port, args):
+    # stalled clients connect and never finish the handshake, like a player whose connection dropped mid-join
+    stalled = [await asyncio.open_connection("127.0.0.1", port) for _ in range(args.stalled)]
+    try:
+        clients, elapsed, join_times = await asyncio.wait_for(
+            bench_accept(port, args.connections, args.concurrency, args.protocol), args.timeout
+        )
+    except asyncio.TimeoutError:
+        return {"connections": args.connections, "error": "accepting stalled for over %is" % args.timeout}
+    for _, writer in stalled:
+        writer.close()
+    latencies = await bench_broadcast(port, clients, args.marks, args.burst, args.protocol)
+    for client in clients:
+        client.writer.close()
+    return {
+        "connections": args.connections,
+        "accept_seconds": elapsed,
+        "accepts_per_second": args.connections / elapsed,
+        "join_seconds": percentiles(join_times),
+        "broadcast_seconds": percentiles(latencies),
+    }
+
+
+def bench_server(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_catalog(directory, args.board_size * args.board_size)
+        for engine in args.engines:
+            port = free_port()
+            proc = start_server(directory, port, args.board_size, engine)
+            try:
+                results[engine] = asyncio.run(run_engine(port, args))
+            finally:
+                proc.terminate()
+                proc.wait()
+    return results
+
+
+def server_memory(pid):
+    # Resident set size of the server process now and at its peak, only on systems with /proc
+    try:
+        with open("/proc/%i/status" % pid) as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    return {
+        "rss_bytes": 1024 * int(status["VmRSS"].split()[0]),
+        "peak_rss_bytes": 1024 * int(status["VmHWM"].split()[0]),
+    }
+
+
+class Sent_Marks:
+    # When each mark went out, so every client receiving it can tell how long it took
+    def __init__(self):
+        self.times = {}  # (color, idx) -> send time of each toggle of idx by color, in order
+        self.count = 0
+
+    def record(self, color, idx):
+        self.times.setdefault((color, idx), []).append(time.perf_counter())
+        self.count += 1
+
+
+async def play(client, color, rate, duration, sent, rng):
+    # Marks a random square rate times a second
+    num_squares = client.board_size * client.board_size
+    start = time.perf_counter()
+    next_mark = start
+    while time.perf_counter() < start + duration:
+        idx = rng.randrange(num_squares)
+        sent.record(color, idx)
+        send_marks(client, [idx])
+        next_mark += 1 / rate
+        await asyncio.sleep(max(0, next_mark - time.perf_counter()))
+    await client.writer.drain()
+
+
+async def watch(client, sent, latencies):
+    # Receives marks until cancelled
+    seen = {}
+    while True:
+        msg_type, payload = await recv_frame(client)
+        if msg_type == MARKS:
+            received = time.perf_counter()
+            for idx, color in decode_marks(payload):
+                toggle = seen.get((color, idx), 0)
+                seen[(color, idx)] = toggle + 1
+                latencies.append(received - sent.times[(color, idx)][toggle])
+            client.received += 1
+
+
+def room_of(client, num_rooms):
+    # Players and spectators are each dealt out over the rooms in turn, a single room is just the default one
+    return None if num_rooms == 1 else b"room-%i" % (client % num_rooms)
+
+
+async def run_load(port, args, pid, spectator_ports=None):
+    # spectators are spread over spectator_ports (relays) if there are any, players always join the server itself
+    spectator_ports = spectator_ports or [port]
+    memory = {"idle": server_memory(pid)}
+    limit = asyncio.Semaphore(args.concurrency)
+    join_times = []
+
+    async def join(color=None, port=port, room=None):
+        async with limit:
+            start = time.perf_counter()
+            client = await open_client(port, color, room=room)
+            join_times.append(time.perf_counter() - start)
+            client.received = 0
+            return client
+
+    rng = random.Random(0)
+    colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(args.players)]
+    try:
+        players, spectators = await asyncio.wait_for(
+            asyncio.gather(
+                asyncio.gather(
+                    *[
+                        join(color, room=room_of(player, args.rooms))
+                        for player, color in enumerate(colors)
+                    ]
+                ),
+                asyncio.gather(
+                    *[
+                        join(port=spectator_ports[i % len(spectator_ports)], room=room_of(i, args.rooms))
+                        for i in range(args.spectators)
+                    ]
+                ),
+            ),
+            args.timeout,
+        )
+    except asyncio.TimeoutError:
+        return {"error": "joining stalled for over %is" % args.timeout}
+    memory["joined"] = server_memory(pid)
+
+    sent = Sent_Marks()
+    latencies = []
+    watchers = [asyncio.ensure_future(watch(client, sent, latencies)) for client in players + spectators]
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[play(client, color, args.rate, args.duration, sent, rng) for client, color in zip(players, colors)]
+    )
+    elapsed = time.perf_counter() - start
+    # everything sent reaches every spectator and every player in the room but the one who marked it
+    members = [room_of(i, args.rooms) for i in range(args.players)]
+    members += [room_of(i, args.rooms) for i in range(args.spectators)]
+    rooms = {color: room_of(player, args.rooms) for player, color in enumerate(colors)}
+    expected = sum(len(times) * (members.count(rooms[color]) - 1) for (color, _), times in sent.times.items())
+    deadline = time.perf_counter() + args.timeout
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    drained = time.perf_counter() - start
+    memory["end"] = server_memory(pid)
+    for watcher in watchers:
+        watcher.cancel()
+    for client in players + spectators:
+        client.writer.close()
+    return {
+        "players": args.players,
+        "spectators": args.spectators,
+        "rooms": args.rooms,
+        "relays": args.relays,
+        "chained": args.chain,
+        "join_seconds": percentiles(join_times),
+        "marks": sent.count,
+        "marks_per_second": sent.count / elapsed,
+        "deliveries": len(latencies),
+        "deliveries_per_second": len(latencies) / drained,
+        "undelivered": expected - len(latencies),
+        "latency_seconds": percentiles(latencies),
+        "server_memory": memory,
+    }
+
+
+def bench_load(args):
+    if args.rooms > 1 and args.relays:
+        # a relay follows a single room
+        return {engine: {"error": "relays and rooms can't be combined"} for engine in args.engines}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_catalog(directory, args.board_size * args.board_size)
+        for engine in args.engines:
+            port = free_port()
+            proc = start_server(directory, port, args.board_size, engine)
+            relays = []
+            try:
+                relays = start_relays(directory, port, args.relays, args.chain, engine)
+                # only the end of a chain has spectators, that's the furthest any mark has to go
+                spectator_ports = [relay_port for relay_port, _ in (relays[-1:] if args.chain else relays)]
+                results[engine] = asyncio.run(run_load(port, args, proc.pid, spectator_ports))
+            finally:
+                for _, relay in relays:
+                    relay.terminate()
+                    relay.wait()
+                proc.terminate()
+                proc.wait()
+    return results
+
+
+def bench_scale(args):
+    # The same load against a server spread over more and more worker processes, rooms are what they spread
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_catalog(directory, args.board_size * args.board_size)
+        for engine in args.engines:
+            results[engine] = {}
+            for workers in args.workers:
+                port = free_port()
+                proc = start_server(directory, port, args.board_size, engine, ["-w", str(workers)])
+                try:
+                    results[engine][workers] = asyncio.run(run_load(port, args, proc.pid))
+                finally:
+                    proc.terminate()
+                    proc.wait()
+    return results
+
+
+def server_module():
+    # explorer-server.py can't be imported with a plain import statement
+    return importlib.import_module("explorer-server")
+
+
+class Set_Board:
+    # The server's board as it used to be, a set of player IPs per square, for comparison
+    def __init__(self, board_size):
+        self.size = board_size
+        self.player_dict = {}
+        self.squares = [set() for i in range(board_size * board_size)]
+
+    def mark(self, idx, player_id):
+        if player_id in self.squares[idx]:
+            self.squares[idx].remove(player_id)
+        else:
+            self.squares[idx].add(player_id)
+
+    def marked_by(self, player_id):
+        return [i for i in range(len(self.squares)) if player_id in self.squares[i]]
+
+    def markers_of(self, idx):
+        return list(self.squares[idx])
+
+    def new_player(self, player_id, player_color):
+        marks = []
+        if player_id in self.player_dict and self.player_dict[player_id] != player_color:
+            old_color = pack_color(self.player_dict[player_id])
+            new_color = pack_color(player_color)
+            for i in range(len(self.squares)):
+                if player_id in self.squares[i]:
+                    marks += [(i, old_color), (i, new_color)]
+        self.player_dict[player_id] = player_color
+        return marks
+
+    def pack_player(self, player_id):
+        return pack_color(self.player_dict[player_id])
+
+
+def populate(game, num_players, seed=0):
+    num_squares = game.size * game.size
+    rng = random.Random(seed)
+    for player in range(num_players):
+        player_id = "10.0.%i.%i" % divmod(player, 256)
+        game.new_player(player_id, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        for idx in rng.sample(range(num_squares), num_squares // 4):
+            game.mark(idx, player_id)
+    return game
+
+
+def populated_game(board_size, num_players, seed=0):
+    return populate(server_module().Server_Game(board_size, list(range(board_size * board_size))), num_players, seed)
+
+
+def legacy_pack_board(game):
+    # How joins were serialized before the snapshot cache, for comparison
+    ret = b""
+    for i in range(game.size * game.size):
+        square = len(game.squares[i]).to_bytes(1, "little")
+        for player_id in game.squares[i]:
+            square += game.pack_player(player_id)
+        ret += square
+    return ret
+
+
+def seconds_per_call(func, min_time=0.2):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, max(1, int(number * min_time / 0.2)))) / number
+
+
+def bench_join(args):
+    results = []
+    for board_size in args.board_sizes:
+        for num_players in args.players:
+            game = populated_game(board_size, num_players)
+            legacy = populate(Set_Board(board_size), num_players)
+            player_id = next(iter(game.players))
+            game.welcome(PROTOCOL_VERSION)
+
+            def mark_then_join():
+                game.mark(0, player_id)
+                game.welcome(PROTOCOL_VERSION)
+
+            results.append(
+                {
+                    "board_size": board_size,
+                    "players": num_players,
+                    "welcome_bytes": len(game.welcome(PROTOCOL_VERSION)),
+                    "rebuild_seconds": seconds_per_call(lambda: legacy_pack_board(legacy)),
+                    "join_after_mark_seconds": seconds_per_call(mark_then_join),
+                    "join_seconds": seconds_per_call(lambda: game.welcome(PROTOCOL_VERSION)),
+                }
+            )
+    return results
+
+
+def print_join_results(results):
+    print("%6s %8s %10s %14s %16s %12s" % ("board", "players", "bytes", "rebuild", "mark + join", "join"))
+    for result in results:
+        print(
+            "%6s %8i %10i %12.1fus %14.1fus %10.2fus"
+            % (
+                "%ix%i" % (result["board_size"], result["board_size"]),
+                result["players"],
+                result["welcome_bytes"],
+                1e6 * result["rebuild_seconds"],
+                1e6 * result["join_after_mark_seconds"],
+                1e6 * result["join_seconds"],
+            )
+        )
+
+
+def allocated_bytes(build):
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        model = build()
+        return model, tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+
+
+def bench_board(args):
+    num_squares = args.board_size * args.board_size
+    # imported now so its own allocations don't get counted as the board's
+    server_module()
+    results = {}
+    for name, board_type in (("sets", Set_Board), ("bitsets", None)):
+        if board_type is None:
+            game, memory = allocated_bytes(lambda: populated_game(args.board_size, args.players))
+            # a running server has the snapshot from its first join, which every swap keeps up to date
+            game.welcome(PROTOCOL_VERSION)
+        else:
+            game, memory = allocated_bytes(lambda: populate(board_type(args.board_size), args.players))
+        player_ids = list(game.player_dict if board_type else game.players)
+        rng = random.Random(1)
+        colors = [(1, 2, 3), (4, 5, 6)]
+
+        def swap_color():
+            colors.reverse()
+            game.new_player(player_ids[0], colors[0])
+            if board_type is None:
+                # the real server also queues the swap for the next broadcast, don't let that pile up
+                game.pending.clear()
+
+        results[name] = {
+            "memory_bytes": memory,
+            "mark_seconds": seconds_per_call(lambda: game.mark(rng.randrange(num_squares), rng.choice(player_ids))),
+            "marked_by_seconds": seconds_per_call(lambda: game.marked_by(rng.choice(player_ids))),
+            "markers_of_seconds": seconds_per_call(lambda: game.markers_of(rng.randrange(num_squares))),
+            "color_swap_seconds": seconds_per_call(swap_color),
+        }
+    return results
+
+
+def print_board_results(results):
+    print("%-20s" % "" + "".join("%14s" % name for name in results))
+    for key in next(iter(results.values())):
+        if key == "memory_bytes":
+            print("%-20s" % "memory" + "".join("%12.1fKB" % (result[key] / 1024) for result in results.values()))
+        else:
+            print(
+                "%-20s" % key.replace("_seconds", "")
+                + "".join("%12.2fus" % (1e6 * result[key]) for result in results.values())
+            )
+
+
+def bench_lines(args):
+    # Finding a player's completed lines by rescanning every line after each mark vs the server's per-line counters,
+    # each timed alone on the same marks: a run of random toggles and then the same toggles undone, so the counters
+    # always end up back where they started
+    results = []
+    for board_size in args.board_sizes:
+        game = populated_game(board_size, args.players)
+        num_squares = board_size * board_size
+        players = list(game.players.values())
+        rng = random.Random(1)
+        toggles = [(rng.choice(players), rng.randrange(num_squares)) for _ in range(1000)]
+        owned = {player: player.marks for player in players}
+        steps = []
+        for player, idx in toggles + toggles[::-1]:
+            owned[player] ^= 1 << idx
+            steps.append((player, idx, bool(owned[player] >> idx & 1), owned[player]))
+        rescan_steps = itertools.cycle(steps)
+        incremental_steps = itertools.cycle(steps)
+
+        def rescan():
+            _, _, _, marks = next(rescan_steps)
+            game.completed_lines(marks)
+
+        def incremental():
+            player, idx, added, _ = next(incremental_steps)
+            game.update_lines(player, idx, added)
+            game.results.clear()
+
+        results.append(
+            {
+                "board_size": board_size,
+                "players": args.players,
+                "rescan_seconds": seconds_per_call(rescan),
+                "incremental_seconds": seconds_per_call(incremental),
+            }
+        )
+    return results
+
+
+def print_lines_results(results):
+    print("%6s %8s %16s %16s" % ("board", "players", "completed_lines", "update_lines"))
+    for result in results:
+        print(
+            "%6s %8i %14.2fus %14.2fus"
+            % (
+                "%ix%i" % (result["board_size"], result["board_size"]),
+                result["players"],
+                1e6 * result["rescan_seconds"],
+                1e6 * result["incremental_seconds"],
+            )
+        )
+
+
+def bench_render(args):
+    # Drawing whole boards from scratch, redrawing after one mark, and encoding the result
+    results = []
+    width, height = args.resolution
+    for board_size in args.board_sizes:
+        num_squares = board_size * board_size
+        goal_list = ["Goal number %i with a longer description than most" % i for i in range(num_squares)]
+        image = Board_Image(board_size, list(range(num_squares)), goal_list, width, height)
+        rng = random.Random(1)
+        colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(args.players)]
+        for idx in range(num_squares):
+            image.set_square(idx, rng.sample(colors, rng.randrange(len(colors) + 1)), rng.random() < 0.5)
+        image.render()
+
+        def full():
+            image.dirty.update(range(num_squares))
+            image.render()
+
+        def mark():
+            idx = rng.randrange(num_squares)
+            image.set_square(idx, rng.sample(colors, rng.randrange(len(colors) + 1)), rng.random() < 0.5)
+            image.render()
+
+        results.append(
+            {
+                "board_size": board_size,
+                "full_seconds": seconds_per_call(full),
+                "mark_seconds": seconds_per_call(mark),
+                "png_seconds": seconds_per_call(image.png),
+                "ppm_seconds": seconds_per_call(image.ppm),
+                "png_bytes": len(image.png()),
+            }
+        )
+    return results
+
+
+def print_render_results(results):
+    print("%6s %12s %12s %12s %12s %10s" % ("board", "full", "one mark", "png", "ppm", "png size"))
+    for result in results:
+        print(
+            "%6s %10.2fms %10.1fus %10.2fms %10.2fms %8.1fKB"
+            % (
+                "%ix%i" % (result["board_size"], result["board_size"]),
+                1000 * result["full_seconds"],
+                1e6 * result["mark_seconds"],
+                1000 * result["png_seconds"],
+                1000 * result["ppm_seconds"],
+                result["png_bytes"] / 1024,
+            )
+        )
+
+
+def print_server_results(results):
+    for engine, result in results.items():
+        print(f"[{engine}]")
+        if "error" in result:
+            print("  " + result["error"])
+            continue
+        print(
+            "  accepted %i connections in %.3fs (%.0f/s)"
+            % (result["connections"], result["accept_seconds"], result["accepts_per_second"])
+        )
+        for name in ("join_seconds", "broadcast_seconds"):
+            stats = result[name]
+            print("  %-18s" % name + "  ".join("%s=%.2fms" % (key, 1000 * value) for key, value in stats.items()))
+
+
+def print_load_results(results):
+    for engine, result in results.items():
+        print(f"[{engine}]")
+        if "error" in result:
+            print("  " + result["error"])
+            continue
+        if result["relays"]:
+            print("  spectators watching through %i relays%s" % (result["relays"], " in a chain" * result["chained"]))
+        if result["rooms"] > 1:
+            print("  spread over %i rooms" % result["rooms"])
+        print(
+            "  %i players and %i spectators, %i marks (%.0f/s) delivered %i times (%.0f/s), %i undelivered"
+            % (
+                result["players"],
+                result["spectators"],
+                result["marks"],
+                result["marks_per_second"],
+                result["deliveries"],
+                result["deliveries_per_second"],
+                result["undelivered"],
+            )
+        )
+        for name in ("join_seconds", "latency_seconds"):
+            stats = result[name]
+            print("  %-18s" % name + "  ".join("%s=%.2fms" % (key, 1000 * value) for key, value in stats.items()))
+        for stage, memory in result["server_memory"].items():
+            if memory is not None:
+                print(
+                    "  server rss %-9s %.1fMB (peak %.1fMB)"
+                    % (stage, memory["rss_bytes"] / 2**20, memory["peak_rss_bytes"] / 2**20)
+                )
+
+
+def print_scale_results(results):
+    for engine, by_workers in results.items():
+        print(f"[{engine}]")
+        for workers, result in by_workers.items():
+            name = "%i worker%s" % (int(workers), "s" * (int(workers) > 1)) if int(workers) else "one process"
+            if "error" in result:
+                print("  %-12s%s" % (name, result["error"]))
+                continue
+            latency = result["latency_seconds"]
+            print(
+                "  %-12s%.0f marks/s delivered %.0f/s, %i undelivered, latency p50=%.2fms p99=%.2fms"
+                % (
+                    name,
+                    result["marks_per_second"],
+                    result["deliveries_per_second"],
+                    result["undelivered"],
+                    1000 * latency.get("p50", 0),
+                    1000 * latency.get("p99", 0),
+                )
+            )
+
+
+def parse():
+    parser = argparse.ArgumentParser(description="Benchmark a local bingo server.")
+    parser.add_argument("-j", "--json", action="store_true", help="print results as JSON")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    subparser = subparsers.add_parser("server", help="connect spectators to real servers and broadcast marks to them")
+    subparser.set_defaults(func=bench_server, printer=print_server_results)
+    subparser.add_argument("-n", "--connections", type=int, default=1000, help="spectators to connect")
+    subparser.add_argument(
+        "-m", "--marks", type=int, default=50, help="rounds of marks to broadcast to every spectator"
+    )
+    subparser.add_argument("-p", "--protocol", type=int, choices=(1, 2), default=PROTOCOL_VERSION)
+    subparser.add_argument("-B", "--burst", type=int, default=1, help="marks the player sends at once")
+    subparser.add_argument("-b", "--board-size", type=int, default=5, help="board dimension to serve")
+    subparser.add_argument("-s", "--stalled", type=int, default=0, help="connections that never finish handshaking")
+    subparser.add_argument("-t", "--timeout", type=int, default=30, help="seconds to wait for all handshakes")
+    subparser.add_argument("-c", "--concurrency", type=int, default=100, help="handshakes in flight at once")
+    subparser.add_argument(
+        "-e", "--engines", nargs="+", choices=("selectors", "asyncio"), default=["selectors", "asyncio"]
+    )
+
+    subparser = subparsers.add_parser("load", help="simulate players marking and spectators watching a real server")
+    subparser.set_defaults(func=bench_load, printer=print_load_results)
+    subparser.add_argument("-n", "--players", type=int, default=10, help="players marking squares")
+    subparser.add_argument("-m", "--spectators", type=int, default=100, help="spectators watching")
+    subparser.add_argument("-r", "--rate", type=float, default=5, help="marks per second each player makes")
+    subparser.add_argument("-d", "--duration", type=float, default=5, help="seconds the players keep marking")
+    subparser.add_argument("-b", "--board-size", type=int, default=16, help="board dimension to serve")
+    subparser.add_argument("-t", "--timeout", type=int, default=30, help="seconds to wait for joins and deliveries")
+    subparser.add_argument("-c", "--concurrency", type=int, default=100, help="handshakes in flight at once")
+    subparser.add_argument("-R", "--relays", type=int, default=0, help="relays to spread the spectators over")
+    subparser.add_argument("-k", "--rooms", type=int, default=1, help="rooms to spread players and spectators over")
+    subparser.add_argument(
+        "--chain", action="store_true", help="chain the relays one after another, spectators watch the last one"
+    )
+    subparser.add_argument(
+        "-e", "--engines", nargs="+", choices=("selectors", "asyncio"), default=["selectors", "asyncio"]
+    )
+
+    subparser = subparsers.add_parser("scale", help="run the load benchmark against more and more server workers")
+    subparser.set_defaults(func=bench_scale, printer=print_scale_results, relays=0, chain=False)
+    subparser.add_argument("-w", "--workers", nargs="+", type=int, default=[0, 1, 2, 4], help="worker counts to try")
+    subparser.add_argument("-n", "--players", type=int, default=64, help="players marking squares")
+    subparser.add_argument("-m", "--spectators", type=int, default=512, help="spectators watching")
+    subparser.add_argument("-k", "--rooms", type=int, default=16, help="rooms to spread players and spectators over")
+    subparser.add_argument("-r", "--rate", type=float, default=20, help="marks per second each player makes")
+    subparser.add_argument("-d", "--duration", type=float, default=5, help="seconds the players keep marking")
+    subparser.add_argument("-b", "--board-size", type=int, default=16, help="board dimension to serve")
+    subparser.add_argument("-t", "--timeout", type=int, default=30, help="seconds to wait for joins and deliveries")
+    subparser.add_argument("-c", "--concurrency", type=int, default=100, help="handshakes in flight at once")
+    subparser.add_argument(
+        "-e", "--engines", nargs="+", choices=("selectors", "asyncio"), default=["selectors", "asyncio"]
+    )
+
+    subparser = subparsers.add_parser("join", help="time serializing the board for a joining client")
+    subparser.set_defaults(func=bench_join, printer=print_join_results)
+    subparser.add_argument("-b", "--board-sizes", nargs="+", type=int, default=[5, 16, 32, 64])
+    subparser.add_argument("-p", "--players", nargs="+", type=int, default=[1, 10, 100])
+
+    subparser = subparsers.add_parser("board", help="compare the server's board model against a set per square")
+    subparser.set_defaults(func=bench_board, printer=print_board_results)
+    subparser.add_argument("-b", "--board-size", type=int, default=64)
+    subparser.add_argument("-p", "--players", type=int, default=100)
+
+    subparser = subparsers.add_parser("lines", help="time bingo line detection after each mark")
+    subparser.set_defaults(func=bench_lines, printer=print_lines_results)
+    subparser.add_argument("-b", "--board-sizes", nargs="+", type=int, default=[5, 16, 32, 64])
+    subparser.add_argument("-p", "--players", type=int, default=10)
+
+    subparser = subparsers.add_parser("render", help="time drawing board images without Tk")
+    subparser.set_defaults(func=bench_render, printer=print_render_results)
+    subparser.add_argument("-b", "--board-sizes", nargs="+", type=int, default=[5, 16, 32])
+    subparser.add_argument("-r", "--resolution", nargs=2, type=int, default=[1600, 1000], help="image width and height")
+    subparser.add_argument("-p", "--players", type=int, default=4, help="colors to stripe the squares with")
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    if args.bench in ("server", "load", "scale"):
+        connections = args.connections if args.bench == "server" else args.players + args.spectators
+        try:
+            import resource
+
+            # every connection costs a descriptor here and one in the server
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 2 * connections + 256)), hard))
+        except (ImportError, ValueError):
+            pass
+    results = args.func(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        args.printer(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,505 @@
 import argparse
-import json
+import queue
 import random
 import selectors
 import socket
-import struct
-from squares import Game_Controller
+import threading
+import tracemalloc
+from collections import deque
+from time import perf_counter
+from tkinter import TclError
+from protocol import (
+    BOARD,
+    FIELD_GAME_ID,
+    FIELD_GOALS,
+    FIELD_LAST_SEQ,
+    FIELD_ROOM,
+    FIELD_SEED,
+    FIELD_SESSION,
+    FIELD_SIZE,
+    LINE,
+    MARK,
+    MARKS,
+    READ_SIZE,
+    SEQ,
+    SERVER_HELLO,
+    SESSION,
+    SQUARES,
+    WIN,
+    Frame_Reader,
+    Protocol_Error,
+    catalog_matches,
+    connect,
+    decode_board,
+    decode_fields,
+    decode_line,
+    decode_marks,
+    decode_squares,
+    decode_varint,
+    decode_varints,
+    decode_win,
+    encode_fields,
+    encode_varint,
+    encode_varints,
+    frame,
+    recv_frame,
+)
+from catalog import load_catalog
+from squares import Game_Controller, summarize
 
-SEL = selectors.DefaultSelector()
+REPORT_INTERVAL = 5000
+RECONNECT_DELAY = 100
+MAX_RECONNECT_DELAY = 10000
 
 
-def recv_single_as_int(sock: socket.socket):
-    byte = sock.recv(1)
-    if byte == b"":
-        SEL.unregister(sock)
-        sock.close()
-        return None
-    return int.from_bytes(byte, "little")
+class Profile:
+    # --profile: how long every phase of starting up takes, then what handling the game costs from stage to stage:
+    # waiting for Tk to get to what the network thread received, handling each frame, and within that updating the
+    # model and the view (creating and configuring canvas items), then Tk drawing the squares that changed. With
+    # trace_memory it also tracks what every phase allocated and where the most memory went.
+    STAGES = (
+        ("wait", "network to Tk"),
+        ("handle", "handling frames"),
+        ("mark", "marking squares"),
+        ("model", "model"),
+        ("view", "view"),
+        ("draw", "Tk drawing"),
+    )
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+        self.started = self.lap_started = perf_counter()
+        self.lap_allocated = self.allocated()
+        self.phases = []  # (name, seconds, bytes allocated or None)
+        self.times = {}  # stage -> [seconds]
+        self.received = 0  # payload bytes
+
+    def allocated(self):
+        return tracemalloc.get_traced_memory()[0] if self.trace_memory else None
+
+    def lap(self, name):
+        # Ends the phase that started when the last one ended
+        now = perf_counter()
+        allocated = current = self.allocated()
+        if allocated is not None:
+            allocated -= self.lap_allocated
+        self.phases.append((name, now - self.lap_started, allocated))
+        self.lap_started = now
+        self.lap_allocated = current
+
+    def add(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def time(self, obj, name, stage):
+        # Swaps obj's method for one that adds how long every call takes to stage
+        method = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(stage, perf_counter() - start)
+
+        setattr(obj, name, timed)
+
+    def report(self):
+        print("Startup:")
+        for name, seconds, allocated in self.phases:
+            memory = "" if allocated is None else ", %.1fKB allocated" % (allocated / 1024)
+            print("  %-10s %8.2fms%s" % (name, 1000 * seconds, memory))
+        print("  %-10s %8.2fms" % ("total", 1000 * (self.lap_started - self.started)))
+        marks = len(self.times.get("mark", ()))
+        if marks:
+            print("%i marks, %.1fKB received:" % (marks, self.received / 1024))
+            for stage, name in self.STAGES:
+                if times := self.times.get(stage):
+                    total = sum(times)
+                    stats = format_stats("%i times" % len(times), summarize(times))
+                    print(
+                        "  %-16s %8.2fms total, %7.1fus a mark, %s" % (name, 1000 * total, 1e6 * total / marks, stats)
+                    )
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            print("Memory: %.1fKB now, %.1fKB at the most, mostly from" % (current / 1024, peak / 1024))
+            ignore = (
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            )
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+            for stat in snapshot.statistics("lineno")[:10]:
+                print("  %s" % stat)
+
+
+class Network_Thread(threading.Thread):
+    # Owns the socket once the handshake is done: every complete frame that arrives goes into inbox as a
+    # (time received, [(type, payload), ...]) batch, or (time, None) once the connection is gone, and wake is
+    # called so the Tk thread can come and get them. send_marks can be called from any thread. Without a socket
+    # it calls dial to connect first, which blocks, and then the first batch starts with the SERVER_HELLO.
+    def __init__(self, sock, frames, wake, dial=None):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.frames = frames
+        self.wake = wake
+        self.dial = dial
+        self.inbox = queue.SimpleQueue()
+        self.outb = bytearray()
+        self.queued = deque()  # (frame length, square indices) of every MARK frame in outb, oldest first
+        self.sent = 0  # bytes of the oldest one the socket has taken
+        self.lock = threading.Lock()
+        self.closing = False
+        # select can't wait on a queue, so this socket pair interrupts it when there's something new to send
+        self.interrupt, self.interrupted = socket.socketpair()
+
+    def send_marks(self, indices):
+        data = frame(MARK, encode_varints(indices))
+        with self.lock:
+            self.outb += data
+            self.queued.append((len(data), indices))
+        self.poke()
+
+    def close(self):
+        self.closing = True
+        self.poke()
+
+    def poke(self):
+        try:
+            self.interrupt.send(b"\0")
+        except OSError:
+            # already stopped, whatever we just queued is left in outb
+            pass
+
+    def unsent(self):
+        # Squares marked in every frame the socket hadn't taken all of, the server drops a frame it only got part of
+        with self.lock:
+            return [idx for _, indices in self.queued for idx in indices]
+
+    def run(self):
+        if self.sock is None:
+            if (hello := self.dial()) is None:
+                if not self.closing:
+                    self.inbox.put((perf_counter(), None))
+                    self.wake()
+                return
+            self.sock, self.frames, fields = hello
+            self.inbox.put((perf_counter(), [(SERVER_HELLO, encode_fields(fields)), *self.frames]))
+            self.wake()
+        sel = selectors.DefaultSelector()
+        self.sock.setblocking(False)
+        self.interrupted.setblocking(False)
+        sel.register(self.sock, selectors.EVENT_READ)
+        sel.register(self.interrupted, selectors.EVENT_READ)
+        try:
+            while not self.closing:
+                with self.lock:
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outb else 0)
+                sel.modify(self.sock, events)
+                for key, mask in sel.select():
+                    if key.fileobj is self.interrupted:
+                        self.interrupted.recv(READ_SIZE)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        data = self.sock.recv(READ_SIZE)
+                        if data == b"":
+                            raise ConnectionResetError
+                        received = perf_counter()
+                        self.frames.feed(data)
+                        if msgs := list(self.frames):
+                            self.inbox.put((received, msgs))
+                            self.wake()
+                    if mask & selectors.EVENT_WRITE:
+                        with self.lock:
+                            sent = self.sock.send(self.outb)
+                            del self.outb[:sent]
+                            self.sent += sent
+                            while self.queued and self.queued[0][0] <= self.sent:
+                                self.sent -= self.queued.popleft()[0]
+        except (OSError, Protocol_Error):
+            pass
+        finally:
+            sel.close()
+            self.sock.close()
+            self.interrupted.close()
+        if not self.closing:
+            self.inbox.put((perf_counter(), None))
+            self.wake()
 
 
 class Socket_Game(Game_Controller):
     def __init__(
-        self, board_size, color, goal_indices, goal_list, board_width, board_height, spectate=False, verbose=False
+        self,
+        board_size,
+        color,
+        goal_indices,
+        goal_list,
+        board_width,
+        board_height,
+        spectate=False,
+        verbose=False,
+        frames=None,
+        server_addr=None,
+        game_id=None,
+        frame_times=False,
+        latency=False,
+        room=None,
+        profile=None,
     ):
         super().__init__(board_size, color, goal_indices, goal_list, board_width, board_height, spectate)
-        self.outb = b""
-        self.delay = 100  # TODO hardcode this? put this elsewhere?
+        self.unsent = []  # squares marked while we're disconnected, sent (and drawn again) once we're back
+        self.frames = frames if frames is not None else Frame_Reader()
+        self.network = None
+        self.wake_pending = False
+        self.root.bind("<<Network>>", self.network_ready)
         self.verbose = verbose
+        self.spectate = spectate
+        # Where we are in the server's mark sequence, so a reconnect only has to catch up on what we missed
+        self.server_addr = server_addr
+        self.room = room
+        self.game_id = game_id
+        self.last_seq = None
+        self.session = None  # the server's token for us, which makes us the same player again when we reconnect
+        self.reconnect_delay = RECONNECT_DELAY
+        self.rejoining = False  # from reconnecting until the server has caught us up
+        self.rejoin_board = False  # whether that was with the whole board, which wipes what we marked meanwhile
+        # The server repeats the standings on every (re)join, so only announce what's new
+        self.completed = set()
+        self.places = {}
         if spectate:
             self.root.unbind("<Button-1>")
+            print("Press Tab (or the arrow keys) to see the board the way each player does, Esc to see it all again")
+        # Timing, when asked for: how long messages wait between arriving and being handled, and how long until the
+        # server acknowledges our marks (with the SEQ every client gets after each round of marks it broadcasts)
+        self.latency = latency
+        self.delivery_times = []
+        self.unacked_marks = deque()
+        self.mark_times = []
+        if frame_times:
+            self.view.measure_frames()
+        if frame_times or latency:
+            self.root.after(REPORT_INTERVAL, self.report)
+        self.profile = profile
+        if profile is not None:
+            self.start_profile()
 
-    def run(self):
-        self.check_for_updates()
+    def start_profile(self):
+        profile = self.profile
+        profile.time(self, "handle_frame", "handle")
+        profile.time(self, "mark", "mark")
+        for name in ("mark", "explore_surrounding", "unexplore_surrounding"):
+            profile.time(self.model, name, "model")
+        if self.fog is not None:
+            profile.time(self.fog, "mark", "model")
+        for name in ("redraw_rectangle", "make_visible", "make_invisible"):
+            profile.time(self.view, name, "view")
+        flush = self.view.flush
+
+        def flush_and_draw():
+            flush()
+            # include Tk actually drawing it
+            self.canvas.update_idletasks()
+
+        self.view.flush = flush_and_draw
+        profile.time(self.view, "flush", "draw")
+        # the window is up once it's first mapped
+        self.root.bind("<Map>", self.window_shown, add="+")
+
+    def window_shown(self, event=None):
+        if self.profile is not None and not any(name == "window" for name, _, _ in self.profile.phases):
+            self.profile.lap("window")
+
+    def run(self, sock=None):
+        if sock is not None:
+            # the network thread can only wake Tk up once it's running
+            self.root.after_idle(self.start_network, sock)
         super().run()
 
+    def start_network(self, sock):
+        self.network = Network_Thread(sock, self.frames, self.wake)
+        self.network.start()
+        if self.unsent:
+            self.network.send_marks(self.unsent)
+            self.unsent = []
+
+    def wake(self):
+        # Called from the network thread, makes Tk call network_ready as soon as it can
+        if not self.wake_pending:
+            self.wake_pending = True
+            try:
+                self.root.event_generate("<<Network>>", when="tail")
+            except (RuntimeError, TclError):
+                # the window is gone
+                pass
+
+    def network_ready(self, event=None):
+        self.wake_pending = False
+        network = self.network
+        while network is not None:
+            try:
+                received, msgs = network.inbox.get_nowait()
+            except queue.Empty:
+                return
+            if msgs is None:
+                self.lost_connection(network)
+                return
+            if self.profile is not None:
+                self.profile.add("wait", perf_counter() - received)
+                self.profile.received += sum(len(payload) for _, payload in msgs)
+            for msg_type, payload in msgs:
+                if self.network is not network:
+                    # the server we reconnected to turned out to be running another board
+                    return
+                self.handle_frame(msg_type, payload)
+            if self.latency:
+                self.delivery_times.append(perf_counter() - received)
+
+    def lost_connection(self, network):
+        self.network = None
+        network.interrupt.close()
+        self.unsent = network.unsent() + self.unsent
+        if self.server_addr is not None:
+            if not self.rejoining:
+                print("Lost connection to the server, reconnecting")
+            self.root.after(self.reconnect_delay, self.reconnect)
+
+    def report(self):
+        if (stats := self.view.frame_stats()) is not None:
+            print(format_stats("%i frames, %i squares" % (stats["count"], stats["squares"]), stats))
+        if self.delivery_times:
+            print(format_stats("%i deliveries" % len(self.delivery_times), summarize(self.delivery_times)))
+            self.delivery_times = []
+        if self.mark_times:
+            print(format_stats("%i marks acknowledged" % len(self.mark_times), summarize(self.mark_times)))
+            self.mark_times = []
+        self.root.after(REPORT_INTERVAL, self.report)
+
     def mark_init_squares(self, sock):
         # assumes blocking
-        for square_idx in range(self.size * self.size):
-            num_markers = recv_single_as_int(sock)
-            if num_markers is None:
-                return False
-            for player_idx in range(num_markers):
-                rgb = []
-                for color_idx in range(3):
-                    color = recv_single_as_int(sock)
-                    if color is None:
-                        return False
-                    rgb.append(color)
-                self.mark(square_idx, tuple(rgb))
+        msg = recv_frame(sock, self.frames)
+        if msg is None or msg[0] != BOARD:
+            return False
+        self.apply_board(msg[1])
         return True
 
-    def read_square(self, sock):
-        # assumes non-blocking
-        marked_square = b""
-        while len(marked_square) < 4:
-            marked_square += sock.recv(4)
-            if marked_square == b"":
-                return False
-        idx = marked_square[0]
-        (R, G, B) = struct.unpack_from("!3B", marked_square, 1)
-        self.mark(idx, (R, G, B))
-        if self.verbose:
-            print("%i %i %i has marked %s" % (R, G, B, self.goal_list[self.goal_indices[idx]]))
-        return True
+    def apply_board(self, payload):
+        # A full snapshot, which after a reconnect has to replace whatever we were showing
+        self.apply_squares(decode_board(payload, self.size * self.size))
+
+    def apply_squares(self, squares):
+        for square_idx, colors in squares:
+            for color in self.model.colors[square_idx].symmetric_difference(colors):
+                self.mark(square_idx, color)
+
+    def handle_frame(self, msg_type, payload):
+        if msg_type == MARKS:
+            for idx, (R, G, B) in decode_marks(payload):
+                self.mark(idx, (R, G, B))
+                if self.verbose:
+                    print("%i %i %i has marked %s" % (R, G, B, self.goal_list[self.goal_indices[idx]]))
+        elif msg_type == SEQ:
+            self.last_seq = decode_varint(payload)[0]
+            if self.rejoining:
+                # caught up, so now what we marked while we were gone can go
+                self.rejoining = False
+                self.resend_unsent(self.rejoin_board)
+            if self.unacked_marks:
+                now = perf_counter()
+                self.mark_times.extend(now - sent for sent in self.unacked_marks)
+                self.unacked_marks.clear()
+        elif msg_type == BOARD:
+            self.apply_board(payload)
+            self.rejoin_board = self.rejoining
+        elif msg_type == SERVER_HELLO:
+            self.rejoined(decode_fields(payload))
+        elif msg_type == SQUARES:
+            # we fell behind, these are the squares that changed meanwhile
+            self.apply_squares(decode_squares(payload))
+        elif msg_type == SESSION:
+            self.session = payload
+        elif msg_type == LINE:
+            color, line, completed = decode_line(payload)
+            if completed and (color, line) not in self.completed:
+                self.completed.add((color, line))
+                print("%i %i %i completed %s" % (*color, self.line_name(line)))
+            elif not completed and (color, line) in self.completed:
+                self.completed.discard((color, line))
+                print("%i %i %i broke %s" % (*color, self.line_name(line)))
+        elif msg_type == WIN:
+            color, place = decode_win(payload)
+            if self.places.get(place) != color:
+                self.places[place] = color
+                print("%i %i %i got bingo (#%i)" % (*color, place))
+                if place == 1:
+                    self.root.title("Bingo! %i %i %i wins" % color)
+
+    def drain_frames(self):
+        for msg_type, payload in self.frames:
+            self.handle_frame(msg_type, payload)
+
+    def reconnect(self):
+        resume = {FIELD_SESSION: self.session} if self.session is not None else {}
+        if self.last_seq is not None and self.game_id is not None and not self.unsent:
+            # Marks we never got to send would be lost with just the missed ones, so then take the whole board again
+            resume.update({FIELD_LAST_SEQ: encode_varint(self.last_seq), FIELD_GAME_ID: self.game_id})
+        # connecting blocks, so it's done on a network thread of its own that hands back the hello, or loses the
+        # connection and gets us back here a while later
+        self.rejoining = True
+        self.rejoin_board = False
+        self.network = Network_Thread(
+            None,
+            None,
+            self.wake,
+            lambda: connect(self.server_addr, self.color, self.spectate, resume, self.room),
+        )
+        self.reconnect_delay = min(2 * self.reconnect_delay, MAX_RECONNECT_DELAY)
+        self.network.start()
 
-    def write_square(self, sock):
-        if self.outb:
-            sent = sock.send(self.outb)
-            self.outb = self.outb[sent:]
-
-    def check_for_updates(self):
-        events = SEL.select(timeout=1)
-        if events:
-            for (key, mask) in events:
-                sock = key.fileobj
-                if mask & selectors.EVENT_READ:
-                    if not self.read_square(sock):
-                        SEL.unregister(sock)
-                        sock.close()
-                        return
-                if mask & selectors.EVENT_WRITE:
-                    self.write_square(sock)
-        self.root.after(self.delay, self.check_for_updates)
+    def rejoined(self, fields):
+        same_goals = decode_varints(fields[FIELD_GOALS]) == list(self.goal_indices)
+        if not same_goals or not catalog_matches(fields, self.goal_list):
+            print("The server is running a different board now, restart to join it")
+            self.network.close()
+            self.network = None
+            return
+        print("Reconnected")
+        self.unacked_marks.clear()
+        self.game_id = fields.get(FIELD_GAME_ID)
+        self.reconnect_delay = RECONNECT_DELAY
+
+    def resend_unsent(self, redraw):
+        # A whole board doesn't have what we marked while we were gone, so then mark it again (where we still can)
+        unsent = self.unsent
+        self.unsent = []
+        for idx in unsent:
+            if not redraw:
+                self.unsent.append(idx)
+            elif self.model.is_visible(idx):
+                self.mark(idx, self.color)
+                self.unsent.append(idx)
+        if self.unsent:
+            self.network.send_marks(self.unsent)
+            self.unsent = []
 
     def mouse_pressed(self, event):
         idx = super().mouse_pressed(event)
         if idx is not None:
-            self.outb += idx.to_bytes(1, "little")
+            if self.network is None or self.rejoining:
+                self.unsent.append(idx)
+                return
+            if self.latency:
+                self.unacked_marks.append(perf_counter())
+            self.network.send_marks([idx])
+
+
+def format_stats(name, stats):
+    return "%s: mean %.2fms p50 %.2fms p95 %.2fms max %.2fms" % (
+        name,
+        1000 * stats["mean"],
+        1000 * stats["p50"],
+        1000 * stats["p95"],
+        1000 * stats["max"],
+    )
 
 
 def parse():
@@ -100,11 +514,42 @@ def parse():
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="set this flag to receive a message every time a goal is marked"
     )
+    parser.add_argument("--room", help="room to join on a server hosting several games, opened if nobody has yet")
+    parser.add_argument("--board-size", type=int, help="dimension of the board, if this opens a room")
+    parser.add_argument("--seed", type=int, help="random seed for the board, if this opens a room")
+    parser.add_argument(
+        "--frame-times",
+        action="store_true",
+        help="print how long redrawing the board takes every %i seconds" % (REPORT_INTERVAL // 1000),
+    )
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="print how long server messages wait to be handled and how long the server takes to acknowledge marks",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time every phase of starting up and every stage of handling marks, and print it all on exit",
+    )
+    parser.add_argument(
+        "--profile-memory", action="store_true", help="with --profile, also trace what allocates memory (slower)"
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse()
+    profile = Profile(args.profile_memory) if args.profile else None
+    try:
+        play(args, profile)
+    finally:
+        if profile is not None:
+            profile.report()
+
+
+def play(args, profile):
+    lap = profile.lap if profile is not None else lambda name: None
     server_addr = (args.host, args.port)
     if args.resolution is not None:
         width, height = args.resolution
@@ -117,37 +562,51 @@ def main():
         R = random.randint(0, 255)
         G = random.randint(0, 255)
         B = random.randint(0, 255)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    room = {}
+    if args.room is not None:
+        room[FIELD_ROOM] = args.room.encode()
+    if args.board_size is not None:
+        room[FIELD_SIZE] = encode_varint(args.board_size)
+    if args.seed is not None:
+        room[FIELD_SEED] = encode_varint(args.seed)
     # Block until initial data is sent and received
-    sock.connect(server_addr)
-    # First tell the server if we're a player
-    if args.spectate:
-        sock.sendall((1).to_bytes(1, "little"))
-    else:
-        # We're a player, send our color so the server can deal with reconnection
-        sock.sendall((0).to_bytes(1, "little"))
-        sock.sendall(struct.pack("!3B", R, G, B))
-    board_size = recv_single_as_int(sock)
-    if board_size is None:
+    if (hello := connect(server_addr, (R, G, B), args.spectate, room=room)) is None:
+        print("Could not connect to the server")
         return
-    goal_indices = b""
-    while len(goal_indices) < board_size * board_size:
-        goal_indices += sock.recv(board_size * board_size - len(goal_indices))
-    with open("./bingo.json") as f:
-        # TODO strip comments
-        goals = json.load(f)
-        goal_list = sorted(
-            [goals[key]["Desc"] for key in goals if isinstance(goals[key], dict) and goals[key].get("Desc")]
-        )
-    game = Socket_Game(board_size, (R, G, B), goal_indices, goal_list, width, height, args.spectate, args.verbose)
+    sock, frames, fields = hello
+    lap("handshake")
+    board_size = decode_varint(fields[FIELD_SIZE])[0]
+    goal_indices = decode_varints(fields[FIELD_GOALS])
+    goal_list = load_catalog()
+    lap("catalog")
+    if not catalog_matches(fields, goal_list) or max(goal_indices) >= len(goal_list):
+        print("Your bingo.json has different goals than the server's, get the same generator as the host and try again")
+        sock.close()
+        return
+    game = Socket_Game(
+        board_size,
+        (R, G, B),
+        goal_indices,
+        goal_list,
+        width,
+        height,
+        args.spectate,
+        args.verbose,
+        frames,
+        server_addr,
+        fields.get(FIELD_GAME_ID),
+        args.frame_times,
+        args.latency,
+        room,
+        profile,
+    )
+    lap("view")
     if not game.mark_init_squares(sock):
-        SEL.unregister(sock)
         sock.close()
         return
-    sock.setblocking(False)
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    SEL.register(sock, events)
-    game.run()
+    game.drain_frames()
+    lap("board")
+    game.run(sock)
 
 
 if __name__ == "__main__":
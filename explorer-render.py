@@ -0,0 +1,154 @@
+import argparse
+import socket
+import time
+from protocol import (
+    BOARD,
+    FIELD_GOALS,
+    FIELD_ROOM,
+    FIELD_SIZE,
+    MARKS,
+    SQUARES,
+    Protocol_Error,
+    catalog_matches,
+    connect,
+    decode_board,
+    decode_marks,
+    decode_squares,
+    decode_varint,
+    decode_varints,
+)
+from catalog import load_catalog
+from render import Board_Image
+from game import Fog, iter_bits
+
+READ_SIZE = 65536
+RECONNECT_DELAY = 1
+
+
+class Board_Export:
+    # The board as a spectator sees it, or through the fog of the player being watched, kept up to date in a Board_Image
+    def __init__(self, board_size, goal_indices, goal_list, width, height, watching=None):
+        self.size = board_size
+        self.goal_indices = goal_indices
+        self.image = Board_Image(board_size, goal_indices, goal_list, width, height)
+        self.colors = [set() for _ in range(board_size * board_size)]
+        self.watching = watching
+        self.fog = Fog(board_size) if watching is not None else None
+        self.has_board = False
+        for idx in range(board_size * board_size):
+            self.image.set_square(idx, (), self.visible(idx))
+
+    def visible(self, idx):
+        return self.fog is None or self.fog.sight_of(self.watching) >> idx & 1
+
+    def redraw(self, idx):
+        self.image.set_square(idx, sorted(self.colors[idx]), self.visible(idx))
+
+    def toggle(self, idx, color):
+        self.colors[idx] ^= {color}
+        self.redraw(idx)
+        if color == self.watching:
+            for changed in iter_bits(self.fog.mark(idx, color)):
+                self.redraw(changed)
+
+    def apply_squares(self, squares):
+        for idx, colors in squares:
+            for color in self.colors[idx].symmetric_difference(colors):
+                self.toggle(idx, color)
+
+    def handle_frame(self, msg_type, payload):
+        if msg_type == MARKS:
+            for idx, color in decode_marks(payload):
+                self.toggle(idx, color)
+        elif msg_type == BOARD:
+            self.apply_squares(decode_board(payload, self.size * self.size))
+            self.has_board = True
+        elif msg_type == SQUARES:
+            self.apply_squares(decode_squares(payload))
+
+
+def follow(args, server_addr, room, goal_list):
+    # Spectates for as long as the server keeps the same board, reconnecting whenever the connection drops, and saves
+    # the image whenever it changed but no more than once every interval seconds
+    export = None
+    last_save = 0
+    while True:
+        if (hello := connect(server_addr, None, True, room=room)) is None:
+            print("Could not connect to the server, retrying")
+            time.sleep(RECONNECT_DELAY)
+            continue
+        sock, frames, fields = hello
+        board_size = decode_varint(fields[FIELD_SIZE])[0]
+        goal_indices = decode_varints(fields[FIELD_GOALS])
+        if not catalog_matches(fields, goal_list) or max(goal_indices) >= len(goal_list):
+            print("Your bingo.json has different goals than the server's, get the same generator as the host")
+            sock.close()
+            return
+        if export is not None and (board_size, goal_indices) != (export.size, export.goal_indices):
+            print("The server is running a different board now")
+            export = None
+        if export is None:
+            width, height = args.resolution
+            export = Board_Export(board_size, goal_indices, goal_list, width, height, args.watch)
+        export.has_board = False
+        try:
+            for msg_type, payload in frames:
+                export.handle_frame(msg_type, payload)
+            while True:
+                wait = None
+                if export.has_board and export.image.dirty:
+                    wait = last_save + args.interval - time.monotonic()
+                    if wait <= 0:
+                        export.image.save(args.output)
+                        last_save = time.monotonic()
+                        if args.once:
+                            return
+                        continue
+                sock.settimeout(wait)
+                try:
+                    data = sock.recv(READ_SIZE)
+                except socket.timeout:
+                    continue
+                if data == b"":
+                    break
+                frames.feed(data)
+                for msg_type, payload in frames:
+                    export.handle_frame(msg_type, payload)
+        except (OSError, Protocol_Error):
+            pass
+        finally:
+            sock.close()
+        print("Lost connection to the server, reconnecting")
+        time.sleep(RECONNECT_DELAY)
+
+
+def parse():
+    parser = argparse.ArgumentParser(description="Spectate a bingo server and keep a PNG (or PPM) of its board.")
+    parser.add_argument("host", help="public IP address of server")
+    parser.add_argument("port", type=int, help="server port to connect to")
+    parser.add_argument("output", help="image file to keep writing, PPM if it ends in .ppm and PNG otherwise")
+    parser.add_argument(
+        "-r", "--resolution", nargs=2, type=int, default=[1600, 1000], help="size of the image (width then height)"
+    )
+    parser.add_argument("-i", "--interval", type=float, default=0.5, help="least seconds between writing the image")
+    parser.add_argument(
+        "-w", "--watch", nargs=3, type=int, help="R G B of a player to show the board through the fog of"
+    )
+    parser.add_argument("--room", help="room to watch on a server hosting several games")
+    parser.add_argument("--once", action="store_true", help="write the image once and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    if args.watch is not None:
+        args.watch = tuple(args.watch)
+    room = {FIELD_ROOM: args.room.encode()} if args.room is not None else {}
+    try:
+        follow(args, (args.host, args.port), room, load_catalog())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
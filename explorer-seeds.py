@@ -0,0 +1,50 @@
+import argparse
+from time import perf_counter
+from boards import CANDIDATES, SWAPS, Board_Generator
+from catalog import load_catalog
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description="Score the balanced boards (see the server's --balanced) of a range of seeds, to pick fair ones."
+    )
+    parser.add_argument("board_size", type=int, help="dimension of bingo board", metavar="N")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="first seed to score")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="seeds to score")
+    parser.add_argument("-t", "--top", type=int, default=10, help="fairest seeds to list")
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=CANDIDATES,
+        help="random boards to pick the best of for each seed (change it and the boards won't match the server's)",
+    )
+    parser.add_argument("--swaps", type=int, default=SWAPS, help="swaps to try on that best board (likewise)")
+    return parser
+
+
+def main():
+    parser = parse()
+    args = parser.parse_args()
+    catalog = load_catalog()
+    max_size = int(len(catalog) ** 0.5)
+    if not 2 <= args.board_size <= max_size:
+        parser.error("board size must be between 2 and %i with this goal list" % max_size)
+    difficulties, types = catalog.goal_info()
+    if not any(difficulties) and not any(types):
+        print("Your bingo.json doesn't give its goals any difficulty or types, so every board is as fair as any other")
+    generator = Board_Generator(difficulties, types, args.board_size, args.candidates, args.swaps)
+    start = perf_counter()
+    scores = [(generator.score(generator.generate(seed)), seed) for seed in range(args.seed, args.seed + args.count)]
+    elapsed = perf_counter() - start
+    print(
+        "Scored %i seeds in %.2fs (%.0f boards/s, %i candidates each)"
+        % (args.count, elapsed, args.count * (args.candidates + 1) / elapsed, args.candidates)
+    )
+    for (clashes, spread), seed in sorted(scores)[: args.top]:
+        # spread as the root mean square of how far each line's difficulty is from an even share
+        spread = (spread / len(generator.lines)) ** 0.5
+        print("seed %i: %i synergy clashes, line difficulty off by %.1f" % (seed, clashes, spread))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,207 +1,1807 @@
 import argparse
-import json
+import asyncio
+import os
 import random
 import selectors
+import signal
 import socket
 import struct
+import subprocess
+import sys
+import zlib
+from collections import deque
+from itertools import islice
+from time import perf_counter
 from types import SimpleNamespace
-from squares import Game
+from protocol import (
+    BOARD,
+    CLIENT_HELLO,
+    FIELD_CATALOG,
+    FIELD_COLOR,
+    FIELD_GAME_ID,
+    FIELD_GOALS,
+    FIELD_LAST_SEQ,
+    FIELD_ROOM,
+    FIELD_SEED,
+    FIELD_SESSION,
+    FIELD_SIZE,
+    FIELD_VERSION,
+    HELLO_MAGIC,
+    MARK,
+    MARKS,
+    MAX_FRAME,
+    PROTOCOL_VERSION,
+    SEQ,
+    SERVER_HELLO,
+    SESSION,
+    SQUARES,
+    V1_MAX_SQUARES,
+    WIN,
+    Frame_Reader,
+    Protocol_Error,
+    decode_board,
+    decode_fields,
+    decode_marks,
+    decode_squares,
+    decode_varint,
+    decode_varints,
+    decode_win,
+    encode_fields,
+    encode_line,
+    encode_marks,
+    encode_squares,
+    encode_v1_marks,
+    encode_varint,
+    encode_varints,
+    encode_win,
+    frame,
+    pack_color,
+)
+from boards import Board_Generator, shuffled_goals
+from catalog import load_catalog
+from journal import CLOSE as J_CLOSE, MARKS as J_MARKS, OPEN as J_OPEN, PLAYER as J_PLAYER, STATE as J_STATE
+from journal import Journal, read_journal
+from metrics import Histogram, Rate, metric, serve_metrics
+from game import Game, iter_bits, popcount
 
 SEL = selectors.DefaultSelector()
+HANDSHAKE_TIMEOUT = 10
+WRITE_TIMEOUT = 30
+BACKLOG_LIMIT = 256 * 1024
+EVENT_LOG_SIZE = 4096
+LINES_TO_WIN = 1
+READ_SIZE = 4096
+UPSTREAM_READ_SIZE = 65536
+RECONNECT_INTERVAL = 1
+SENDMSG = hasattr(socket.socket, "sendmsg")
+IOV_MAX = 1024
+LAG_INTERVAL = 0.25
+MAX_ROOMS = 1000
+HANDOFF_SIZE = 65536
+MAX_ROOM_NAME = 64
+ROOM_TIMEOUT = 300
+SESSION_SIZE = 16
 
 
-def pack_color(rgb):
-    return struct.pack("!3B", *rgb)
+class Server_Metrics:
+    # Counted as we go by either engine, and only turned into text when someone scrapes them
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.marks = 0
+        self.mark_rate = Rate()
+        self.read = Histogram()
+        self.write = Histogram()
+        self.new_connection = Histogram()
+        self.broadcast = Histogram()
+        self.loop_lag = Histogram()
+
+    def add_marks(self, count):
+        self.marks += count
+        self.mark_rate.add(count)
+
+    def render(self, lobby, connections):
+        # connections is a list of (connection, bytes queued for it that its socket hasn't taken yet)
+        backlogs = [backlog for _, backlog in connections]
+        games = list(lobby.rooms.values())
+        return [
+            *metric("bingo_rooms", "gauge", "Games being served", [(None, len(games))]),
+            *metric("bingo_connections", "gauge", "Connected clients", [(None, len(connections))]),
+            *metric(
+                "bingo_spectators",
+                "gauge",
+                "Connected spectators",
+                [(None, sum(conn.spectator for conn, _ in connections))],
+            ),
+            *metric(
+                "bingo_players",
+                "gauge",
+                "Players that have joined any game",
+                [(None, sum(len(game.players) for game in games))],
+            ),
+            *metric("bingo_received_bytes_total", "counter", "Bytes read from clients", [(None, self.bytes_in)]),
+            *metric("bingo_sent_bytes_total", "counter", "Bytes written to clients", [(None, self.bytes_out)]),
+            *metric("bingo_marks_total", "counter", "Marks made by players", [(None, self.marks)]),
+            *metric(
+                "bingo_marks_per_second",
+                "gauge",
+                "Marks per second over the last %i seconds" % self.mark_rate.window,
+                [(None, self.mark_rate.per_second())],
+            ),
+            *metric(
+                "bingo_catching_up",
+                "gauge",
+                "Clients too far behind to be sent every mark, that get the squares that changed once they catch up",
+                [(None, sum(conn.dirty is not None for conn, _ in connections))],
+            ),
+            *metric("bingo_backlog_bytes_total", "gauge", "Bytes queued for all clients", [(None, sum(backlogs))]),
+            *metric(
+                "bingo_backlog_max_bytes",
+                "gauge",
+                "Most bytes queued for one client",
+                [(None, max(backlogs, default=0))],
+            ),
+            *metric(
+                "bingo_backlog_bytes",
+                "gauge",
+                "Bytes queued for each client that has any",
+                [({"addr": conn.addr, "port": conn.port}, backlog) for conn, backlog in connections if backlog],
+            ),
+            *metric("bingo_read_seconds", "histogram", "Time spent handling what a client sent", self.read),
+            *metric("bingo_write_seconds", "histogram", "Time spent catching up a client's backlog", self.write),
+            *metric(
+                "bingo_new_connection_seconds",
+                "histogram",
+                "Time spent accepting and joining a client",
+                self.new_connection,
+            ),
+            *metric("bingo_broadcast_seconds", "histogram", "Time spent sending a round of marks out", self.broadcast),
+            *metric("bingo_loop_lag_seconds", "histogram", "How long events wait on the event loop", self.loop_lag),
+        ]
+
+
+METRICS = Server_Metrics()
+
+
+class Send_Queue:
+    # Outgoing frames are shared between every recipient, so they're only ever sliced through memoryviews;
+    # a partial send never copies the rest of the backlog like outb = outb[sent:] did
+    __slots__ = ("frames", "size")
+
+    def __init__(self):
+        self.frames = deque()
+        self.size = 0
+
+    def __bool__(self):
+        return self.size > 0
+
+    def append(self, frame):
+        if frame:
+            self.frames.append(memoryview(frame))
+            self.size += len(frame)
+
+    def send(self, sock: socket.socket):
+        # Returns True once everything queued has been written
+        while self.frames:
+            try:
+                if SENDMSG and len(self.frames) > 1:
+                    sent = sock.sendmsg([self.frames[i] for i in range(min(len(self.frames), IOV_MAX))])
+                else:
+                    sent = sock.send(self.frames[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            METRICS.bytes_out += sent
+            while sent and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+            if sent:
+                self.frames[0] = self.frames[0][sent:]
+                return False
+        return True
 
 
 def wrapped_send(sock: socket.socket, data, msg):
-    # Write to socket, and if get a full buffer error, tell the selector to care about writing
-    try:
-        left_to_send = msg
-        while len(left_to_send) > 0:
-            sent = sock.send(left_to_send)
-            left_to_send = left_to_send[sent:]
-    except socket.error as e:
-        # EAGAIN and EWOULDBLOCK are basically the same error but for different systems/legacy architecture
-        if e.args[0] == socket.EAGAIN or e.args[0] == socket.EWOULDBLOCK:
-            data.outb += left_to_send
-            SEL.unregister(sock)
-            SEL.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data)
-        else:
-            raise e
+    # Write to socket, and if it can't take everything, tell the selector to care about writing
+    data.outb.append(msg)
+    if not data.outb.send(sock) and not data.writing:
+        data.writing = True
+        data.progress = perf_counter()
+        SEL.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data)
+
+
+def drop(sock: socket.socket):
+    if (data := SEL.unregister(sock).data) is not None:
+        data.game.connections.pop(sock, None)
+    sock.close()
 
 
 def recv_single_as_int(sock: socket.socket):
+    # only used during the handshake, before the socket is registered with the selector
     byte = sock.recv(1)
     if byte == b"":
-        SEL.unregister(sock)
         sock.close()
         return None
     return int.from_bytes(byte, "little")
 
 
-def send_to_all(message, orig_addr):
-    socket_map = SEL.get_map()
-    for conn in socket_map:
-        loop_key = socket_map[conn]
-        if loop_key.data is not None:  # not our listening socket
-            loop_addr = loop_key.data.addr
-            if loop_addr != orig_addr:
-                wrapped_send(loop_key.fileobj, loop_key.data, message)
+def recv_exactly(sock: socket.socket, num_bytes):
+    buf = b""
+    while len(buf) < num_bytes:
+        chunk = sock.recv(num_bytes - len(buf))
+        if chunk == b"":
+            sock.close()
+            return None
+        buf += chunk
+    return buf
+
+
+def recv_frame(sock: socket.socket):
+    # Blocking read of one whole frame during the handshake, returns (type, payload)
+    length = 0
+    for shift in range(0, 35, 7):
+        if (byte := recv_single_as_int(sock)) is None:
+            return None
+        length |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+    if not 0 < length <= MAX_FRAME or (msg := recv_exactly(sock, length)) is None:
+        return None
+    return msg[0], msg[1:]
+
+
+def negotiate(client_version):
+    # A versioned hello always means at least version 2, we speak whichever is older of theirs and ours
+    if client_version < 2:
+        raise Protocol_Error("versioned hello for version %i" % client_version)
+    return min(client_version, PROTOCOL_VERSION)
+
+
+def client_hello(msg):
+    # Returns the fields of a CLIENT_HELLO frame
+    if msg is None or msg[0] != CLIENT_HELLO:
+        raise Protocol_Error("expected a client hello")
+    return decode_fields(msg[1])
+
+
+def parse_hello(buf):
+    # Non-blocking version of the handshake for the supervisor: (version, hello fields, bytes of buf the hello took)
+    # once buf starts with a whole hello, None until then
+    if not buf:
+        return None
+    if buf[0] == HELLO_MAGIC:
+        if len(buf) < 2:
+            return None
+        version = negotiate(buf[1])
+        try:
+            length, start = decode_varint(buf, 2)
+        except IndexError:
+            return None
+        if not 0 < length <= HANDOFF_SIZE // 2:
+            raise Protocol_Error("hello too big")
+        if len(buf) < start + length:
+            return None
+        return version, client_hello((buf[start], buf[start + 1 : start + length])), start + length
+    if buf[0]:
+        return 1, {}, 1
+    if len(buf) < 4:
+        return None
+    return 1, {FIELD_COLOR: bytes(buf[1:4])}, 4
+
+
+def receive_handoff(channel):
+    # For a worker: (connection, version, hello fields, anything they sent after the hello) from the supervisor,
+    # which accepted them and read their hello to know which worker has their room, or None
+    try:
+        hello, fds, _, _ = socket.recv_fds(channel, HANDOFF_SIZE, 1)
+    except (BlockingIOError, InterruptedError):
+        return None
+    if not fds:
+        raise SystemExit("The supervisor has gone, stopping")
+    conn = socket.socket(fileno=fds[0])
+    try:
+        parsed = parse_hello(hello)
+    except Protocol_Error:
+        parsed = None
+    if parsed is None:
+        conn.close()
+        return None
+    version, fields, used = parsed
+    return conn, version, fields, hello[used:]
+
+
+def join_upstream(addr, fields):
+    # Blocking, connects to the server (or relay) that a relay relays as a spectator, returns (socket, hello fields)
+    sock = socket.create_connection(addr, HANDSHAKE_TIMEOUT)
+    try:
+        sock.sendall(bytes((HELLO_MAGIC, PROTOCOL_VERSION)) + frame(CLIENT_HELLO, encode_fields(fields)))
+        if (msg := recv_frame(sock)) is None or msg[0] != SERVER_HELLO:
+            raise Protocol_Error("expected a server hello")
+    except (OSError, Protocol_Error):
+        sock.close()
+        raise
+    return sock, decode_fields(msg[1])
+
+
+def incoming_marks(data, chunk):
+    # Square indices out of whatever a connection just sent us
+    if data.version == 1:
+        return chunk
+    data.inb.feed(chunk)
+    marks = []
+    for msg_type, payload in data.inb:
+        if msg_type == MARK:
+            marks += decode_varints(payload)
+    return marks
+
+
+class Tick_Frames:
+    # Everything marked in one loop iteration goes out as one frame per protocol version that every recipient shares,
+    # plus variants for the players that marked, leaving out their own marks since they've already drawn them.
+    # Frames are only encoded the first time someone needs them.
+    __slots__ = ("marks", "markers", "seq", "results", "cache", "squares")
+
+    def __init__(self, marks, seq, results=b""):
+        self.marks = marks
+        self.markers = {player_id for player_id, _, _ in marks}
+        self.seq = seq
+        self.results = results  # line and win frames, which everyone gets, marker or not
+        self.cache = {}
+        self.squares = None
+
+    def touched(self):
+        # Bitmask of the squares marked this time, for connections that only need to know which squares changed
+        if self.squares is None:
+            self.squares = 0
+            for _, idx, _ in self.marks:
+                self.squares |= 1 << idx
+        return self.squares
+
+    def get(self, version, player_id):
+        if player_id not in self.markers:
+            player_id = None
+        key = (version, player_id)
+        if key not in self.cache:
+            marks = [(idx, color) for other_id, idx, color in self.marks if player_id is None or other_id != player_id]
+            if version == 1:
+                self.cache[key] = encode_v1_marks(marks)
+            else:
+                # even a player that only heard about their own marks needs to know how far along they are
+                marks = encode_marks(marks) if marks else b""
+                self.cache[key] = marks + self.results + frame(SEQ, encode_varint(self.seq))
+        return self.cache[key]
+
+
+def send_to_all(frames, connections, backlog_limit=BACKLOG_LIMIT):
+    # connections is the socket -> connection data of everyone in the game the frames are from
+    if not frames:
+        return
+    for sock, data in list(connections.items()):
+        if data.dirty is not None:
+            # too far behind to get every mark, they'll just hear where these squares ended up once they catch up
+            data.dirty |= frames.touched()
+            continue
+        frame = frames.get(data.version, data.player_id)
+        if frame:
+            try:
+                wrapped_send(sock, data, frame)
+            except ConnectionError:
+                # Server shouldn't crash if someone disconnects weirdly, and everyone else still needs the frame
+                drop(sock)
+                continue
+            if data.outb.size > backlog_limit:
+                if data.version == 1:
+                    # old clients have no way to be told a square's state outright
+                    print(f"Dropping {data.addr}, they've fallen too far behind")
+                    drop(sock)
+                else:
+                    data.dirty = 0
+
+
+def drop_stalled(write_timeout):
+    # Connections whose socket hasn't taken a single byte of their backlog in write_timeout seconds
+    now = perf_counter()
+    for loop_key in list(SEL.get_map().values()):
+        if (data := loop_key.data) is not None and data.writing and now - data.progress > write_timeout:
+            print(f"Dropping {data.addr}, they haven't taken anything we've sent in {write_timeout:g}s")
+            drop(loop_key.fileobj)
+
+
+def selector_connections():
+    # For the metrics thread, which can catch the loop halfway through registering or unregistering someone
+    while True:
+        try:
+            keys = list(SEL.get_map().values())
+        except (RuntimeError, KeyError):
+            continue
+        return [(key.data, key.data.outb.size) for key in keys if key.data is not None]
+
+
+class Player:
+    # marks is a bitmask over squares, index is this player's bit in Server_Game.markers,
+    # line_counts how many squares of each bingo line they have marked and lines a bitmask of the completed ones,
+    # host the address they last joined from (None if they've only been read back from the journal)
+    __slots__ = ("player_id", "index", "color", "packed", "marks", "line_counts", "lines", "place", "host")
+
+    def __init__(self, player_id, index, color, num_lines):
+        self.player_id = player_id
+        self.index = index
+        self.color = color
+        self.packed = pack_color(color)
+        self.marks = 0
+        self.line_counts = [0] * num_lines
+        self.lines = 0
+        self.place = None
+        self.host = None
+
+
+def session_of(player_id):
+    # The token a player id came from, None for version 1 players, who are their address
+    try:
+        return bytes.fromhex(player_id)
+    except ValueError:
+        return None
 
 
 class Server_Game(Game):
-    def __init__(self, size, goals):
+    def __init__(
+        self,
+        size,
+        goals,
+        event_log_size=EVENT_LOG_SIZE,
+        lines_to_win=LINES_TO_WIN,
+        catalog_digest=None,
+        backlog_limit=BACKLOG_LIMIT,
+        seed=None,
+    ):
         super().__init__(size)
-        self.player_dict = {}
-        self.squares = [set() for i in range(size * size)]
+        self.num_squares = size * size
+        self.players = {}  # player_id -> Player
+        self.by_index = []
+        self.by_color = {}  # packed color -> Player, no two players in a game share one
+        self.markers = [0] * self.num_squares  # bitmask over player indices for every square
         self.goals = goals[: size * size]
+        self.seed = seed  # the board was generated from, if it's known
+        self.catalog_digest = catalog_digest
+        self.backlog_limit = backlog_limit
+        self.connections = {}  # socket (or asyncio stream writer) -> connection, for everyone in this game
+        self.pending = []  # (player_id, idx, packed color) marks waiting for the end of this loop iteration
+        self.results = []  # line and win frames waiting along with them
+        self.lines_to_win = lines_to_win
+        self.winners = []
+        # Every mark gets the next sequence number, the most recent ones are kept so a client that reconnects
+        # only has to be told what it missed
+        self.game_id = os.urandom(8)
+        self.seq = 0
+        self.events = deque(maxlen=event_log_size)  # (seq, player_id, idx, packed color)
+        # Serialized board per protocol version, one entry per square so a mark only re-encodes its own square,
+        # plus the whole welcome message joined from it, kept until the next mark so a crowd of joins shares it
+        self.snapshots = {}
+        self.welcomes = {}
+        self.greetings = {}
+        self.journal = None  # the Journal this game is written to, if it is
+        self.journal_id = None  # the number it goes by there
+
+    def record(self, marks, player_id):
+        # marks is a list of (idx, packed color) toggles that have already been applied
+        first = self.seq + 1
+        self.seq += len(marks)
+        self.events.extend((first + i, player_id, idx, color) for i, (idx, color) in enumerate(marks))
+        self.pending += [(player_id, idx, color) for idx, color in marks]
+
+    def take_frames(self):
+        if not self.pending:
+            return None
+        pending = self.pending
+        self.pending = []
+        results = b"".join(self.results)
+        self.results = []
+        return Tick_Frames(pending, self.seq, results)
+
+    def replay(self, last_seq, player_id):
+        # The marks a client that has seen everything up to last_seq is missing, or None if we no longer have them all
+        if last_seq > self.seq or (self.events and last_seq < self.events[0][0] - 1):
+            return None
+        if not self.events and last_seq != self.seq:
+            return None
+        missed = islice(self.events, max(0, len(self.events) - (self.seq - last_seq)), None)
+        # their own marks they drew themselves, whether or not we'd told them about them yet
+        marks = [(idx, color) for _, other_id, idx, color in missed if other_id != player_id]
+        # line events aren't logged, so they get the current standings instead
+        return (encode_marks(marks) if marks else b"") + self.pack_results() + frame(SEQ, encode_varint(self.seq))
 
     def mark(self, idx, player_id):
-        if player_id in self.squares[idx]:
-            self.squares[idx].remove(player_id)
-        else:
-            self.squares[idx].add(player_id)
+        player = self.players[player_id]
+        player.marks ^= 1 << idx
+        added = player.marks >> idx & 1
+        self.markers[idx] ^= 1 << player.index
+        self.refresh_squares((idx,))
+        self.update_lines(player, idx, added)
+
+    def update_lines(self, player, idx, added):
+        # Only the (at most four) lines through this square can have changed
+        for line in self.lines_through[idx]:
+            if added:
+                player.line_counts[line] += 1
+                if player.line_counts[line] == self.size:
+                    player.lines |= 1 << line
+                    self.results.append(encode_line(player.packed, line, True))
+            else:
+                if player.line_counts[line] == self.size:
+                    player.lines &= ~(1 << line)
+                    self.results.append(encode_line(player.packed, line, False))
+                player.line_counts[line] -= 1
+        if added and player.place is None and popcount(player.lines) >= self.lines_to_win:
+            self.winners.append(player)
+            player.place = len(self.winners)
+            self.results.append(encode_win(player.packed, player.place))
+
+    def pack_results(self):
+        # Every currently completed line and every win so far, for clients that weren't around to hear about them
+        lines = [encode_line(player.packed, line, True) for player in self.by_index for line in iter_bits(player.lines)]
+        return b"".join(lines) + b"".join(encode_win(player.packed, player.place) for player in self.winners)
+
+    def marked_by(self, player_id):
+        return list(iter_bits(self.players[player_id].marks))
+
+    def markers_of(self, idx):
+        return [self.by_index[i].player_id for i in iter_bits(self.markers[idx])]
+
+    def refresh_squares(self, indices):
+        for version, squares in self.snapshots.items():
+            for idx in indices:
+                squares[idx] = self.pack_square(idx, version)
+        self.welcomes.clear()
+
+    def recolor_squares(self, player, indices):
+        # A color swap doesn't change who marked what, so the snapshots of the squares only need the player's three
+        # bytes swapped, which are the ones after everyone's from a lower index
+        if not self.snapshots:
+            return
+        # the same for every version, only what counts the markers is different
+        offsets = [3 * popcount(self.markers[idx] >> player.index) for idx in indices]
+        for squares in self.snapshots.values():
+            for idx, offset in zip(indices, offsets):
+                square = squares[idx]
+                pos = len(square) - offset
+                squares[idx] = square[:pos] + player.packed + square[pos + 3 :]
+        self.welcomes.clear()
 
     def new_player(self, player_id, player_color):
-        message = b""
-        if player_id in self.player_dict:
-            old_color = pack_color(self.player_dict[player_id])
+        marks = []
+        if (player := self.players.get(player_id)) is None:
+            player = self.players[player_id] = Player(player_id, len(self.by_index), player_color, len(self.line_masks))
+            self.by_index.append(player)
+            self.by_color[player.packed] = player
+            if self.journal is not None:
+                self.journal.player(self.journal_id, player_id, player_color)
+        elif player.color != player_color:
+            old_color = player.packed
             new_color = pack_color(player_color)
-            for i in range(len(self.squares)):
-                if player_id in self.squares[i]:
-                    # transmit mark to current players to unmark old color and mark new color
-                    idx_byte = i.to_bytes(1, "little")
-                    message += idx_byte + old_color + idx_byte + new_color
-        self.player_dict[player_id] = player_color
-        return message
+            marked = list(iter_bits(player.marks))
+            for i in marked:
+                # transmit mark to current players to unmark old color and mark new color
+                marks.append((i, old_color))
+                marks.append((i, new_color))
+            player.color = player_color
+            player.packed = new_color
+            self.by_color.pop(old_color, None)
+            self.by_color[new_color] = player
+            self.record(marks, player_id)
+            self.recolor_squares(player, marked)
+            if self.journal is not None:
+                self.journal.player(self.journal_id, player_id, player_color)
+        return marks
+
+    def journal_fields(self, room):
+        # What the journal needs to open this game again
+        fields = {FIELD_ROOM: room, FIELD_SIZE: encode_varint(self.size), FIELD_GOALS: encode_varints(self.goals)}
+        if self.seed is not None:
+            fields[FIELD_SEED] = encode_varint(self.seed)
+        if self.catalog_digest is not None:
+            fields[FIELD_CATALOG] = self.catalog_digest
+        return fields
+
+    def journal_state(self, room):
+        players = [(player.player_id, player.color, player.marks, player.place) for player in self.by_index]
+        return self.journal_fields(room), self.seq, players
+
+    def restore(self, seq, players):
+        # Back to a state from the journal, on a fresh game
+        for player_id, color, marks, place in players:
+            self.new_player(player_id, color)
+            player = self.players[player_id]
+            player.marks = marks
+            for idx in iter_bits(marks):
+                self.markers[idx] |= 1 << player.index
+            player.line_counts = [popcount(marks & mask) for mask in self.line_masks]
+            player.lines = sum(1 << line for line, count in enumerate(player.line_counts) if count == self.size)
+            player.place = place
+        self.winners = sorted((player for player in self.by_index if player.place), key=lambda player: player.place)
+        self.seq = seq
+        self.refresh_squares(range(self.num_squares))
+
+    def serves(self, version):
+        # Version 1 only has a byte for each square and goal index
+        return version > 1 or (self.size * self.size <= V1_MAX_SQUARES and max(self.goals) < 256)
+
+    def refusal(self, host, version, fields):
+        # Why a freshly handshaked connection can't join, if it can't
+        if not self.serves(version):
+            return "their client is too old for a board this big"
+        if FIELD_COLOR in fields:
+            if len(fields[FIELD_COLOR]) != 3:
+                return "their color isn't R G B"
+            other = self.by_color.get(fields[FIELD_COLOR])
+            if other is not None and other.player_id != self.identify(host, version, fields)[0]:
+                return "someone else is already playing as that color"
+        if FIELD_LAST_SEQ in fields:
+            try:
+                decode_varint(fields[FIELD_LAST_SEQ])
+            except (IndexError, Protocol_Error):
+                return "their sequence number doesn't make sense"
+        return None
 
     def pack_goals(self):
         return struct.pack("!%iB" % (self.size * self.size), *(self.goals))
 
     def pack_player(self, player_id):
-        return pack_color(self.player_dict[player_id])
+        return self.players[player_id].packed
 
-    def pack_square(self, idx):
-        ret = len(self.squares[idx]).to_bytes(1, "little")
-        for player_id in self.squares[idx]:
-            ret += self.pack_player(player_id)
-        return ret
+    def pack_square(self, idx, version=1):
+        markers = self.markers[idx]
+        if version == 1:
+            count = popcount(markers).to_bytes(1, "little")
+        else:
+            count = encode_varint(popcount(markers))
+        return count + b"".join(self.by_index[i].packed for i in iter_bits(markers))
 
-    def pack_board(self):
-        ret = b""
-        for i in range(self.size * self.size):
-            ret += self.pack_square(i)
-        return ret
+    def catch_up(self, squares, version):
+        # For a connection that fell too far behind to be sent every mark: where the squares in the squares bitmask
+        # are now, the standings, and how far along that puts them
+        squares = [(idx, self.pack_square(idx, version)) for idx in iter_bits(squares)]
+        return (encode_squares(squares) if squares else b"") + self.pack_results() + frame(SEQ, encode_varint(self.seq))
 
-    def new_connection(self, sock):
-        conn, (host, port) = sock.accept()
-        conn.setblocking(True)
-        print(f"Accepted connection from {host}")
-        replacement_msg = None
-        if (spectate := recv_single_as_int(conn)) is None:
+    def pack_board(self, version=1):
+        if version not in self.snapshots:
+            self.snapshots[version] = [self.pack_square(i, version) for i in range(self.num_squares)]
+        return b"".join(self.snapshots[version])
+
+    def greeting(self, version):
+        # The part of the welcome that never changes: board size and goals
+        if version not in self.greetings:
+            if version == 1:
+                self.greetings[version] = self.size.to_bytes(1, "little") + self.pack_goals()
+            else:
+                fields = {
+                    FIELD_VERSION: encode_varint(version),
+                    FIELD_SIZE: encode_varint(self.size),
+                    FIELD_GOALS: encode_varints(self.goals),
+                    FIELD_GAME_ID: self.game_id,
+                }
+                if self.catalog_digest is not None:
+                    fields[FIELD_CATALOG] = self.catalog_digest
+                self.greetings[version] = frame(SERVER_HELLO, encode_fields(fields))
+        return self.greetings[version]
+
+    def welcome(self, version):
+        # Everything a freshly connected client needs to draw the board
+        if version not in self.welcomes:
+            if version == 1:
+                board = self.pack_board()
+            else:
+                board = frame(BOARD, self.pack_board(version)) + self.pack_results()
+                board += frame(SEQ, encode_varint(self.seq))
+            self.welcomes[version] = self.greeting(version) + board
+        return self.welcomes[version]
+
+    def identify(self, host, version, fields):
+        # Which player a freshly handshaked connection is, and the session token they're to be told about if any.
+        # Version 1 clients are whoever played from their address before; anyone newer is whoever the token they
+        # sent back was given to, or a new player with a token of their own, however many share an address. A client
+        # that's been restarted has lost its token, so without one they're whoever has their color if that's from
+        # the same address or nobody is connected as them, rather than a second player in the same color.
+        if FIELD_COLOR not in fields:
+            # spectators hear about every mark
+            return None, None
+        if version == 1:
+            return host, None
+        session = fields.get(FIELD_SESSION, b"")
+        if session.hex() in self.players:
+            return session.hex(), session
+        if (player := self.by_color.get(fields[FIELD_COLOR])) is not None:
+            connected = any(conn.player_id == player.player_id for conn in self.connections.values())
+            if player.host == host or not connected:
+                return player.player_id, session_of(player.player_id)
+        session = os.urandom(SESSION_SIZE)
+        return session.hex(), session
+
+    def join(self, host, version, fields):
+        # Registers a freshly handshaked connection, returns (their player id, None for spectators, and what to send)
+        player_id, session = self.identify(host, version, fields)
+        swapped = False
+        if player_id is not None:
+            swapped = bool(self.new_player(player_id, tuple(fields[FIELD_COLOR])))
+            self.players[player_id].host = host
+        session = frame(SESSION, session) if session is not None else b""
+        if version > 1 and FIELD_LAST_SEQ in fields and fields.get(FIELD_GAME_ID) == self.game_id and not swapped:
+            # a reconnect, which only needs what it missed (their color swap would be news to them though)
+            if (missed := self.replay(decode_varint(fields[FIELD_LAST_SEQ])[0], player_id)) is not None:
+                return player_id, self.greeting(version) + missed + session
+        return player_id, self.welcome(version) + session
+
+    def flush(self):
+        if frames := self.take_frames():
+            start = perf_counter()
+            send_to_all(frames, self.connections, self.backlog_limit)
+            METRICS.broadcast.observe(perf_counter() - start)
+
+    def read_marks(self, marks, player_id):
+        if (player := self.players.get(player_id)) is None:
+            # spectators don't get to mark
             return
-        elif not spectate:
-            if (r := recv_single_as_int(conn)) is None:
-                return
-            if (g := recv_single_as_int(conn)) is None:
-                return
-            if (b := recv_single_as_int(conn)) is None:
-                return
-            replacement_msg = self.new_player(host, (r, g, b))
-        data = SimpleNamespace(addr=host, outb=b"")
-        wrapped_send(conn, data, self.size.to_bytes(1, "little") + self.pack_goals() + self.pack_board())
-        conn.setblocking(False)
-        if replacement_msg:
-            send_to_all(replacement_msg, host)
-        SEL.register(conn, selectors.EVENT_READ, data=data)
+        marks = [idx for idx in marks if idx < self.num_squares]
+        METRICS.add_marks(len(marks))
+        self.apply_marks(player, marks)
+        if self.journal is not None and marks:
+            self.journal.marks(self.journal_id, player.index, marks)
+
+    def apply_marks(self, player, marks):
+        for idx in marks:
+            self.mark(idx, player.player_id)
+        self.record([(idx, player.packed) for idx in marks], player.player_id)
 
     def read(self, key: selectors.SelectorKey):
         sock = key.fileobj
         data = key.data
-        idx = sock.recv(1)
-        if idx:
-            self.mark(int.from_bytes(idx, "little"), data.addr)
-            message = idx + struct.pack("!3B", *(self.player_dict[data.addr]))
-            send_to_all(message, data.addr)
-        else:
-            SEL.unregister(sock)
-            sock.close()
+        chunk = sock.recv(READ_SIZE)
+        METRICS.bytes_in += len(chunk)
+        try:
+            if chunk:
+                self.read_marks(incoming_marks(data, chunk), data.player_id)
+                return
+        except Protocol_Error:
+            pass
+        drop(sock)
 
-    @staticmethod
-    def write(key: selectors.SelectorKey):
+    def write(self, key: selectors.SelectorKey):
         # Alternative write, called with a selector key, for when we're actively selecting on writing availability
         # If we write our entire buff successfully, we can stop selecting on writing for this socket
         sock = key.fileobj
         data = key.data
-        if data.outb:
-            sent = sock.send(data.outb)
-            data.outb = data.outb[sent:]
-            if not data.outb:
-                # We are freed from caring about writing
-                SEL.unregister(sock)
-                SEL.register(sock, selectors.EVENT_READ, data=data)
+        data.progress = perf_counter()
+        if data.outb.send(sock):
+            if data.dirty is not None:
+                # caught up at last, now they can hear what they missed (as of the last broadcast, so make that now)
+                self.flush()
+                data.outb.append(self.catch_up(data.dirty, data.version))
+                data.dirty = None
+                if not data.outb.send(sock):
+                    return
+            # We are freed from caring about writing
+            data.writing = False
+            SEL.modify(sock, selectors.EVENT_READ, data=data)
+
+
+class Relay_Game(Server_Game):
+    # Mirrors a game served somewhere else, which it follows as a spectator, and serves it on to spectators of its own
+    # exactly like the server would, so the server only has to send every mark to a few relays. Relays can follow
+    # relays too. Sequence numbers and the game id are upstream's, so clients can reconnect to any relay of the game.
+    def __init__(self, upstream, fields, event_log_size=EVENT_LOG_SIZE, backlog_limit=BACKLOG_LIMIT, room=b""):
+        super().__init__(
+            decode_varint(fields[FIELD_SIZE])[0],
+            decode_varints(fields[FIELD_GOALS]),
+            event_log_size,
+            catalog_digest=fields.get(FIELD_CATALOG),
+            backlog_limit=backlog_limit,
+        )
+        self.upstream = upstream
+        self.room = room  # the room we follow upstream, whichever one our own clients ask for
+        self.game_id = fields[FIELD_GAME_ID]
+        # players are known by color here, and lines are worked out from their marks like upstream does, but only
+        # upstream knows how many lines win, so places are just copied from it
+        self.lines_to_win = len(self.line_masks) + 1
+        self.inb = Frame_Reader()
+        # where upstream resolved to when we first joined, so reconnecting never waits on a name lookup
+        self.peer = None  # (address family, address)
+        self.dial_started = None
+        self.dial_frames = None  # once connected, what upstream has sent on the socket dial gave
+
+    def refusal(self, host, version, fields):
+        if FIELD_COLOR in fields:
+            return "players have to join the game itself, not a relay"
+        return super().refusal(host, version, fields)
+
+    def player_for(self, packed):
+        if (player := self.players.get(packed)) is None:
+            player = self.players[packed] = Player(packed, len(self.by_index), tuple(packed), len(self.line_masks))
+            self.by_index.append(player)
+        return player
+
+    def toggle(self, marks):
+        # marks is a list of (idx, packed color) toggles, upstream's marks or the difference a snapshot made
+        for idx, packed in marks:
+            self.mark(idx, self.player_for(packed).player_id)
+        self.record(marks, None)
+
+    def differences(self, squares):
+        # The toggles that turn our squares into (square index, [colors]) snapshots of them, unmarks first so that
+        # a line we hadn't heard was broken and is complete again doesn't look completed twice
+        unmarks = []
+        marks = []
+        for idx, colors in squares:
+            now = {pack_color(color) for color in colors}
+            before = {self.by_index[i].packed for i in iter_bits(self.markers[idx])}
+            unmarks += [(idx, packed) for packed in before - now]
+            marks += [(idx, packed) for packed in now - before]
+        return unmarks + marks
+
+    def feed(self, chunk):
+        self.inb.feed(chunk)
+        for msg_type, payload in self.inb:
+            if msg_type == MARKS:
+                self.toggle([(idx, pack_color(color)) for idx, color in decode_marks(payload)])
+            elif msg_type == BOARD:
+                self.toggle(self.differences(decode_board(payload, self.num_squares)))
+            elif msg_type == SQUARES:
+                self.toggle(self.differences(decode_squares(payload)))
+            elif msg_type == WIN:
+                color, place = decode_win(payload)
+                if (player := self.player_for(pack_color(color))).place is None:
+                    player.place = place
+                    self.winners.append(player)
+                    self.results.append(frame(WIN, payload))
+            elif msg_type == SEQ:
+                if (seq := decode_varint(payload)[0]) != self.seq:
+                    # we were sent squares rather than every mark, so our log doesn't line up with upstream's
+                    self.events.clear()
+                    self.seq = seq
+
+    def rejoin_hello(self):
+        # upstream only has to send what we missed if it still can
+        hello = {FIELD_LAST_SEQ: encode_varint(self.seq), FIELD_GAME_ID: self.game_id}
+        if self.room:
+            hello[FIELD_ROOM] = self.room
+        return bytes((HELLO_MAGIC, PROTOCOL_VERSION)) + frame(CLIENT_HELLO, encode_fields(hello))
+
+    def rejoined(self, msg, frames):
+        # msg is the first frame upstream sent back, frames whatever came after it
+        if msg[0] != SERVER_HELLO:
+            raise Protocol_Error("expected a server hello")
+        if decode_fields(msg[1]).get(FIELD_GAME_ID) != self.game_id:
+            raise Protocol_Error("upstream is serving a different game now")
+        print(f"Reconnected to {self.upstream[0]}:{self.upstream[1]}")
+        self.inb = frames
+        self.feed(b"")
+
+    def dial(self):
+        # Selectors engine, starts reconnecting without blocking and returns the socket, which dialed takes from
+        # connecting to joined one ready event at a time
+        family, addr = self.peer
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(addr)
+        self.dial_started = perf_counter()
+        self.dial_frames = None
+        SEL.register(sock, selectors.EVENT_WRITE, data=None)
+        return sock
+
+    def dialed(self, sock):
+        # True once upstream has said hello on sock, False if it never will, None while it's still on its way
+        try:
+            if self.dial_frames is None:
+                if error := sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    raise OSError(error, os.strerror(error))
+                # small enough to always fit in a fresh socket's buffer
+                sock.send(self.rejoin_hello())
+                self.dial_frames = Frame_Reader()
+                SEL.modify(sock, selectors.EVENT_READ, data=None)
+                return None
+            if not (chunk := sock.recv(UPSTREAM_READ_SIZE)):
+                raise ConnectionResetError
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            return False
+        METRICS.bytes_in += len(chunk)
+        self.dial_frames.feed(chunk)
+        if (msg := self.dial_frames.pop()) is None:
+            return None
+        self.rejoined(msg, self.dial_frames)
+        return True
+
+    def read_upstream(self, sock):
+        # Selectors engine, returns False once upstream is gone
+        try:
+            chunk = sock.recv(UPSTREAM_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            chunk = b""
+        METRICS.bytes_in += len(chunk)
+        if chunk:
+            self.feed(chunk)
+            return True
+        print(f"Lost connection to {self.upstream[0]}:{self.upstream[1]}")
+        drop(sock)
+        return False
+
+
+class Lobby:
+    # Every game this process serves, by room name. Clients that don't ask for a room (every version 1 client among
+    # them) join the default room b"", the game from the command line; any other room is opened by the first client
+    # to ask for it and closed once nobody has been in it for room_timeout seconds. Each game only ever broadcasts
+    # to its own connections.
+    def __init__(self, default, open_room=None, max_rooms=MAX_ROOMS, room_timeout=ROOM_TIMEOUT):
+        self.default = default
+        self.rooms = {b"": default}
+        self.open_room = open_room  # (size, seed) -> Server_Game or None if it can't, None if there's only one game
+        self.max_rooms = max_rooms
+        self.room_timeout = room_timeout
+        self.emptied = {}  # room -> when the last client left it
+        self.journal = None
+
+    def enter(self, host, version, fields):
+        # Returns (the game a freshly handshaked client joins, None) or (None, why they can't)
+        room = fields.get(FIELD_ROOM, b"") if self.open_room is not None else b""
+        if (game := self.rooms.get(room)) is None:
+            if len(room) > MAX_ROOM_NAME:
+                return None, "that room name is too long"
+            if len(self.rooms) > self.max_rooms:
+                return None, "there are too many rooms open already"
+            try:
+                size = decode_varint(fields[FIELD_SIZE])[0] if FIELD_SIZE in fields else self.default.size
+                seed = decode_varint(fields[FIELD_SEED])[0] if FIELD_SEED in fields else random.randint(0, 2**32)
+            except (IndexError, Protocol_Error):
+                return None, "their room settings don't make sense"
+            if (game := self.open_room(size, seed)) is None:
+                return None, "there aren't enough goals for a board that big"
+            self.rooms[room] = game
+            print(f"Opened room {room_name(room)}, {size}x{size} with seed {seed}")
+            if self.journal is not None:
+                game.journal = self.journal
+                game.journal_id = self.journal.open_game(game.journal_fields(room))
+        if (reason := game.refusal(host, version, fields)) is not None:
+            return None, reason
+        return game, None
+
+    def close_idle(self):
+        now = perf_counter()
+        for room, game in list(self.rooms.items()):
+            if game.connections or game is self.default:
+                self.emptied.pop(room, None)
+            elif now - self.emptied.setdefault(room, now) > self.room_timeout:
+                print(f"Closing room {room_name(room)}, nobody's been in it for {self.room_timeout:g}s")
+                del self.rooms[room]
+                del self.emptied[room]
+                if game.journal is not None:
+                    game.journal.close_game(game.journal_id)
+
+    def keep_journal(self, journal):
+        # From now on, everything that happens in every room gets written to journal
+        self.journal = journal
+        self.compact_journal()
+
+    def compact_journal(self):
+        rooms = list(self.rooms.items())
+        self.journal.compact([game.journal_state(room) for room, game in rooms])
+        for journal_id, (_, game) in enumerate(rooms):
+            game.journal = self.journal
+            game.journal_id = journal_id
+
+    def sweep(self):
+        # Once a second or so
+        self.close_idle()
+        if self.journal is not None and self.journal.due():
+            self.compact_journal()
+
+    def flush(self):
+        for game in self.rooms.values():
+            game.flush()
+
+    def handshake(self, conn):
+        # Blocking, returns (version, hello fields), version 1 clients only ever send a color if they're a player
+        if (first := recv_single_as_int(conn)) is None:
+            return None
+        if first == HELLO_MAGIC:
+            if (version := recv_single_as_int(conn)) is None:
+                return None
+            return negotiate(version), client_hello(recv_frame(conn))
+        if first:
+            return 1, {}
+        if (rgb := recv_exactly(conn, 3)) is None:
+            return None
+        return 1, {FIELD_COLOR: rgb}
+
+    def new_connection(self, sock):
+        conn, (host, port) = sock.accept()
+        conn.setblocking(True)
+        print(f"Accepted connection from {host}")
+        try:
+            if (hello := self.handshake(conn)) is None:
+                return
+        except (Protocol_Error, OSError):
+            conn.close()
+            return
+        self.admit(conn, host, port, *hello)
+
+    def adopt(self, channel):
+        # Instead of new_connection in a worker
+        if (handoff := receive_handoff(channel)) is None:
+            return
+        conn = handoff[0]
+        try:
+            host, port = conn.getpeername()[:2]
+        except OSError:
+            conn.close()
+            return
+        print(f"Accepted connection from {host}")
+        self.admit(conn, host, port, *handoff[1:])
+
+    def admit(self, conn, host, port, version, fields, leftover=b""):
+        # Everything after the handshake; leftover is whatever the client sent after its hello, if someone else read it
+        game, reason = self.enter(host, version, fields)
+        if game is None:
+            print(f"Refusing {host}, {reason}")
+            conn.close()
+            return
+        # Anything still pending is already part of the board we're about to send, so get it out to everyone else first
+        game.flush()
+        data = SimpleNamespace(
+            addr=host,
+            port=port,
+            version=version,
+            spectator=FIELD_COLOR not in fields,
+            player_id=None,  # who they mark as, once they've joined
+            game=game,
+            inb=Frame_Reader(),
+            outb=Send_Queue(),
+            writing=False,
+            progress=0.0,  # when the socket last took some of outb
+            dirty=None,  # bitmask of squares changed since they fell behind, if they have
+        )
+        conn.setblocking(False)
+        SEL.register(conn, selectors.EVENT_READ, data=data)
+        game.connections[conn] = data
+        data.player_id, welcome = game.join(host, version, fields)
+        wrapped_send(conn, data, welcome)
+        if leftover:
+            game.read_marks(incoming_marks(data, leftover), data.player_id)
+
+
+def room_name(room):
+    return repr(room.decode(errors="replace")) if room else "(default)"
+
 
+class Async_Server:
+    # Each connection gets its own reader task (this handler) and writer task, so one slow or stalled client
+    # can only ever time itself out instead of freezing everyone else like the blocking handshake does
+    def __init__(
+        self,
+        lobby,
+        handshake_timeout=HANDSHAKE_TIMEOUT,
+        write_timeout=WRITE_TIMEOUT,
+        idle_timeout=None,
+    ):
+        self.lobby = lobby
+        self.handshake_timeout = handshake_timeout
+        self.write_timeout = write_timeout
+        self.idle_timeout = idle_timeout
+        self.flush_scheduled = False
+
+    async def recv_exactly(self, reader, num_bytes, timeout):
+        try:
+            return await asyncio.wait_for(reader.readexactly(num_bytes), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+
+    async def recv_frame(self, reader, timeout):
+        length = 0
+        for shift in range(0, 35, 7):
+            if (byte := await self.recv_exactly(reader, 1, timeout)) is None:
+                return None
+            length |= (byte[0] & 0x7F) << shift
+            if byte[0] < 0x80:
+                break
+        if not 0 < length <= MAX_FRAME or (msg := await self.recv_exactly(reader, length, timeout)) is None:
+            return None
+        return msg[0], msg[1:]
+
+    async def handshake(self, reader):
+        # Same wire formats as the selectors engine, returns (version, hello fields)
+        if (first := await self.recv_exactly(reader, 1, self.handshake_timeout)) is None:
+            return None
+        if first[0] == HELLO_MAGIC:
+            if (version := await self.recv_exactly(reader, 1, self.handshake_timeout)) is None:
+                return None
+            hello_frame = await self.recv_frame(reader, self.handshake_timeout)
+            return negotiate(version[0]), client_hello(hello_frame)
+        if first[0]:
+            return 1, {}
+        if (rgb := await self.recv_exactly(reader, 3, self.handshake_timeout)) is None:
+            return None
+        return 1, {FIELD_COLOR: rgb}
+
+    def flush(self):
+        self.flush_scheduled = False
+        for game in list(self.lobby.rooms.values()):
+            self.send_to_all(game)
+
+    def send_to_all(self, game):
+        if not (frames := game.take_frames()):
+            return
+        start = perf_counter()
+        for conn in list(game.connections.values()):
+            if conn.dirty is not None:
+                # too far behind to get every mark, they'll just hear where these squares ended up once they catch up
+                conn.dirty |= frames.touched()
+                continue
+            if frame := frames.get(conn.version, conn.player_id):
+                # the transport sends straight away and only buffers what the socket won't take yet
+                conn.writer.write(frame)
+                METRICS.bytes_out += len(frame)
+                if backlog := conn.writer.transport.get_write_buffer_size():
+                    conn.backlogged.set()
+                    if backlog > game.backlog_limit:
+                        self.fall_behind(conn)
+        METRICS.broadcast.observe(perf_counter() - start)
+
+    def fall_behind(self, conn):
+        if conn.version == 1:
+            # old clients have no way to be told a square's state outright
+            print(f"Dropping {conn.addr}, they've fallen too far behind")
+            conn.writer.close()
+        else:
+            conn.dirty = 0
 
-def parse(max_size):
+    def connection_backlogs(self):
+        # For the metrics thread
+        connections = [conn for game in list(self.lobby.rooms.values()) for conn in list(game.connections.values())]
+        return [(conn, conn.writer.transport.get_write_buffer_size()) for conn in connections]
+
+    async def measure_lag(self):
+        # How late the loop gets round to a callback that should have run LAG_INTERVAL later
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            METRICS.loop_lag.observe(max(0.0, loop.time() - start - LAG_INTERVAL))
+
+    def schedule_flush(self):
+        # Runs once the callbacks for this loop iteration are done, so every mark read in it shares one frame
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    async def drain(self, conn):
+        # As long as the socket takes some of the backlog every write_timeout seconds, it's slow rather than dead
+        while True:
+            backlog = conn.writer.transport.get_write_buffer_size()
+            try:
+                return await asyncio.wait_for(conn.writer.drain(), self.write_timeout)
+            except asyncio.TimeoutError:
+                if conn.writer.transport.get_write_buffer_size() >= backlog:
+                    raise
+
+    async def write_loop(self, conn):
+        try:
+            while True:
+                await conn.backlogged.wait()
+                conn.backlogged.clear()
+                start = perf_counter()
+                await self.drain(conn)
+                METRICS.write.observe(perf_counter() - start)
+                if conn.dirty is not None:
+                    # caught up at last, now they can hear what they missed (as of the last broadcast, so make that now)
+                    self.send_to_all(conn.game)
+                    conn.writer.write(conn.game.catch_up(conn.dirty, conn.version))
+                    conn.dirty = None
+                    conn.backlogged.set()
+        except (asyncio.TimeoutError, ConnectionError):
+            conn.writer.close()
+
+    async def handle(self, reader, writer):
+        host, port = writer.get_extra_info("peername")[:2]
+        print(f"Accepted connection from {host}")
+        try:
+            hello = await self.handshake(reader)
+        except Protocol_Error:
+            hello = None
+        if hello is None:
+            writer.close()
+            return
+        await self.serve_client(reader, writer, *hello)
+
+    async def serve_client(self, reader, writer, version, fields, leftover=b""):
+        # Everything after the handshake; leftover is whatever the client sent after its hello, if someone else read it
+        host, port = writer.get_extra_info("peername")[:2]
+        game, reason = self.lobby.enter(host, version, fields)
+        if game is None:
+            print(f"Refusing {host}, {reason}")
+            writer.close()
+            return
+        # Anything still pending is already part of the board we're about to send, so get it out to everyone else first
+        start = perf_counter()
+        self.send_to_all(game)
+        conn = SimpleNamespace(
+            addr=host,
+            port=port,
+            version=version,
+            spectator=FIELD_COLOR not in fields,
+            player_id=None,  # who they mark as, once they've joined
+            game=game,
+            inb=Frame_Reader(),
+            writer=writer,
+            backlogged=asyncio.Event(),
+            dirty=None,
+        )
+        conn.player_id, welcome = game.join(host, version, fields)
+        writer.write(welcome)
+        METRICS.bytes_out += len(welcome)
+        METRICS.new_connection.observe(perf_counter() - start)
+        self.schedule_flush()
+        conn.backlogged.set()
+        writer_task = asyncio.create_task(self.write_loop(conn))
+        game.connections[writer] = conn
+        try:
+            marks = leftover
+            while not writer.is_closing():
+                if not marks:
+                    try:
+                        marks = await asyncio.wait_for(reader.read(READ_SIZE), self.idle_timeout)
+                    except (asyncio.TimeoutError, ConnectionError):
+                        break
+                    if not marks:
+                        break
+                METRICS.bytes_in += len(marks)
+                start = perf_counter()
+                try:
+                    game.read_marks(incoming_marks(conn, marks), conn.player_id)
+                except Protocol_Error:
+                    break
+                METRICS.read.observe(perf_counter() - start)
+                self.schedule_flush()
+                marks = b""
+        finally:
+            game.connections.pop(writer, None)
+            writer_task.cancel()
+            writer.close()
+
+    def adopt(self, channel):
+        # Instead of handle in a worker
+        if (handoff := receive_handoff(channel)) is not None:
+            asyncio.create_task(self.serve_handoff(*handoff))
+
+    async def serve_handoff(self, conn, version, fields, leftover):
+        try:
+            reader, writer = await asyncio.open_connection(sock=conn)
+        except OSError:
+            conn.close()
+            return
+        print(f"Accepted connection from {writer.get_extra_info('peername')[0]}")
+        await self.serve_client(reader, writer, version, fields, leftover)
+
+    async def sweep_lobby(self):
+        while True:
+            await asyncio.sleep(1)
+            self.lobby.sweep()
+
+    async def rejoin(self, game):
+        reader, writer = await asyncio.open_connection(*game.upstream)
+        try:
+            writer.write(game.rejoin_hello())
+            frames = Frame_Reader()
+            while (msg := frames.pop()) is None:
+                if not (chunk := await reader.read(UPSTREAM_READ_SIZE)):
+                    raise ConnectionResetError
+                METRICS.bytes_in += len(chunk)
+                frames.feed(chunk)
+            game.rejoined(msg, frames)
+        except BaseException:
+            writer.close()
+            raise
+        self.schedule_flush()
+        return reader, writer
+
+    async def follow(self, sock):
+        # Feeds a Relay_Game from upstream, starting with the socket it joined on and reconnecting whenever it drops
+        game = self.lobby.default
+        reader, writer = await asyncio.open_connection(sock=sock)
+        while True:
+            if reader is not None:
+                while True:
+                    try:
+                        chunk = await reader.read(UPSTREAM_READ_SIZE)
+                    except ConnectionError:
+                        break
+                    if not chunk:
+                        break
+                    METRICS.bytes_in += len(chunk)
+                    game.feed(chunk)
+                    self.schedule_flush()
+                writer.close()
+                print(f"Lost connection to {game.upstream[0]}:{game.upstream[1]}")
+            await asyncio.sleep(RECONNECT_INTERVAL)
+            try:
+                reader, writer = await asyncio.wait_for(self.rejoin(game), HANDSHAKE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                reader = None
+
+    async def serve(self, host, port, metrics_port=None, metrics_host="127.0.0.1", upstream=None, channel=None):
+        if metrics_port is not None:
+            serve_metrics(metrics_host, metrics_port, lambda: METRICS.render(self.lobby, self.connection_backlogs()))
+            asyncio.create_task(self.measure_lag())
+        if self.lobby.open_room is not None or self.lobby.journal is not None:
+            asyncio.create_task(self.sweep_lobby())
+        if channel is not None:
+            # a worker, whose connections all come from the supervisor
+            channel.setblocking(False)
+            asyncio.get_running_loop().add_reader(channel, self.adopt, channel)
+            await asyncio.Event().wait()
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        async with server:
+            if upstream is None:
+                await server.serve_forever()
+            else:
+                # a relay stops altogether if upstream starts sending nonsense or a different game
+                await asyncio.gather(server.serve_forever(), self.follow(upstream))
+
+
+class Supervisor:
+    # Spreads rooms over worker processes so a busy server can use every core. The supervisor owns the port: it
+    # accepts every connection and reads its hello without blocking, then passes the socket (and the hello) to the
+    # worker that has their room over a Unix socket. Rooms go to workers by a hash of their name, so everyone in
+    # a room always lands in the same Server_Game. Workers that die are started again, empty or from their journal.
+    def __init__(self, args, server_addr):
+        self.args = args
+        self.server_addr = server_addr
+        self.sel = selectors.DefaultSelector()
+        self.workers = [None] * args.workers
+        self.pending = {}  # socket -> (when accepted, what they've sent so far)
+
+    def start_worker(self, index, restart=False):
+        # The worker gets the same command line, plus the end of a socket pair to receive its connections on
+        channel, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:]]
+        command += ["--worker-channel", str(theirs.fileno()), "--worker-index", str(index)]
+        if self.args.seed is not None:
+            command += ["-s", str(self.args.seed)]
+        if restart and self.args.journal is not None and not self.args.resume:
+            # one that's started again picks its rooms back up (the first time only if asked to)
+            command.append("--resume")
+        process = subprocess.Popen(command, pass_fds=(theirs.fileno(),))
+        theirs.close()
+        self.workers[index] = SimpleNamespace(process=process, channel=channel)
+
+    def check_workers(self):
+        for index, worker in enumerate(self.workers):
+            if worker.process.poll() is not None:
+                print(f"Worker {index} stopped with exit code {worker.process.returncode}, starting it again")
+                worker.channel.close()
+                self.start_worker(index, restart=True)
+
+    def accept(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.sel.register(conn, selectors.EVENT_READ)
+        self.pending[conn] = (perf_counter(), b"")
+
+    def read(self, conn):
+        accepted, buf = self.pending[conn]
+        try:
+            chunk = conn.recv(READ_SIZE)
+            buf += chunk
+            hello = parse_hello(buf) if chunk else None
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, Protocol_Error):
+            chunk = hello = None
+        if not chunk:
+            self.forget(conn)
+            return
+        if hello is None:
+            self.pending[conn] = (accepted, buf)
+            return
+        room = hello[1].get(FIELD_ROOM, b"")
+        worker = self.workers[zlib.crc32(room) % len(self.workers)]
+        self.sel.unregister(conn)
+        del self.pending[conn]
+        try:
+            socket.send_fds(worker.channel, [buf], [conn.fileno()])
+        except OSError:
+            # a worker that's just died, check_workers will start it again
+            pass
+        conn.close()
+
+    def forget(self, conn):
+        self.sel.unregister(conn)
+        del self.pending[conn]
+        conn.close()
+
+    def drop_stalled(self):
+        now = perf_counter()
+        for conn, (accepted, _) in list(self.pending.items()):
+            if now - accepted > self.args.handshake_timeout:
+                self.forget(conn)
+
+    def run(self):
+        listener = listen(self.server_addr)
+        self.sel.register(listener, selectors.EVENT_READ)
+        for index in range(len(self.workers)):
+            self.start_worker(index)
+        print(f"Started {len(self.workers)} workers")
+        # terminate means stop, and stop the workers too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        swept = perf_counter()
+        try:
+            while True:
+                for key, _ in self.sel.select(timeout=1):
+                    if key.fileobj is listener:
+                        self.accept(listener)
+                    else:
+                        self.read(key.fileobj)
+                if (now := perf_counter()) - swept > 1:
+                    self.drop_stalled()
+                    self.check_workers()
+                    swept = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in self.workers:
+                worker.process.terminate()
+            for worker in self.workers:
+                worker.process.wait()
+
+
+def upstream_address(text):
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected HOST:PORT")
+    return host, int(port)
+
+
+def parse():
     parser = argparse.ArgumentParser(description="Start a server session of a synced bingo game.")
     parser.add_argument("host", help="internal IP address of server")
     parser.add_argument("port", type=int, help="server port to connect to (make sure you forwarded it!)")
     parser.add_argument(
         "board_size",
         type=int,
-        help="dimension of bingo board (min 2, max dependent on total amount of goals)",
+        nargs="?",
+        help="dimension of bingo board (min 2, max dependent on total amount of goals), not needed for a relay",
         metavar="N",
-        choices=range(2, max_size + 1),
+    )
+    parser.add_argument(
+        "--relay",
+        type=upstream_address,
+        metavar="HOST:PORT",
+        help="relay the game served there (by a server or another relay) to spectators instead of running one",
+    )
+    parser.add_argument("--relay-room", default="", help="room to relay, if not the default one")
+    parser.add_argument(
+        "--max-rooms",
+        type=int,
+        default=MAX_ROOMS,
+        help="rooms clients can open besides the default one, each a game of its own (0 for none)",
+    )
+    parser.add_argument(
+        "--room-timeout",
+        type=float,
+        default=ROOM_TIMEOUT,
+        help="seconds a room can stay empty before it's closed",
     )
     parser.add_argument("-s", "--seed", type=int, help="random seed to use to generate board layout")
-    return parser.parse_args()
+    parser.add_argument(
+        "--balanced",
+        action="store_true",
+        help="generate boards (in every room) with spread out difficulty and no synergies in a line, using what "
+        "synerGen generators say about their goals; explorer-seeds.py finds the fairest seeds",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="PATH",
+        help="keep every room's board in this file as it's played, so a server that dies can --resume",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="pick the rooms in --journal back up where they were, if it exists, instead of starting a new board",
+    )
+    parser.add_argument(
+        "--lines-to-win",
+        type=int,
+        default=LINES_TO_WIN,
+        help="completed rows, columns or diagonals a player needs to win",
+    )
+    parser.add_argument(
+        "--event-log",
+        type=int,
+        default=EVENT_LOG_SIZE,
+        help="marks to remember for clients that reconnect, older ones get the whole board again",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("selectors", "asyncio"),
+        default="selectors",
+        help="event loop to serve with; asyncio handles each connection's handshake independently",
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=HANDSHAKE_TIMEOUT,
+        help="seconds a new connection gets to finish its handshake (asyncio engine or with workers only)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="seconds without a mark before a connection is dropped (asyncio engine only, default never)",
+    )
+    parser.add_argument(
+        "--backlog-limit",
+        type=int,
+        default=BACKLOG_LIMIT,
+        help="bytes a client can fall behind by before it's only sent the squares that changed once it catches up",
+    )
+    parser.add_argument(
+        "--write-timeout",
+        type=float,
+        default=WRITE_TIMEOUT,
+        help="seconds a client with a backlog can go without taking any of it before it's dropped",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="processes to spread rooms over, each serving its own metrics on the port after the last (default one "
+        "process for everything)",
+    )
+    parser.add_argument("--worker-channel", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-index", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics over HTTP on this port")
+    parser.add_argument(
+        "--metrics-host", default="127.0.0.1", help="address to serve metrics on (default only this machine)"
+    )
+    return parser
 
 
-def main():
-    with open("./bingo.json") as f:
-        # TODO strip comments
-        goals = json.load(f)
-        goal_list = sorted(
-            [goals[key]["Desc"] for key in goals if isinstance(goals[key], dict) and goals[key].get("Desc")]
-        )
-        goal_indices = list(range(len(goal_list)))
-    max_size = int(len(goal_list) ** 0.5)
-    args = parse(max_size)
-    server_addr = (args.host, args.port)
+def restore_rooms(path, new_game):
+    # Every room still open in the journal at path, as of its last intact record; new_game(size, goals, seed,
+    # catalog digest) makes each one's game
+    games = {}  # journal id -> (room, game)
+    for record_type, journal_id, payload in read_journal(path):
+        if record_type == J_OPEN:
+            seed = decode_varint(payload[FIELD_SEED])[0] if FIELD_SEED in payload else None
+            goals = decode_varints(payload[FIELD_GOALS])
+            game = new_game(decode_varint(payload[FIELD_SIZE])[0], goals, seed, payload.get(FIELD_CATALOG))
+            games[journal_id] = (payload.get(FIELD_ROOM, b""), game)
+            continue
+        if journal_id not in games:
+            continue
+        game = games[journal_id][1]
+        if record_type == J_STATE:
+            game.restore(*payload)
+        elif record_type == J_PLAYER:
+            game.new_player(*payload)
+        elif record_type == J_MARKS:
+            player, marks = payload
+            game.apply_marks(game.by_index[player], [idx for idx in marks if idx < game.num_squares])
+        elif record_type == J_CLOSE:
+            del games[journal_id]
+    for _, game in games.values():
+        # nobody's connected to be told about any of it
+        game.pending.clear()
+        game.results.clear()
+    return dict(games.values())
+
+
+def new_lobby(parser, args):
+    catalog = load_catalog()
+    max_size = int(len(catalog) ** 0.5)
+    generators = {}  # board size -> Board_Generator, for --balanced
+
+    def open_room(size, seed):
+        if not 2 <= size <= max_size:
+            return None
+        if args.balanced:
+            if size not in generators:
+                generators[size] = Board_Generator(*catalog.goal_info(), size)
+            goals = generators[size].generate(seed)
+        else:
+            goals = shuffled_goals(len(catalog), size, seed)
+        return Server_Game(size, goals, args.event_log, args.lines_to_win, catalog.digest, args.backlog_limit, seed)
+
+    if args.resume and os.path.exists(args.journal):
+        return resume_lobby(parser, args, catalog, open_room)
     board_size = args.board_size
-    if args.seed is not None:
-        seed = args.seed
-    else:
+    if board_size is None or not 2 <= board_size <= max_size:
+        parser.error("board size must be between 2 and %i with this goal list" % max_size)
+    if args.seed is None:
         # this is the only way I can figure out how to generate a seed and print it to save
-        seed = random.randint(0, 2**32)
-    random.seed(seed)
-    print("Generating board with seed ", str(seed))
+        args.seed = random.randint(0, 2**32)
+    if args.worker_channel is None:
+        print("Generating board with seed ", str(args.seed))
+    return Lobby(open_room(board_size, args.seed), open_room, args.max_rooms, args.room_timeout)
+
+
+def resume_lobby(parser, args, catalog, open_room):
+    def restored_game(size, goals, seed, catalog_digest):
+        # goal indices from another goal list would be different goals
+        if catalog_digest != catalog.digest:
+            raise ValueError("the goal list has changed since")
+        return Server_Game(size, goals, args.event_log, args.lines_to_win, catalog.digest, args.backlog_limit, seed)
+
+    start = perf_counter()
+    try:
+        rooms = restore_rooms(args.journal, restored_game)
+    except (OSError, ValueError, KeyError, IndexError, Protocol_Error) as error:
+        parser.exit(1, f"Couldn't resume from {args.journal}: {error}\n")
+    if b"" not in rooms:
+        parser.exit(1, f"Couldn't resume from {args.journal}: it has no default room\n")
+    lobby = Lobby(rooms[b""], open_room, args.max_rooms, args.room_timeout)
+    lobby.rooms.update(rooms)
+    marks = sum(game.seq for game in rooms.values())
+    print(f"Resumed {len(rooms)} rooms ({marks} marks) from {args.journal} in {perf_counter() - start:.3f}s")
+    return lobby
+
+
+def new_relay(parser, args):
+    # Returns (the lobby with the game it relays, the socket it follows it on)
+    if args.board_size is not None:
+        parser.error("a relay gets its board from upstream")
+    room = args.relay_room.encode()
+    try:
+        upstream, fields = join_upstream(args.relay, {FIELD_ROOM: room} if room else {})
+    except (OSError, Protocol_Error) as error:
+        parser.exit(1, f"Couldn't join {args.relay[0]}:{args.relay[1]}: {error}\n")
+    print(f"Relaying {args.relay[0]}:{args.relay[1]}")
+    game = Relay_Game(args.relay, fields, args.event_log, args.backlog_limit, room)
+    game.peer = (upstream.family, upstream.getpeername())
+    return Lobby(game), upstream
+
+
+def worker_journal(path, index):
+    # each worker keeps its own rooms, so it needs a journal of its own
+    return f"{path}.{index}"
+
+
+def listen(server_addr):
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name == "posix":
+        # like asyncio does, so a restarted server or relay can take its port straight back (not on Windows, where
+        # this would let another program take it)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     listener.bind(server_addr)
-    listener.listen()
+    listener.listen(1024)
     listener.setblocking(False)
-    SEL.register(listener, selectors.EVENT_READ, data=None)
-    random.shuffle(goal_indices)
+    return listener
 
-    game = Server_Game(board_size, goal_indices[: board_size * board_size])
 
+def main():
+    parser = parse()
+    args = parser.parse_args()
+    server_addr = (args.host, args.port)
+    upstream = None
+    channel = None
+    if args.resume and args.journal is None:
+        parser.error("--resume needs the --journal to resume from")
+    if args.relay is not None and args.journal is not None:
+        parser.error("a relay has nothing of its own to journal")
+    if args.worker_channel is not None:
+        channel = socket.socket(fileno=args.worker_channel)
+        if args.metrics_port is not None:
+            args.metrics_port += args.worker_index
+        if args.journal is not None:
+            args.journal = worker_journal(args.journal, args.worker_index)
+    elif args.workers:
+        if args.relay is not None:
+            parser.error("a relay only has the one game, so it can't be spread over workers")
+        if not hasattr(socket, "send_fds") or not hasattr(socket, "SOCK_SEQPACKET"):
+            parser.error("workers need a system that can pass sockets between processes")
+        journals = [worker_journal(args.journal, index) for index in range(args.workers)] if args.journal else []
+        if not (args.resume and all(os.path.exists(path) for path in journals)):
+            # checks the board size and settles the seed every worker's default room starts from
+            new_lobby(parser, args)
+        Supervisor(args, server_addr).run()
+        return
+    if args.relay is None:
+        lobby = new_lobby(parser, args)
+    else:
+        lobby, upstream = new_relay(parser, args)
+    if args.journal is not None:
+        lobby.keep_journal(Journal(args.journal))
+    try:
+        serve(args, server_addr, lobby, upstream, channel)
+    finally:
+        if lobby.journal is not None:
+            lobby.journal.close()
+
+
+def serve(args, server_addr, lobby, upstream, channel):
+    game = lobby.default
+    if args.engine == "asyncio":
+        server = Async_Server(lobby, args.handshake_timeout, args.write_timeout, args.idle_timeout)
+        try:
+            asyncio.run(server.serve(*server_addr, args.metrics_port, args.metrics_host, upstream, channel))
+        except KeyboardInterrupt:
+            pass
+        except Protocol_Error as error:
+            print(f"Stopped relaying: {error}")
+        return
+
+    if channel is None:
+        listener = listen(server_addr)
+    else:
+        # a worker, whose connections all come from the supervisor
+        listener = channel
+        listener.setblocking(False)
+    SEL.register(listener, selectors.EVENT_READ, data=None)
+    if upstream is not None:
+        upstream.setblocking(False)
+        SEL.register(upstream, selectors.EVENT_READ, data=None)
+    if args.metrics_port is not None:
+        serve_metrics(args.metrics_host, args.metrics_port, lambda: METRICS.render(lobby, selector_connections()))
+
+    swept = perf_counter()
+    dialing = None  # a relay's socket on its way back to upstream
     while True:
         try:
             # On Windows, timeout=None breaks KeyboardInterrupt for some reason
-            events = SEL.select(timeout=10)
+            # (and a relay that has lost upstream, or rooms that might be closed, need waking up every second anyway)
+            sweeping = len(lobby.rooms) > 1 or (args.relay is not None and upstream is None)
+            events = SEL.select(timeout=1 if sweeping else 10)
+            # everything that happens until the next select is time other sockets' events wait
+            woke = perf_counter()
             for key, mask in events:
-                if key.data is None:
+                start = perf_counter()
+                if key.fileobj is listener:
                     # This is our listener socket, new connection
-                    game.new_connection(key.fileobj)
-                else:
-                    if mask & selectors.EVENT_READ:
-                        game.read(key)
-                    if mask & selectors.EVENT_WRITE:
-                        game.write(key)
+                    if channel is None:
+                        lobby.new_connection(listener)
+                    else:
+                        lobby.adopt(listener)
+                    METRICS.new_connection.observe(perf_counter() - start)
+                    continue
+                if key.fileobj is upstream:
+                    if not game.read_upstream(upstream):
+                        upstream = None
+                    continue
+                if key.fileobj is dialing:
+                    if (joined := game.dialed(dialing)) is not None:
+                        if joined:
+                            upstream = dialing
+                        else:
+                            drop(dialing)
+                        dialing = None
+                    continue
+                if mask & selectors.EVENT_READ:
+                    key.data.game.read(key)
+                    METRICS.read.observe(perf_counter() - start)
+                if mask & selectors.EVENT_WRITE:
+                    start = perf_counter()
+                    key.data.game.write(key)
+                    METRICS.write.observe(perf_counter() - start)
+            lobby.flush()
+            if (now := perf_counter()) - swept > 1:
+                drop_stalled(args.write_timeout)
+                lobby.sweep()
+                if dialing is not None and now - game.dial_started > HANDSHAKE_TIMEOUT:
+                    drop(dialing)
+                    dialing = None
+                if args.relay is not None and upstream is None and dialing is None:
+                    dialing = game.dial()
+                swept = now
+            METRICS.loop_lag.observe(perf_counter() - woke)
         except KeyboardInterrupt:
             SEL.close()
             break
+        except Protocol_Error as error:
+            print(f"Stopped relaying: {error}")
+            SEL.close()
+            break
         except ConnectionResetError:
             # Server shouldn't crash if someone disconnects weirdly
             pass
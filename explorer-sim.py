@@ -0,0 +1,159 @@
+import argparse
+import json
+import multiprocessing
+import os
+from time import perf_counter
+from catalog import load_catalog
+from simulate import STRATEGIES, Simulation
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description="Simulate games on the boards of a range of seeds, to see how fast the fog opens, how soon every "
+        "goal comes into sight and how long lines take."
+    )
+    parser.add_argument("board_size", type=int, help="dimension of bingo board", metavar="N")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="first seed to simulate")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="seeds to simulate")
+    parser.add_argument("-g", "--games", type=int, default=1, help="games to play on every seed's board")
+    parser.add_argument(
+        "-p",
+        "--players",
+        nargs="+",
+        choices=sorted(STRATEGIES),
+        default=["random"] * 4,
+        help="how each player picks their next goal: at random, whatever opens the most fog, whatever gets a line "
+        "closest, or the easiest goal (by difficulty in bingo.json)",
+    )
+    parser.add_argument("-l", "--lines-to-win", type=int, default=1, help="lines a player needs for bingo")
+    parser.add_argument("--balanced", action="store_true", help="simulate the server's --balanced boards")
+    parser.add_argument(
+        "--weighted", action="store_true", help="a goal takes 1 + its difficulty to do instead of 1 for every goal"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count() or 1, help="processes to simulate in (1 for none)"
+    )
+    parser.add_argument("-t", "--top", type=int, default=10, help="goals slowest to come into sight to list")
+    parser.add_argument("-j", "--json", action="store_true", help="print results as JSON")
+    return parser
+
+
+def results(stats, catalog, top):
+    size = stats.board_size
+    goals = [goal for goal in range(len(catalog)) if stats.goal_distance[goal].count]
+    # the goals that turned up the latest, or never, on the boards they were on
+    slowest = sorted(
+        goals,
+        key=lambda goal: (stats.goal_unseen[goal] / stats.goal_distance[goal].count, stats.goal_seen[goal].mean),
+        reverse=True,
+    )[:top]
+    return {
+        "games": stats.games,
+        "fog": [fog.summary() for fog in stats.fog if fog.count],
+        "squares": [
+            {"unseen": stats.square_unseen[idx], **seen.summary()} for idx, seen in enumerate(stats.square_seen)
+        ],
+        "slowest_goals": [
+            {
+                "goal": catalog[goal],
+                "boards": stats.goal_distance[goal].count,
+                "distance": stats.goal_distance[goal].mean,
+                "unseen": stats.goal_unseen[goal],
+                **stats.goal_seen[goal].summary(),
+            }
+            for goal in slowest
+        ],
+        "lines": [
+            {"line": line, "name": name, **stats.lines[line].summary()}
+            for line, name in enumerate(
+                ["row %i" % (r + 1) for r in range(size)]
+                + ["column %i" % (c + 1) for c in range(size)]
+                + ["diagonal", "anti-diagonal"]
+            )
+        ],
+        "first_line": stats.first_line.summary(),
+        "player_first_line": stats.player_first_line.summary(),
+        "win": stats.win.summary(),
+        "no_win": stats.no_win,
+    }
+
+
+def format_times(summary):
+    if not summary["count"]:
+        return "never"
+    return "mean %.1f, p10 %g, p50 %g, p90 %g" % (summary["mean"], summary["p10"], summary["p50"], summary["p90"])
+
+
+def print_results(results, board_size):
+    num_squares = board_size * board_size
+    print("Fog, squares a player can see after their first marks:")
+    for marks, fog in enumerate(results["fog"][: board_size + 1]):
+        print("  %3i marks: %5.1f (%.0f%%)" % (marks, fog["mean"], 100 * fog["mean"] / num_squares))
+    print("First line: %s" % format_times(results["first_line"]))
+    print("Every player's first line: %s" % format_times(results["player_first_line"]))
+    print("Bingo: %s, %i games without" % (format_times(results["win"]), results["no_win"]))
+    print("Lines, how often and when they're completed first:")
+    for line in results["lines"]:
+        if line["count"]:
+            share = 100 * line["count"] / results["games"]
+            print("  %-14s %5.1f%% of games, mean %.1f" % (line["name"], share, line["mean"]))
+        else:
+            print("  %-14s never" % line["name"])
+    if board_size <= 16:
+        print("When each square comes into sight (mean):")
+        for row in range(board_size):
+            squares = results["squares"][row * board_size : (row + 1) * board_size]
+            print("  " + " ".join("%5.1f" % square["mean"] if square["count"] else "    -" for square in squares))
+    print("Goals slowest to come into sight:")
+    for goal in results["slowest_goals"]:
+        print(
+            "  %5.1f%% never, %s, %.1f marks from the start on average: %s"
+            % (
+                100 * goal["unseen"] / goal["boards"],
+                "mean %.1f" % goal["mean"] if goal["count"] else "never seen",
+                goal["distance"],
+                goal["goal"],
+            )
+        )
+
+
+def main():
+    parser = parse()
+    args = parser.parse_args()
+    catalog = load_catalog()
+    max_size = int(len(catalog) ** 0.5)
+    if not 2 <= args.board_size <= max_size:
+        parser.error("board size must be between 2 and %i with this goal list" % max_size)
+    difficulties, types = catalog.goal_info()
+    if (args.weighted or "easy" in args.players) and not any(difficulties):
+        print("Your bingo.json doesn't give its goals any difficulty, so every goal counts as just as hard")
+    simulation = Simulation(
+        args.board_size,
+        args.players,
+        difficulties,
+        types,
+        args.balanced,
+        args.weighted,
+        args.lines_to_win,
+        args.games,
+    )
+    start = perf_counter()
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            stats = simulation.run(args.seed, args.count, pool)
+    else:
+        stats = simulation.run(args.seed, args.count)
+    elapsed = perf_counter() - start
+    summary = results(stats, catalog, args.top)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(
+        "Simulated %i games in %.2fs (%.0f games/s, %i process%s)"
+        % (stats.games, elapsed, stats.games / elapsed, args.workers, "es" * (args.workers > 1))
+    )
+    print_results(summary, args.board_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+from enum import IntEnum
+
+# The board and the models of it that don't need Tk, so the server, renderer and simulator run without a display
+
+
+def rgb_to_hex(rgb):
+    return "#%02x%02x%02x" % rgb
+
+
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def iter_bits(mask):
+    # Indices of the set bits of an int bitmask, lowest first; a byte at a time so that big, dense masks
+    # don't cost a big int operation per bit
+    for offset, byte in enumerate(mask.to_bytes((mask.bit_length() + 7) // 8, "little")):
+        if byte:
+            for bit in _BYTE_BITS[byte]:
+                yield 8 * offset + bit
+
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+
+EMPTY_COLOR = (40, 40, 40)
+
+
+def pixel_to_point(size: int) -> float:
+    scaled = size * 0.75
+    # round to nearest half pt
+    return round(scaled * 2.0) / 2.0
+
+
+def pixel_to_int_point(size: int) -> int:
+    return round(size * 0.75)
+
+
+def goal_font_size(length, square_height):
+    # In points for a goal length characters long, smaller the longer it is so it still fits
+    # TODO hardcoded height/width
+    ratio = 1 / length**0.5
+    return pixel_to_int_point(round(square_height * ratio))
+
+
+def stripe_coords(left, top, square_width, square_height, divs, idx):
+    # Where the idx-th of divs side by side stripes of a square goes, one per player who marked it
+    width = square_width / divs
+    return (left + idx * width, top, left + (idx + 1) * width, top + square_height)
+
+
+
+class Visibility(IntEnum):
+
+    INVISIBLE = 0
+    VISIBLE = 1
+    ALWAYS = 2
+
+
+class Game:
+    def __init__(self, board_size):
+        self.size: int = board_size
+        if board_size % 2:
+            self.middle = (board_size * board_size) // 2
+        else:
+            self.middle = (board_size * board_size) // 2 - (board_size // 2)
+        # Bingo lines are numbered rows first, then columns, then the diagonal and the anti-diagonal
+        self.line_masks = self.make_line_masks()
+        self.lines_through = [self.square_lines(idx) for idx in range(board_size * board_size)]
+        self.neighbors = [self.make_neighbors(idx) for idx in range(board_size * board_size)]
+
+    def row(self, idx):
+        return idx // self.size
+
+    def col(self, idx):
+        return idx % self.size
+
+    def make_line_masks(self):
+        size = self.size
+        row = (1 << size) - 1
+        col = int(("0" * (size - 1) + "1") * size, 2)
+        diagonal = sum(1 << (i * size + i) for i in range(size))
+        anti_diagonal = sum(1 << (i * size + size - 1 - i) for i in range(size))
+        return [row << (r * size) for r in range(size)] + [col << c for c in range(size)] + [diagonal, anti_diagonal]
+
+    def square_lines(self, idx):
+        row = self.row(idx)
+        col = self.col(idx)
+        lines = [row, self.size + col]
+        if row == col:
+            lines.append(2 * self.size)
+        if row + col == self.size - 1:
+            lines.append(2 * self.size + 1)
+        return lines
+
+    def completed_lines(self, marks):
+        # Bitmask of the lines a bitmask of marked squares covers, rescanning every line
+        return sum(1 << line for line, mask in enumerate(self.line_masks) if marks & mask == mask)
+
+    def line_name(self, line):
+        if line < self.size:
+            return "row %i" % (line + 1)
+        if line < 2 * self.size:
+            return "column %i" % (line - self.size + 1)
+        return "diagonal" if line == 2 * self.size else "anti-diagonal"
+
+    def adjacent_indices(self, idx):
+        return self.neighbors[idx]
+
+    def start_squares(self):
+        # The squares everyone can always see: the middle one and its neighbors, or the middle four on even boards
+        if self.size % 2:
+            return [self.middle, *self.adjacent_indices(self.middle)]
+        return [self.middle, self.middle - 1, self.middle + self.size, self.middle + self.size - 1]
+
+    def make_neighbors(self, idx):
+        row = self.row(idx)
+        col = self.col(idx)
+        ret = []
+        if row > 0:
+            ret.append(idx - self.size)
+        if row < self.size - 1:
+            ret.append(idx + self.size)
+        if col > 0:
+            ret.append(idx - 1)
+        if col < self.size - 1:
+            ret.append(idx + 1)
+        return tuple(ret)
+
+
+class Game_Model(Game):
+    def __init__(self, board_size, all_visible=False):
+        super().__init__(board_size)
+        num_squares = board_size * board_size
+        self.colors = [set() for _ in range(num_squares)]  # !!! Colors should be in (R, G, B) form, NOT hex yet!
+        # a Visibility per square, and how many of each square's neighbors we've marked ourselves
+        self.visibility = bytearray([Visibility.ALWAYS if all_visible else Visibility.INVISIBLE]) * num_squares
+        self.own_neighbors = bytearray(num_squares)
+        if not all_visible:
+            for idx in self.start_squares():
+                self.visibility[idx] = Visibility.ALWAYS
+
+    def __repr__(self):
+        border = "------------"
+        ret = []
+        for colors in self.colors:
+            ret.append(border)
+            ret.extend("|" + rgb_to_hex(color) + "|" for color in colors)
+            ret.extend("|         |" for _ in range(4 - len(colors)))
+            ret.append(border)
+        return "\n".join(ret)
+
+    def mark(self, idx, color):
+        colors = self.colors[idx]
+        if color not in colors:
+            colors.add(color)
+            return (True, sorted(colors))
+        else:
+            colors.remove(color)
+            return (False, sorted(colors))
+
+    def is_visible(self, idx):
+        return self.visibility[idx] != Visibility.INVISIBLE
+
+    # explore_surrounding and unexplore_surrounding must be called for every one of our own marks and unmarks,
+    # that's what keeps own_neighbors up to date
+    def explore_surrounding(self, idx):
+        envisioned = []
+        for adj_idx in self.neighbors[idx]:
+            self.own_neighbors[adj_idx] += 1
+            if self.visibility[adj_idx] == Visibility.INVISIBLE:
+                self.visibility[adj_idx] = Visibility.VISIBLE
+                envisioned.append(adj_idx)
+        return envisioned
+
+    def surrounded_by_color(self, idx, color):
+        return any(color in self.colors[adj_idx] for adj_idx in self.neighbors[idx])
+
+    def unexplore_surrounding(self, idx, color):
+        devisioned = []
+        for adj_idx in self.neighbors[idx]:
+            self.own_neighbors[adj_idx] -= 1
+            if self.visibility[adj_idx] == Visibility.VISIBLE and not self.own_neighbors[adj_idx]:
+                self.visibility[adj_idx] = Visibility.INVISIBLE
+                devisioned.append(adj_idx)
+        return devisioned
+
+
+class Fog(Game):
+    # What every player can see at once, for spectators to look through any of their eyes: the start squares plus
+    # every neighbor of their own marks, just like Game_Model works out for ourselves. Marks and sight are int
+    # bitmasks over squares, so a player's whole sight is four shifts of their marks, a machine word of squares
+    # at a time, and only the player who marked has theirs worked out again.
+    def __init__(self, board_size):
+        super().__init__(board_size)
+        self.full = (1 << board_size * board_size) - 1
+        first_column = int(("0" * (board_size - 1) + "1") * board_size, 2)
+        self.not_first_column = self.full & ~first_column
+        self.not_last_column = self.full & ~(first_column << (board_size - 1))
+        self.start = sum(1 << idx for idx in self.start_squares())
+        self.marks = {}  # color -> bitmask of the squares they've marked
+        self.sight = {}  # color -> bitmask of the squares they can see
+        self.players = []  # colors, in the order they first marked
+
+    def dilate(self, marks):
+        # Every neighbor of the squares in marks, without wrapping from the end of one row to the start of another
+        size = self.size
+        vertical = (marks << size | marks >> size) & self.full
+        return vertical | (marks << 1 & self.not_first_column) | (marks >> 1 & self.not_last_column)
+
+    def mark(self, idx, color):
+        # Returns the squares (as a bitmask) that color can now see or no longer see
+        if color not in self.marks:
+            self.marks[color] = 0
+            self.players.append(color)
+        self.marks[color] ^= 1 << idx
+        before = self.sight_of(color)
+        self.sight[color] = self.start | self.dilate(self.marks[color])
+        return before ^ self.sight[color]
+
+    def sight_of(self, color):
+        # None for the whole board
+        if color is None:
+            return self.full
+        return self.sight.get(color, self.start)
@@ -0,0 +1,200 @@
+import os
+import struct
+import threading
+import zlib
+from protocol import (
+    Protocol_Error,
+    decode_fields,
+    decode_varint,
+    decode_varints,
+    encode_fields,
+    encode_varint,
+    encode_varints,
+)
+
+# A server's games as an append-only log, so a restarted server can pick up where it died. The file is
+# JOURNAL_MAGIC, then records of varint length, record type byte, payload, and a !I crc32 of the type and payload.
+# Every game in it gets a number in the order their OPEN records come, which the records about it start with.
+# Reading stops at the first record that's cut short or doesn't check out, which is wherever a crash interrupted
+# the last write. Once enough has been appended the whole file is rewritten as an OPEN and a STATE per game that's
+# still open, so a resume never has more than COMPACT_BYTES of marks to replay.
+JOURNAL_MAGIC = b"BNGJ\x01"
+COMPACT_BYTES = 256 * 1024
+
+# record types
+OPEN = 1  # hello fields: FIELD_ROOM, FIELD_SIZE, FIELD_SEED, FIELD_GOALS, FIELD_CATALOG
+STATE = 2  # varint seq, then for every player in the order they joined: varint length and player id, R G B,
+# varint place they won in (0 if they haven't), varint length and their marks bitmask little endian
+PLAYER = 3  # R G B, then the player id, for a player that joined or changed color
+MARKS = 4  # varint index of the player (see STATE), varint square indices they toggled
+CLOSE = 5  # nothing, the game was closed
+
+_CRC = struct.Struct("!I")
+
+
+def encode_record(record_type, game, payload=b""):
+    body = bytes((record_type,)) + encode_varint(game) + payload
+    return encode_varint(len(body)) + body + _CRC.pack(zlib.crc32(body))
+
+
+def encode_state(seq, players):
+    # players is a list of (player id, R G B, marks bitmask, place or None)
+    out = [encode_varint(seq)]
+    for player_id, color, marks, place in players:
+        packed_id = player_id.encode()
+        packed_marks = marks.to_bytes((marks.bit_length() + 7) // 8, "little")
+        out += [encode_varint(len(packed_id)), packed_id, bytes(color), encode_varint(place or 0)]
+        out += [encode_varint(len(packed_marks)), packed_marks]
+    return b"".join(out)
+
+
+def decode_state(payload):
+    seq, pos = decode_varint(payload)
+    players = []
+    while pos < len(payload):
+        length, pos = decode_varint(payload, pos)
+        player_id = payload[pos : pos + length].decode()
+        color = tuple(payload[pos + length : pos + length + 3])
+        place, pos = decode_varint(payload, pos + length + 3)
+        length, pos = decode_varint(payload, pos)
+        players.append((player_id, color, int.from_bytes(payload[pos : pos + length], "little"), place or None))
+        pos += length
+    return seq, players
+
+
+def read_journal(path):
+    # Yields (record type, game number, payload) for every intact record, with OPEN payloads decoded to their fields,
+    # PLAYER and MARKS ones to (player id, color) and (player index, [square indices]) and STATE ones to
+    # (seq, players like encode_state's)
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(JOURNAL_MAGIC):
+        raise ValueError("not a game journal")
+    pos = len(JOURNAL_MAGIC)
+    while pos < len(data):
+        try:
+            length, start = decode_varint(data, pos)
+            end = start + length
+            if end + _CRC.size > len(data) or _CRC.unpack_from(data, end)[0] != zlib.crc32(data[start:end]):
+                return
+            record_type = data[start]
+            game, body = decode_varint(data, start + 1)
+            payload = data[body:end]
+            if record_type == OPEN:
+                payload = decode_fields(payload)
+            elif record_type == PLAYER:
+                payload = (payload[3:].decode(), tuple(payload[:3]))
+            elif record_type == MARKS:
+                player, body = decode_varint(payload)
+                payload = (player, decode_varints(payload[body:]))
+            elif record_type == STATE:
+                payload = decode_state(payload)
+        except (IndexError, Protocol_Error, UnicodeDecodeError):
+            return
+        yield record_type, game, payload
+        pos = end + _CRC.size
+
+
+class Journal:
+    # Appends happen on the game loop, which only ever adds to a buffer; a thread of its own writes that out and
+    # fsyncs, so every fsync covers whatever piled up during the one before it and the game never waits on the disk
+    def __init__(self, path, compact_bytes=COMPACT_BYTES):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self.games = 0  # numbers handed out so far
+        self.size = 0  # bytes in the file once everything appended so far is written
+        self.compacted_size = 0
+        self.batch = bytearray()
+        self.snapshot = None  # a whole new file's worth, waiting to replace the old one
+        self.closing = False
+        self.wake = threading.Condition()
+        self.file = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def append(self, record):
+        with self.wake:
+            self.batch += record
+            self.wake.notify()
+        self.size += len(record)
+
+    def open_game(self, fields):
+        game = self.games
+        self.games += 1
+        self.append(encode_record(OPEN, game, encode_fields(fields)))
+        return game
+
+    def player(self, game, player_id, color):
+        self.append(encode_record(PLAYER, game, bytes(color) + player_id.encode()))
+
+    def marks(self, game, player, squares):
+        self.append(encode_record(MARKS, game, encode_varint(player) + encode_varints(squares)))
+
+    def close_game(self, game):
+        self.append(encode_record(CLOSE, game))
+
+    def due(self):
+        return self.size - self.compacted_size > self.compact_bytes
+
+    def compact(self, games):
+        # games is a list of (OPEN fields, seq, players like encode_state's), which get numbered in that order;
+        # everything appended but not written yet is already part of them
+        snapshot = [JOURNAL_MAGIC]
+        for game, (fields, seq, players) in enumerate(games):
+            snapshot.append(encode_record(OPEN, game, encode_fields(fields)))
+            snapshot.append(encode_record(STATE, game, encode_state(seq, players)))
+        snapshot = b"".join(snapshot)
+        with self.wake:
+            self.snapshot = snapshot
+            self.batch = bytearray()
+            self.wake.notify()
+        self.games = len(games)
+        self.size = self.compacted_size = len(snapshot)
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def close(self):
+        with self.wake:
+            self.closing = True
+            self.wake.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.wake:
+                while not self.batch and self.snapshot is None and not self.closing:
+                    self.wake.wait()
+                batch, self.batch = self.batch, bytearray()
+                snapshot, self.snapshot = self.snapshot, None
+                closing = self.closing
+            try:
+                if snapshot is not None:
+                    self.replace(snapshot)
+                if batch and self.file is not None:
+                    self.file.write(batch)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            except OSError as error:
+                print(f"Couldn't write the journal: {error}")
+            if closing:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def replace(self, snapshot):
+        # Written next to the journal and moved over it, so there's always one whole journal or the other on disk
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        if os.name == "posix":
+            # and the move itself has to make it to disk too
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "ab")
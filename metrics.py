@@ -0,0 +1,96 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+# Just enough of the Prometheus text format to watch a server with: counters, gauges and histograms, served over
+# plain HTTP from a thread of its own so scrapes never hold up the game loop
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is everything past the biggest bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield "%s_bucket{le=\"%s\"} %i" % (name, bound, total)
+        yield "%s_bucket{le=\"+Inf\"} %i" % (name, self.count)
+        yield "%s_sum %r" % (name, self.sum)
+        yield "%s_count %i" % (name, self.count)
+
+
+class Rate:
+    # Events per second over the last few seconds, counted in one second buckets
+    __slots__ = ("window", "counts", "seconds")
+
+    def __init__(self, window=10):
+        self.window = window
+        # one more than the window for the second that's still going
+        self.counts = [0] * (window + 1)
+        self.seconds = [0] * (window + 1)
+
+    def add(self, count):
+        second = int(monotonic())
+        slot = second % (self.window + 1)
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += count
+
+    def per_second(self):
+        # the current second isn't over yet, so it's left out
+        second = int(monotonic())
+        recent = sum(count for count, at in zip(self.counts, self.seconds) if 0 < second - at <= self.window)
+        return recent / self.window
+
+
+def metric(name, kind, description, samples):
+    # samples is an iterable of (labels dict or None, value), or for histograms the Histogram itself
+    lines = ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, kind)]
+    if kind == "histogram":
+        lines.extend(samples.samples(name))
+        return lines
+    for labels, value in samples:
+        if labels:
+            label_text = ",".join('%s="%s"' % (key, str(label).replace('"', '\\"')) for key, label in labels.items())
+            lines.append("%s{%s} %r" % (name, label_text, value))
+        else:
+            lines.append("%s %r" % (name, value))
+    return lines
+
+
+def serve_metrics(host, port, render):
+    # render returns the whole metrics page as a list of lines, it's called from the HTTP server's threads
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = ("\n".join(render()) + "\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,250 @@
+import socket
+import struct
+
+# Version 1 is the original fixed-width format: one byte per square index and per goal index, 4 byte mark records.
+# A version 2 client opens with HELLO_MAGIC and the highest version it speaks (0 and 1 still mean a version 1
+# spectator/player), then everything in both directions is a frame: varint length, message type byte, payload.
+# Integers inside payloads are varints, so boards and goal lists aren't capped at 256 entries.
+PROTOCOL_VERSION = 2
+HELLO_MAGIC = 0xB0
+MAX_FRAME = 1 << 24
+V1_MAX_SQUARES = 256
+READ_SIZE = 65536
+CONNECT_TIMEOUT = 10
+
+# message types
+CLIENT_HELLO = 1  # fields
+SERVER_HELLO = 2  # fields
+BOARD = 3  # for every square: varint marker count, then that many R G B triples
+MARK = 4  # client -> server, one or more varint square indices
+MARKS = 5  # server -> client, one or more (varint square index, R G B) toggles
+SEQ = 6  # server -> client, varint sequence number of the last mark the client has now been told about
+LINE = 7  # server -> client, R G B of a player, varint line (see Game.line_masks), 1 if completed or 0 if broken
+WIN = 8  # server -> client, R G B of a player that has completed enough lines, varint place they finished in
+SQUARES = 9  # server -> client, for some squares: varint square index, then the square exactly like in BOARD
+SESSION = 10  # server -> player, right after the board, the token to send back as FIELD_SESSION to be them again
+
+# hello fields, each sent as varint tag, varint length, value; unknown tags are skipped so either side can add more
+FIELD_COLOR = 1  # R G B, only sent by players
+FIELD_VERSION = 2  # varint, the version the server picked
+FIELD_SIZE = 3  # varint board dimension, from a client it's the size to open a new room with
+FIELD_GOALS = 4  # varint goal index per square
+FIELD_LAST_SEQ = 5  # varint, sent by a reconnecting client that still has the board up to that sequence number
+FIELD_GAME_ID = 6  # random bytes the server picks at startup, so sequence numbers from another game don't count
+FIELD_CATALOG = 7  # digest of the server's goal catalog (see catalog.py), goal indices only mean anything if it matches
+FIELD_ROOM = 8  # name of the room (game) a client wants to join, opened if it isn't yet; without one, the default room
+FIELD_SEED = 9  # varint seed to generate the board of a room a client opens with
+FIELD_SESSION = 10  # token from a SESSION message, sent by a player that's reconnecting
+
+
+class Protocol_Error(Exception):
+    pass
+
+
+def pack_color(rgb):
+    return struct.pack("!3B", *rgb)
+
+
+def encode_varint(value):
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(buf, pos=0):
+    # Raises IndexError if buf ends partway through the varint
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise Protocol_Error("varint too long")
+
+
+def encode_varints(values):
+    if all(value < 0x80 for value in values):
+        return bytes(values)
+    return b"".join(encode_varint(value) for value in values)
+
+
+def decode_varints(buf):
+    values = []
+    pos = 0
+    try:
+        while pos < len(buf):
+            value, pos = decode_varint(buf, pos)
+            values.append(value)
+    except IndexError:
+        raise Protocol_Error("varint runs past the end of its frame") from None
+    return values
+
+
+def frame(msg_type, payload=b""):
+    return encode_varint(len(payload) + 1) + bytes((msg_type,)) + payload
+
+
+def encode_fields(fields):
+    return b"".join(encode_varint(tag) + encode_varint(len(value)) + value for tag, value in fields.items())
+
+
+def decode_fields(payload):
+    fields = {}
+    pos = 0
+    while pos < len(payload):
+        try:
+            tag, pos = decode_varint(payload, pos)
+            length, pos = decode_varint(payload, pos)
+        except IndexError:
+            raise Protocol_Error("field runs past the end of its frame") from None
+        if pos + length > len(payload):
+            raise Protocol_Error("field runs past the end of its frame")
+        fields[tag] = bytes(payload[pos : pos + length])
+        pos += length
+    return fields
+
+
+def encode_marks(marks):
+    # marks is an iterable of (square index, packed color)
+    return frame(MARKS, b"".join(encode_varint(idx) + color for idx, color in marks))
+
+
+def decode_marks(payload):
+    marks = []
+    pos = 0
+    while pos < len(payload):
+        idx, pos = decode_varint(payload, pos)
+        marks.append((idx, tuple(payload[pos : pos + 3])))
+        pos += 3
+    return marks
+
+
+def encode_line(color, line, completed):
+    return frame(LINE, color + encode_varint(line) + bytes((completed,)))
+
+
+def decode_line(payload):
+    line, pos = decode_varint(payload, 3)
+    return tuple(payload[:3]), line, bool(payload[pos])
+
+
+def encode_win(color, place):
+    return frame(WIN, color + encode_varint(place))
+
+
+def decode_win(payload):
+    return tuple(payload[:3]), decode_varint(payload, 3)[0]
+
+
+def encode_v1_marks(marks):
+    return b"".join(idx.to_bytes(1, "little") + color for idx, color in marks)
+
+
+def decode_board(payload, num_squares):
+    # Yields (square index, [colors]) for every square in a BOARD payload
+    pos = 0
+    for idx in range(num_squares):
+        num_markers, pos = decode_varint(payload, pos)
+        yield idx, [tuple(payload[pos + 3 * i : pos + 3 * i + 3]) for i in range(num_markers)]
+        pos += 3 * num_markers
+
+
+def encode_squares(squares):
+    # squares is an iterable of (square index, that square packed like in a BOARD)
+    return frame(SQUARES, b"".join(encode_varint(idx) + square for idx, square in squares))
+
+
+def decode_squares(payload):
+    # Yields (square index, [colors]) for every square in a SQUARES payload
+    pos = 0
+    while pos < len(payload):
+        idx, pos = decode_varint(payload, pos)
+        num_markers, pos = decode_varint(payload, pos)
+        yield idx, [tuple(payload[pos + 3 * i : pos + 3 * i + 3]) for i in range(num_markers)]
+        pos += 3 * num_markers
+
+
+class Frame_Reader:
+    # Buffers a byte stream and hands back every complete frame in it
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def pop(self):
+        # The next complete frame, None until there is one
+        for msg in self:
+            return msg
+        return None
+
+    def __iter__(self):
+        pos = 0
+        try:
+            while pos < len(self.buffer):
+                length, start = decode_varint(self.buffer, pos)
+                if length == 0 or length > MAX_FRAME:
+                    raise Protocol_Error("bad frame length %i" % length)
+                if start + length > len(self.buffer):
+                    break
+                msg_type = self.buffer[start]
+                payload = bytes(self.buffer[start + 1 : start + length])
+                pos = start + length
+                yield msg_type, payload
+        except IndexError:
+            # the length prefix itself is still incomplete
+            pass
+        finally:
+            del self.buffer[:pos]
+
+
+# The client side of the handshake, shared by explorer-client.py and explorer-render.py
+def recv_frame(sock: socket.socket, frames: Frame_Reader):
+    # assumes blocking, returns the next (type, payload) the server sends
+    while True:
+        for msg in frames:
+            return msg
+        data = sock.recv(READ_SIZE)
+        if data == b"":
+            sock.close()
+            return None
+        frames.feed(data)
+
+
+def connect(server_addr, color, spectate, resume=None, room=None):
+    # Blocks until the server has said hello, returns (socket, frames, hello fields) or None
+    # room is the hello fields picking which room to join (and how to open it if nobody has yet)
+    try:
+        sock = socket.create_connection(server_addr, timeout=CONNECT_TIMEOUT)
+    except OSError:
+        return None
+    # First tell the server which protocol we speak and if we're a player
+    fields = {**(room or {}), **(resume or {})}
+    if not spectate:
+        # We're a player, send our color so the server can deal with reconnection
+        fields[FIELD_COLOR] = pack_color(color)
+    frames = Frame_Reader()
+    try:
+        sock.sendall(bytes((HELLO_MAGIC, PROTOCOL_VERSION)) + frame(CLIENT_HELLO, encode_fields(fields)))
+        msg = recv_frame(sock, frames)
+    except OSError:
+        sock.close()
+        return None
+    if msg is None or msg[0] != SERVER_HELLO:
+        sock.close()
+        return None
+    return sock, frames, decode_fields(msg[1])
+
+
+def catalog_matches(fields, catalog):
+    # servers from before catalog digests don't send one, so there's nothing to check
+    return FIELD_CATALOG not in fields or fields[FIELD_CATALOG] == catalog.digest
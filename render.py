@@ -0,0 +1,211 @@
+import os
+import struct
+import zlib
+from game import EMPTY_COLOR, goal_font_size, iter_bits, stripe_coords
+
+# Board pictures without Tk or a display, for stream overlays and anything else that wants images of a game. Squares
+# are laid out like Game_View lays them out: stripes split like _Square_View.make_rectangle's, goal text wrapped to
+# 95% of a square and sized by goal_font_size, hidden where the fog is. Pixels are one bytearray of R G B that
+# everything is drawn into a row at a time with slice assignment, and the white runs of every goal's wrapped text
+# are worked out once per text and square size, so a mark only costs redrawing the squares it changed.
+PNG_LEVEL = 1  # zlib level, flat colors squash plenty at the fastest one
+GLYPH_EM = 10  # 7 rows of capitals are about as tall as they are in a 10 pixel font
+GLYPH_ADVANCE = 6  # columns from one glyph to the next
+LINE_ADVANCE = 9  # rows from one line of text to the next
+WHITE = b"\xff\xff\xff"
+
+# 5x7 glyphs for " " to "~", 5 columns each with the top row in the lowest bit
+FONT = bytes.fromhex(
+    "000000000000005F00000007000700147F147F14242A7F2A12231308646236495522500005030000001C2241000041221C00"
+    "14083E081408083E080800503000000808080808006060000020100804023E5149453E00427F400042615149462141454B31"
+    "1814127F1027454545393C4A49493001710905033649494936064949291E0036360000005636000008142241001414141414"
+    "00412214080201510906324979413E7E1111117E7F494949363E414141227F4141221C7F494949417F090909013E4149497A"
+    "7F0808087F00417F41002040413F017F081422417F404040407F020C027F7F0408107F3E4141413E7F090909063E4151215E"
+    "7F09192946464949493101017F01013F4040403F1F2040201F3F4038403F631408146307087008076151494543007F414100"
+    "02040810200041417F0004020102044040404040000102040020545454787F484444383844444420384444487F3854545418"
+    "087E0901020C5252523E7F0804047800447D40002040443D007F1028440000417F40007C041804787C080404783844444438"
+    "7C14141408081414187C7C080404084854545420043F4440203C4040207C1C2040201C3C4030403C44281028440C5050503C"
+    "4464544C44000836410000007F000000413608000804081008"
+)
+
+_glyph_runs = {}
+
+
+def glyph_runs(char, scale):
+    # (x, y, length) of every run of lit pixels in char scaled up scale times, anything outside ASCII is a "?"
+    key = (char, scale)
+    if key not in _glyph_runs:
+        code = ord(char) - 32 if " " <= char <= "~" else ord("?") - 32
+        columns = FONT[5 * code : 5 * code + 5]
+        runs = []
+        for row in range(7):
+            start = None
+            for x, on in enumerate([column >> row & 1 for column in columns] + [0]):
+                if on and start is None:
+                    start = x
+                elif not on and start is not None:
+                    runs += [(start * scale, row * scale + dy, (x - start) * scale) for dy in range(scale)]
+                    start = None
+        _glyph_runs[key] = runs
+    return _glyph_runs[key]
+
+
+def wrap(text, per_line):
+    # Greedy word wrap like Tk's, a word that doesn't fit on a line of its own gets split
+    lines = []
+    line = ""
+    for word in text.split():
+        while len(word) > per_line:
+            if line:
+                lines.append(line)
+                line = ""
+            lines.append(word[:per_line])
+            word = word[per_line:]
+        if not line:
+            line = word
+        elif len(line) + 1 + len(word) <= per_line:
+            line += " " + word
+        else:
+            lines.append(line)
+            line = word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def png_chunk(tag, data):
+    return struct.pack("!I", len(data)) + tag + data + struct.pack("!I", zlib.crc32(tag + data))
+
+
+class Board_Image:
+    def __init__(self, board_size, goal_indices, goal_list, width, height):
+        self.size = board_size
+        self.width = width
+        self.height = height
+        self.stride = 3 * width
+        self.pixels = bytearray(self.stride * height)
+        self.white = memoryview(WHITE * width)
+        self.texts = [goal_list[goal_indices[i]] for i in range(board_size * board_size)]
+        square_width = width / board_size
+        square_height = height / board_size
+        # pixel bounds of every square, rounded so neighbors meet exactly
+        self.bounds = [
+            (
+                round(col * square_width),
+                round(row * square_height),
+                round((col + 1) * square_width),
+                round((row + 1) * square_height),
+            )
+            for row in range(board_size)
+            for col in range(board_size)
+        ]
+        self.squares = [((), True)] * (board_size * board_size)  # (colors, text visible) to draw every square with
+        self.dirty = set(range(board_size * board_size))
+        self.layouts = {}  # (text, square width, square height) -> its white runs, see text_runs
+
+    def set_square(self, idx, colors, visible=True):
+        # colors in the order to draw their stripes, left to right
+        square = (tuple(colors), bool(visible))
+        if square != self.squares[idx]:
+            self.squares[idx] = square
+            self.dirty.add(idx)
+
+    def text_runs(self, text, width, height):
+        # (offset from the top left of the square, length) in bytes of every run of white in text laid out in a
+        # width x height square, cut off at its edges so drawing it never touches another square
+        key = (text, width, height)
+        if key in self.layouts:
+            return self.layouts[key]
+        scale = max(1, round(goal_font_size(len(text), height) / 0.75 / GLYPH_EM))
+        advance = GLYPH_ADVANCE * scale
+        lines = wrap(text, max(1, int((width * 0.95 + scale) // advance)))
+        top = (height - (LINE_ADVANCE * len(lines) - 2) * scale) // 2
+        runs = []
+        for i, line in enumerate(lines):
+            left = (width - len(line) * advance + scale) // 2
+            for j, char in enumerate(line):
+                for x, y, length in glyph_runs(char, scale):
+                    x += left + j * advance
+                    y += top + i * LINE_ADVANCE * scale
+                    start = max(x, 0)
+                    end = min(x + length, width)
+                    if 0 <= y < height and start < end:
+                        runs.append((y * self.stride + 3 * start, 3 * (end - start)))
+        self.layouts[key] = runs
+        return runs
+
+    def fill(self, left, top, right, bottom, color):
+        # A rectangle outlined in white along its top and left, and its bottom and right where those are the edge of
+        # the image, so every square and stripe is split from the next by exactly one line like on a Tk canvas
+        width = right - left
+        if width <= 0 or bottom <= top:
+            return
+        row = bytearray(bytes(color) * width)
+        row[:3] = WHITE
+        if right == self.width:
+            row[-3:] = WHITE
+        edge = self.white[: 3 * width]
+        pixels = self.pixels
+        pos = top * self.stride + 3 * left
+        pixels[pos : pos + 3 * width] = edge
+        for y in range(top + 1, bottom):
+            pos += self.stride
+            pixels[pos : pos + 3 * width] = edge if y == self.height - 1 else row
+
+    def draw_square(self, idx):
+        colors, visible = self.squares[idx]
+        left, top, right, bottom = self.bounds[idx]
+        divs = len(colors) or 1
+        for i, color in enumerate(colors or (EMPTY_COLOR,)):
+            x0, _, x1, _ = stripe_coords(left, top, right - left, bottom - top, divs, i)
+            self.fill(round(x0), top, round(x1), bottom, color)
+        if visible:
+            pixels = self.pixels
+            white = self.white
+            base = top * self.stride + 3 * left
+            for offset, length in self.text_runs(self.texts[idx], right - left, bottom - top):
+                pixels[base + offset : base + offset + length] = white[:length]
+
+    def render(self):
+        # The pixels, with every square that changed since last time drawn again
+        for idx in self.dirty:
+            self.draw_square(idx)
+        self.dirty.clear()
+        return self.pixels
+
+    def ppm(self):
+        pixels = self.render()
+        return b"P6 %i %i 255\n" % (self.width, self.height) + pixels
+
+    def png(self, level=PNG_LEVEL):
+        pixels = self.render()
+        # every row starts with its filter type, 0 for none
+        rows = b"".join(b"\0" + pixels[pos : pos + self.stride] for pos in range(0, len(pixels), self.stride))
+        header = struct.pack("!2I5B", self.width, self.height, 8, 2, 0, 0, 0)
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + png_chunk(b"IHDR", header)
+            + png_chunk(b"IDAT", zlib.compress(rows, level))
+            + png_chunk(b"IEND", b"")
+        )
+
+    def save(self, path):
+        # PPM if path says so, otherwise PNG. Written next to path and moved over it, so whatever is watching the
+        # file never reads half an image
+        data = self.ppm() if path.lower().endswith(".ppm") else self.png()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def draw_model(image, model, sight=None):
+    # A Game_Model's board through its own fog, or through a Fog bitmask of what some player can see
+    for idx, colors in enumerate(model.colors):
+        image.set_square(idx, sorted(colors), model.is_visible(idx) if sight is None else sight >> idx & 1)
+
+
+def draw_server_game(image, game, sight=None):
+    # A Server_Game's board as it is right now, with nothing hidden unless there's a sight bitmask
+    for idx, markers in enumerate(game.markers):
+        colors = sorted(game.by_index[i].color for i in iter_bits(markers))
+        image.set_square(idx, colors, sight is None or sight >> idx & 1)
@@ -0,0 +1,302 @@
+import heapq
+import random
+from boards import Board_Generator, shuffled_goals
+from game import Game_Model, popcount
+
+# Monte Carlo games on the boards of a range of seeds, to see how they play: how fast the fog opens, how soon every
+# goal (and every square) comes into sight, and how long lines and bingo take. Every player is a Game_Model of their
+# own, exactly like a client's, marking one of the squares they can see at a time according to a strategy. Time is
+# counted in goals done; with weighted a goal takes 1 + its difficulty instead. Games are reduced into Sim_Stats as
+# they finish, and Sim_Stats merge, so a pool of processes can each reduce a chunk of seeds and hand back just that.
+CHUNK_SEEDS = 64
+COLORS = [(255, 0, 0), (0, 0, 255), (0, 200, 0), (255, 200, 0), (200, 0, 200), (0, 200, 200), (255, 128, 0)]
+
+
+class Running_Stats:
+    # Count, mean, variance (Welford's) and range of a stream of numbers, mergeable with another one's (Chan's)
+    __slots__ = ("count", "mean", "m2", "low", "high")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.low = float("inf")
+        self.high = float("-inf")
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+
+    def std(self):
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.mean, "std": self.std(), "min": self.low, "max": self.high}
+
+
+class Histogram:
+    # How often each value came up, for percentiles of times that only ever take a few hundred different values
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+
+    def add(self, value):
+        value = round(value, 1)
+        self.counts[value] = self.counts.get(value, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.count += other.count
+
+    def percentile(self, fraction):
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= fraction * self.count:
+                return value
+        return None
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        total = sum(value * count for value, count in self.counts.items())
+        percentiles = {"p%i" % (100 * fraction): self.percentile(fraction) for fraction in (0.1, 0.5, 0.9, 0.99)}
+        return {"count": self.count, "mean": total / self.count, **percentiles}
+
+
+class Sim_Stats:
+    def __init__(self, board_size, num_goals):
+        num_squares = board_size * board_size
+        self.board_size = board_size
+        self.games = 0
+        self.fog = [Running_Stats() for _ in range(num_squares + 1)]  # squares a player sees after k of their marks
+        self.square_seen = [Running_Stats() for _ in range(num_squares)]  # when each square first came into sight
+        self.square_unseen = [0] * num_squares  # games that ended before it did
+        self.goal_seen = [Running_Stats() for _ in range(num_goals)]  # likewise for every goal, wherever it was
+        self.goal_unseen = [0] * num_goals
+        self.goal_distance = [Running_Stats() for _ in range(num_goals)]  # marks it's away from the start squares
+        self.lines = [Running_Stats() for _ in range(2 * board_size + 2)]  # when each line was first completed
+        self.first_line = Histogram()  # when anyone first completed a line
+        self.player_first_line = Histogram()  # when each player first completed one
+        self.win = Histogram()  # when someone got bingo
+        self.no_win = 0
+
+    def merge(self, other):
+        self.games += other.games
+        for mine, theirs in (
+            (self.fog, other.fog),
+            (self.square_seen, other.square_seen),
+            (self.goal_seen, other.goal_seen),
+            (self.goal_distance, other.goal_distance),
+            (self.lines, other.lines),
+        ):
+            for stats, other_stats in zip(mine, theirs):
+                stats.merge(other_stats)
+        for counts, other_counts in ((self.square_unseen, other.square_unseen), (self.goal_unseen, other.goal_unseen)):
+            for i, count in enumerate(other_counts):
+                counts[i] += count
+        self.first_line.merge(other.first_line)
+        self.player_first_line.merge(other.player_first_line)
+        self.win.merge(other.win)
+        self.no_win += other.no_win
+
+
+class Sim_Player:
+    # A Game_Model of their own, and the squares they can see but haven't marked kept in a list (to pick from at
+    # random) along with where in it each one is (to take one out in constant time)
+    def __init__(self, board_size, color, strategy):
+        self.model = Game_Model(board_size)
+        self.color = color
+        self.strategy = strategy
+        self.marks = 0  # bitmask over squares
+        self.num_visible = 0
+        self.open = []
+        self.position = {}
+        self.lines = 0
+        self.first_line = None
+        self.see([idx for idx in range(board_size * board_size) if self.model.is_visible(idx)])
+
+    def see(self, squares):
+        self.num_visible += len(squares)
+        for idx in squares:
+            self.position[idx] = len(self.open)
+            self.open.append(idx)
+
+    def mark(self, idx):
+        # Returns the squares that came into sight
+        last = self.open.pop()
+        if last != idx:
+            self.open[self.position[idx]] = last
+            self.position[last] = self.position[idx]
+        del self.position[idx]
+        self.marks |= 1 << idx
+        envisioned = self.model.explore_surrounding(idx)
+        self.see(envisioned)
+        return envisioned
+
+
+# Strategies pick one of the squares player can see and hasn't marked; ties are broken at random so the players
+# using them don't all walk the same path
+def pick_random(sim, player, goals, rng):
+    return rng.choice(player.open)
+
+
+def pick_explore(sim, player, goals, rng):
+    # whichever brings the most squares into sight
+    visible = player.model.is_visible
+    return max(player.open, key=lambda idx: (sum(not visible(adj) for adj in sim.game.neighbors[idx]), rng.random()))
+
+
+def pick_lines(sim, player, goals, rng):
+    # whichever goes furthest towards finishing a line
+    masks = sim.game.line_masks
+    lines_through = sim.game.lines_through
+    return max(
+        player.open,
+        key=lambda idx: (max(popcount(player.marks & masks[line]) for line in lines_through[idx]), rng.random()),
+    )
+
+
+def pick_easy(sim, player, goals, rng):
+    # whichever goal is easiest
+    return min(player.open, key=lambda idx: (sim.difficulties[goals[idx]], rng.random()))
+
+
+STRATEGIES = {"random": pick_random, "explore": pick_explore, "lines": pick_lines, "easy": pick_easy}
+
+
+class Simulation:
+    def __init__(
+        self, board_size, strategies, difficulties, types, balanced=False, weighted=False, lines_to_win=1, games=1
+    ):
+        self.size = board_size
+        self.num_squares = board_size * board_size
+        self.strategies = strategies
+        self.difficulties = difficulties
+        self.num_goals = len(difficulties)
+        self.weighted = weighted
+        self.lines_to_win = lines_to_win
+        self.games = games  # per seed, each with the players making different picks
+        self.generator = Board_Generator(difficulties, types, board_size) if balanced else None
+        self.game = Game_Model(board_size)
+        self.distances = self.start_distances()
+
+    def start_distances(self):
+        # Fewest marks it takes to see every square, from a breadth first search out of the start squares
+        distances = [None] * self.num_squares
+        frontier = [idx for idx in range(self.num_squares) if self.game.is_visible(idx)]
+        for idx in frontier:
+            distances[idx] = 0
+        for idx in frontier:
+            for adj in self.game.neighbors[idx]:
+                if distances[adj] is None:
+                    distances[adj] = distances[idx] + 1
+                    frontier.append(adj)
+        return distances
+
+    def board(self, seed):
+        if self.generator is not None:
+            return self.generator.generate(seed)
+        return shuffled_goals(self.num_goals, self.size, seed)
+
+    def cost(self, goal):
+        return 1 + self.difficulties[goal] if self.weighted else 1
+
+    def play(self, goals, rng, stats):
+        players = [
+            Sim_Player(self.size, COLORS[i % len(COLORS)], STRATEGIES[strategy])
+            for i, strategy in enumerate(self.strategies)
+        ]
+        seen = [0 if self.game.is_visible(idx) else None for idx in range(self.num_squares)]
+        line_times = [None] * len(self.game.line_masks)
+        first_line = win = None
+        # (time they'll next mark, player number), so the player that's been busiest waits the longest
+        clocks = [(0, i) for i in range(len(players))]
+        for player in players:
+            stats.fog[0].add(player.num_visible)
+        while clocks and win is None:
+            clock, i = heapq.heappop(clocks)
+            player = players[i]
+            if not player.open:
+                continue
+            idx = player.strategy(self, player, goals, rng)
+            clock += self.cost(goals[idx])
+            for other in players:
+                other.model.mark(idx, player.color)
+            for adj in player.mark(idx):
+                if seen[adj] is None:
+                    seen[adj] = clock
+            stats.fog[popcount(player.marks)].add(player.num_visible)
+            for line in self.game.lines_through[idx]:
+                mask = self.game.line_masks[line]
+                if player.marks & mask == mask:
+                    player.lines += 1
+                    if line_times[line] is None:
+                        line_times[line] = clock
+                    if player.first_line is None:
+                        player.first_line = clock
+                        stats.player_first_line.add(clock)
+                    if first_line is None:
+                        first_line = clock
+            if player.lines >= self.lines_to_win:
+                win = clock
+            heapq.heappush(clocks, (clock, i))
+        for idx, when in enumerate(seen):
+            goal = goals[idx]
+            stats.goal_distance[goal].add(self.distances[idx])
+            if when is None:
+                stats.square_unseen[idx] += 1
+                stats.goal_unseen[goal] += 1
+            else:
+                stats.square_seen[idx].add(when)
+                stats.goal_seen[goal].add(when)
+        for line, when in enumerate(line_times):
+            if when is not None:
+                stats.lines[line].add(when)
+        if first_line is not None:
+            stats.first_line.add(first_line)
+        if win is not None:
+            stats.win.add(win)
+        else:
+            stats.no_win += 1
+        stats.games += 1
+
+    def run_seeds(self, seeds):
+        # One chunk's worth of games, reduced
+        stats = Sim_Stats(self.size, self.num_goals)
+        for seed in range(*seeds):
+            goals = self.board(seed)
+            for game in range(self.games):
+                self.play(goals, random.Random("%i:%i" % (seed, game)), stats)
+        return stats
+
+    def run(self, first_seed, count, pool=None):
+        # Every seed's games, spread over pool if there is one, merged in whatever order the chunks finish
+        chunks = (
+            (start, min(start + CHUNK_SEEDS, first_seed + count))
+            for start in range(first_seed, first_seed + count, CHUNK_SEEDS)
+        )
+        stats = Sim_Stats(self.size, self.num_goals)
+        results = pool.imap_unordered(self.run_seeds, chunks) if pool is not None else map(self.run_seeds, chunks)
+        for chunk_stats in results:
+            stats.merge(chunk_stats)
+        return stats
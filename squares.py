@@ -1,188 +1,139 @@
-from enum import IntEnum
+from time import perf_counter
 from tkinter import Tk, Canvas
-
-
-def rgb_to_hex(rgb):
-    return "#%02x%02x%02x" % rgb
-
-
-class Visibility(IntEnum):
-
-    INVISIBLE = 0
-    VISIBLE = 1
-    ALWAYS = 2
+from tkinter.font import Font
+from game import (
+    EMPTY_COLOR,
+    Fog,
+    Game,
+    Game_Model,
+    goal_font_size,
+    iter_bits,
+    pixel_to_int_point,
+    pixel_to_point,
+    rgb_to_hex,
+    stripe_coords,
+)
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "mean": sum(times) / len(times),
+        "p50": times[len(times) // 2],
+        "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "max": times[-1],
+    }
+
+
+class Font_Cache:
+    # The goal font for every length of goal text, shared by every square with a goal that long. They're named Tk
+    # fonts, so giving one a new size when the squares change size redraws every text using it at once.
+    def __init__(self, root, square_height):
+        self.root = root
+        self.square_height = square_height
+        self.sizes = {}  # (text length, square height) -> points
+        self.fonts = {}  # text length -> Font
+
+    def size(self, length, square_height):
+        key = (length, square_height)
+        if key not in self.sizes:
+            self.sizes[key] = goal_font_size(length, square_height)
+        return self.sizes[key]
+
+    def font(self, text):
+        length = len(text)
+        if length not in self.fonts:
+            self.fonts[length] = Font(root=self.root, family="arial", size=self.size(length, self.square_height))
+        return self.fonts[length]
+
+    def resize(self, square_height):
+        self.square_height = square_height
+        for length, font in self.fonts.items():
+            font.configure(size=self.size(length, square_height))
 
 
 class _Square_View:
-    def __init__(self, canvas: Canvas, left, top, square_width, square_height, text):
-        self.left = left
-        self.top = top
+    # Canvas items are created once and then only moved, recolored or hidden: a background, a pool of one stripe
+    # per marker (which only grows), and the goal text on top of them. Where the square is comes from the view every
+    # time, so when the window is resized only the items already on the canvas have to be scaled.
+    def __init__(self, view, idx, text):
+        self.view = view
+        self.idx = idx
         self.text = text
-        self.square_width = square_width
-        self.square_height = square_height
-        self.canvas = canvas
+        self.canvas = view.canvas
         self.text_shape = None
+        self.text_visible = False
+        self.stripes = []
+        self.num_stripes = 0
         self.draw_empty()
 
-    @staticmethod
-    def pixel_to_point(size: int) -> float:
-        scaled = size * 0.75
-        # round to nearest half pt
-        return round(scaled * 2.0) / 2.0
+    pixel_to_point = staticmethod(pixel_to_point)
+    pixel_to_int_point = staticmethod(pixel_to_int_point)
+
+    @property
+    def left(self):
+        return self.view.left(self.idx)
 
-    @staticmethod
-    def pixel_to_int_point(size: int) -> int:
-        return round(size * 0.75)
+    @property
+    def top(self):
+        return self.view.top(self.idx)
+
+    @property
+    def square_width(self):
+        return self.view.square_width
+
+    @property
+    def square_height(self):
+        return self.view.square_height
+
+    def stripe_coords(self, divs, idx):
+        return stripe_coords(self.left, self.top, self.square_width, self.square_height, divs, idx)
 
     def make_rectangle(self, color, divs, idx):
-        width = self.square_width / divs
-        return self.canvas.create_rectangle(
-            self.left + idx * width,
-            self.top,
-            self.left + (idx + 1) * width,
-            self.top + self.square_height,
-            fill=rgb_to_hex(color),
-            outline="white",
-        )
+        return self.canvas.create_rectangle(*self.stripe_coords(divs, idx), fill=rgb_to_hex(color), outline="white")
 
     def draw_empty(self):
-        self.recs = {self.make_rectangle((40, 40, 40), 1, 0)}
+        self.background = self.make_rectangle(EMPTY_COLOR, 1, 0)
 
     def make_visible(self):
-        # TODO hardcoded height/width
-        ratio = 1 / (len(self.text)) ** 0.5
-        height_px = round(self.square_height * ratio)
-
-        self.text_shape = self.canvas.create_text(
-            self.left + self.square_width / 2,
-            self.top + self.square_height / 2,
-            text=self.text,
-            fill="white",
-            activefill="black",
-            width=self.square_width * 0.95,
-            font=("arial", self.pixel_to_int_point(height_px)),
-            justify="center",
-        )
+        if self.text_shape is None:
+            self.text_shape = self.canvas.create_text(
+                self.left + self.square_width / 2,
+                self.top + self.square_height / 2,
+                text=self.text,
+                fill="white",
+                activefill="black",
+                width=self.square_width * 0.95,
+                font=self.view.fonts.font(self.text),
+                justify="center",
+                tags="goal",
+            )
+        elif not self.text_visible:
+            self.canvas.itemconfig(self.text_shape, state="normal")
+        self.text_visible = True
 
     def make_invisible(self):
-        self.canvas.delete(self.text_shape)
-        self.text_shape = None
-
-    def redraw_text(self):
-        if self.text_shape is not None:
-            self.make_invisible()
-            self.make_visible()
+        if self.text_visible:
+            self.canvas.itemconfig(self.text_shape, state="hidden")
+            self.text_visible = False
 
     def redraw_rectangle(self, colors):
-        for rec in self.recs:
-            self.canvas.delete(rec)
-        self.recs = set()
-        for i in range(len(colors)):
-            self.recs.add(self.make_rectangle(colors[i], len(colors), i))
-        if len(self.recs) == 0:
-            self.draw_empty()
-        self.redraw_text()
-
-
-class _Square_Model:
-    def __init__(self, board_size, board_idx):
-        self.board_size = board_size
-        self.board_idx = board_idx
-        self.visible = Visibility.INVISIBLE
-        self.colors = set()  # !!! Colors should be in (R, G, B) form, NOT hex yet!
-
-    def __repr__(self):
-        border = "------------"
-        ret = border + "\n"
-        for color in self.colors:
-            ret += "|" + rgb_to_hex(color) + "|\n"
-        for i in range(4 - len(self.colors)):
-            ret += "|         |\n"
-        return ret + border
-
-    def mark(self, color):
-        if color not in self.colors:
-            self.colors.add(color)
-            return (True, sorted(self.colors))
-        else:
-            self.colors.remove(color)
-            return (False, sorted(self.colors))
-
-
-class Game:
-    def __init__(self, board_size):
-        self.size: int = board_size
-        if board_size % 2:
-            self.middle = (board_size * board_size) // 2
-        else:
-            self.middle = (board_size * board_size) // 2 - (board_size // 2)
-
-    def row(self, idx):
-        return idx // self.size
-
-    def col(self, idx):
-        return idx % self.size
-
-    def adjacent_indices(self, idx):
-        row = self.row(idx)
-        col = self.col(idx)
-        ret = []
-        if row > 0:
-            ret.append(idx - self.size)
-        if row < self.size - 1:
-            ret.append(idx + self.size)
-        if col > 0:
-            ret.append(idx - 1)
-        if col < self.size - 1:
-            ret.append(idx + 1)
-        return ret
-
-
-class Game_Model(Game):
-    def __init__(self, board_size, all_visible=False):
-        super().__init__(board_size)
-        self.squares = [_Square_Model(board_size, i) for i in range(board_size * board_size)]
-        if all_visible:
-            for square in self.squares:
-                square.visible = Visibility.ALWAYS
-        else:
-            self.squares[self.middle].visible = Visibility.ALWAYS
-            if board_size % 2:
-                for idx in self.adjacent_indices(self.middle):
-                    self.squares[idx].visible = Visibility.ALWAYS
+        divs = len(colors)
+        created = False
+        for i, color in enumerate(colors):
+            if i < len(self.stripes):
+                self.canvas.coords(self.stripes[i], *self.stripe_coords(divs, i))
+                self.canvas.itemconfig(self.stripes[i], fill=rgb_to_hex(color), state="normal")
             else:
-                self.squares[self.middle - 1].visible = Visibility.ALWAYS
-                self.squares[self.middle + board_size].visible = Visibility.ALWAYS
-                self.squares[self.middle + board_size - 1].visible = Visibility.ALWAYS
-
-    def __repr__(self):
-        ret = "\n".join([repr(square) for square in self.squares])
-        return ret
-
-    def mark(self, idx, color):
-        return self.squares[idx].mark(color)
-
-    def explore_surrounding(self, idx):
-        envisioned = []
-        for adj_idx in self.adjacent_indices(idx):
-            if self.squares[adj_idx].visible == Visibility.INVISIBLE:
-                self.squares[adj_idx].visible = Visibility.VISIBLE
-                envisioned.append(adj_idx)
-        return envisioned
-
-    def surrounded_by_color(self, idx, color):
-        for adj_idx in self.adjacent_indices(idx):
-            if color in self.squares[adj_idx].colors:
-                return True
-        return False
-
-    def unexplore_surrounding(self, idx, color):
-        devisioned = []
-        for adj_idx in self.adjacent_indices(idx):
-            if self.squares[adj_idx].visible == Visibility.VISIBLE and not self.surrounded_by_color(adj_idx, color):
-                self.squares[adj_idx].visible = Visibility.INVISIBLE
-                devisioned.append(adj_idx)
-        return devisioned
+                self.stripes.append(self.make_rectangle(color, divs, i))
+                created = True
+        for i in range(divs, self.num_stripes):
+            self.canvas.itemconfig(self.stripes[i], state="hidden")
+        self.num_stripes = divs
+        if created and self.text_shape is not None:
+            # new items go on top of everything, the text has to stay above them
+            self.canvas.tag_raise(self.text_shape)
 
 
 class Game_View(Game):
@@ -191,24 +142,17 @@ class Game_View(Game):
         self.canvas = canvas
         self.square_width = canvas.width / board_size
         self.square_height = canvas.height / board_size
-        self.squares = [
-            _Square_View(
-                canvas, self.left(i), self.top(i), self.square_width, self.square_height, goal_list[goal_indices[i]]
-            )
-            for i in range(board_size * board_size)
-        ]
-        if all_visible:
-            for square in self.squares:
-                square.make_visible()
-        else:
-            self.squares[self.middle].make_visible()
-            if board_size % 2:
-                for idx in self.adjacent_indices(self.middle):
-                    self.squares[idx].make_visible()
-            else:
-                self.squares[self.middle - 1].make_visible()
-                self.squares[self.middle + board_size].make_visible()
-                self.squares[self.middle + board_size - 1].make_visible()
+        self.fonts = Font_Cache(canvas, self.square_height)
+        self.squares = [_Square_View(self, i, goal_list[goal_indices[i]]) for i in range(board_size * board_size)]
+        # Squares to redraw and their latest colors, all drawn at once when Tk is next idle
+        self.dirty = {}
+        self.flush_scheduled = False
+        # Likewise the size the window was last resized to
+        self.new_size = None
+        self.resize_scheduled = False
+        self.frame_times = None
+        for idx in range(board_size * board_size) if all_visible else self.start_squares():
+            self.squares[idx].make_visible()
 
     def left(self, idx):
         return (idx % self.size) * self.square_width
@@ -217,7 +161,58 @@ class Game_View(Game):
         return (idx // self.size) * self.square_height
 
     def redraw_rectangle(self, idx, colors):
-        self.squares[idx].redraw_rectangle(colors)
+        self.dirty[idx] = colors
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.canvas.after_idle(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        dirty = self.dirty
+        self.dirty = {}
+        if self.frame_times is None:
+            for idx, colors in dirty.items():
+                self.squares[idx].redraw_rectangle(colors)
+            return
+        start = perf_counter()
+        for idx, colors in dirty.items():
+            self.squares[idx].redraw_rectangle(colors)
+        # include Tk actually drawing it
+        self.canvas.update_idletasks()
+        self.frame_times.append((perf_counter() - start, len(dirty)))
+
+    def resize(self, width, height):
+        self.new_size = (width, height)
+        if not self.resize_scheduled:
+            self.resize_scheduled = True
+            self.canvas.after_idle(self.apply_resize)
+
+    def apply_resize(self):
+        # Every item is scaled by the canvas in one go, every goal text rewrapped with one itemconfig on their tag and
+        # rescaled by resizing the few shared fonts, however big the board
+        self.resize_scheduled = False
+        width, height = self.new_size
+        if (width, height) == (self.canvas.width, self.canvas.height) or width < self.size or height < self.size:
+            return
+        self.canvas.scale("all", 0, 0, width / self.canvas.width, height / self.canvas.height)
+        self.canvas.width = width
+        self.canvas.height = height
+        self.square_width = width / self.size
+        self.square_height = height / self.size
+        self.canvas.itemconfig("goal", width=self.square_width * 0.95)
+        self.fonts.resize(self.square_height)
+
+    def measure_frames(self):
+        self.frame_times = []
+
+    def frame_stats(self):
+        # Summary of, and then forget, the frames flushed since last time
+        if not self.frame_times:
+            return None
+        stats = summarize(frame_time for frame_time, _ in self.frame_times)
+        stats["squares"] = sum(num_squares for _, num_squares in self.frame_times)
+        self.frame_times = []
+        return stats
 
     def make_visible(self, idx):
         self.squares[idx].make_visible()
@@ -231,7 +226,8 @@ class Game_Controller(Game):
         super().__init__(board_size)
         self.root = Tk()
         self.color = color
-        self.canvas = Canvas(self.root, width=board_width, height=board_height)
+        # without a highlight border, the canvas is exactly as big as the window says it is when it's resized
+        self.canvas = Canvas(self.root, width=board_width, height=board_height, highlightthickness=0)
         self.canvas.width = board_width
         self.canvas.height = board_height
         self.goal_indices = goal_indices
@@ -239,8 +235,17 @@ class Game_Controller(Game):
         self.all_visible = all_visible
         self.model: Game_Model = Game_Model(board_size, all_visible)
         self.view: Game_View = Game_View(board_size, self.canvas, goal_indices, goal_list, all_visible)
-        self.canvas.pack()
+        # Seeing everything, we can also look at the board the way any one player sees it
+        self.fog = Fog(board_size) if all_visible else None
+        self.watching = None  # the player whose sight we're showing, None for all of it
+        self.canvas.pack(fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda event: self.view.resize(event.width, event.height))
         self.root.bind("<Button-1>", self.mouse_pressed)
+        if all_visible:
+            self.root.bind("<Tab>", lambda event: self.watch_next(1))
+            self.root.bind("<Right>", lambda event: self.watch_next(1))
+            self.root.bind("<Left>", lambda event: self.watch_next(-1))
+            self.root.bind("<Escape>", lambda event: self.watch(None))
 
     def __repr__(self):
         return repr(self.model)
@@ -251,7 +256,11 @@ class Game_Controller(Game):
     def mark(self, idx, color):
         (added, colors) = self.model.mark(idx, color)
         self.view.redraw_rectangle(idx, colors)
-        if color == self.color:
+        if self.fog is not None:
+            changed = self.fog.mark(idx, color)
+            if color == self.watching:
+                self.show_sight(changed)
+        elif color == self.color:
             if added:
                 for newly_visible in self.model.explore_surrounding(idx):
                     self.view.make_visible(newly_visible)
@@ -260,11 +269,34 @@ class Game_Controller(Game):
                 for newly_invisible in self.model.unexplore_surrounding(idx, color):
                     self.view.make_invisible(newly_invisible)
 
+    def show_sight(self, changed):
+        # Redraws the squares in the changed bitmask as the player we're watching sees them
+        sight = self.fog.sight_of(self.watching)
+        for idx in iter_bits(changed):
+            if sight >> idx & 1:
+                self.view.make_visible(idx)
+            else:
+                self.view.make_invisible(idx)
+
+    def watch(self, color):
+        before = self.fog.sight_of(self.watching)
+        self.watching = color
+        self.show_sight(before ^ self.fog.sight_of(color))
+        if color is None:
+            self.root.title("Watching everyone")
+        else:
+            self.root.title("Watching %i %i %i (Tab or arrows for another player, Esc for everyone)" % color)
+
+    def watch_next(self, step):
+        # Cycles through everyone who has marked anything, and the whole board between the last and the first
+        choices = [None, *self.fog.players]
+        self.watch(choices[(choices.index(self.watching) + step) % len(choices)])
+
     def mouse_pressed(self, event):
         col = int(event.x * self.size / self.canvas.width)
         row = int(event.y * self.size / self.canvas.height)
         idx = row * self.size + col
-        if int(self.model.squares[idx].visible) > 0:
+        if self.model.is_visible(idx):
             self.mark(idx, self.color)
             return idx
         else: